@@ -0,0 +1,108 @@
+"""container module for AutotagBacklog"""
+from __future__ import annotations
+
+from . import strings
+from ..config import Configuration as ProgramConfig
+from .config import Configuration as AgentConfig
+from ..db_connection_pool import DbConnectionPool
+from .autotagger import AutoTagger
+from .pwgo_image import PiwigoImage
+from .paged_image_job import PagedImageJob
+
+class AutotagBacklog(PagedImageJob):
+    """Works through the images waiting in the auto tag album. Images are read from the
+    album in pages ordered by id and tagged with a bounded number of concurrent autotaggers
+    so a large backlog doesn't exhaust the db pool or memory. The last image id of each
+    finished page is checkpointed in the autotag_backlog table so an interrupted run
+    continues where it stopped when the agent restarts."""
+    PROGRESS_MSG = "autotagged %s of %s backlog images of album %s, %s failed (eta %.0fs)"
+    FAILURE_MSG = "unable to autotag backlog image %s"
+
+    @classmethod
+    async def process(cls) -> None:
+        """autotags every image in the auto tag album, resuming from the checkpoint of
+        an interrupted run, and then applies label tags to previously tagged images"""
+        acfg = AgentConfig.get()
+        album_id = acfg.auto_tag_alb
+        last_image_id = await cls._get_checkpoint(album_id)
+        done, failed = await cls._run_pages(album_id, last_image_id
+            , acfg.autotag_backlog_workers, acfg.autotag_backlog_page_size)
+
+        await cls._clear_checkpoint(album_id)
+        cls.get_logger().info("finished autotag backlog: %s images, %s failed", done, failed)
+
+        # initialize the tags for any previously autotagged images
+        # this is in case a new tag has been added to the piwigo table
+        # that matches one that was previously detected by rekognition
+        await AutoTagger.apply_label_tags()
+
+    @classmethod
+    def _log_begin(cls, key: int, total: int, last_image_id: int) -> None:
+        cls.get_logger().info(strings.LOG_AUTOTAG_BACKLOG_BEGIN(total, last_image_id))
+
+    @classmethod
+    async def _handle_image(cls, img: PiwigoImage) -> None:
+        """autotags a single image"""
+        async with AutoTagger.create(img) as tagger:
+            await tagger.autotag_image()
+
+    @classmethod
+    async def _get_checkpoint(cls, album_id: int) -> int:
+        pcfg = ProgramConfig.get()
+        async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.msg_db_name) as (cur,conn):
+            sql = """
+                INSERT INTO autotag_backlog (category_id, last_image_id)
+                VALUES (%s, 0)
+                ON DUPLICATE KEY UPDATE category_id = category_id
+            """
+            await cur.execute(sql, (album_id,))
+            await conn.commit()
+            await cur.execute("SELECT last_image_id FROM autotag_backlog WHERE category_id = %s", (album_id,))
+            return (await cur.fetchone())["last_image_id"]
+
+    @classmethod
+    async def _count_remaining(cls, key: int, last_image_id: int) -> int:
+        pcfg = ProgramConfig.get()
+        async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.pwgo_db_name) as (cur,_):
+            sql = """
+                SELECT COUNT(*) AS cnt
+                FROM image_category
+                WHERE category_id = %s AND image_id > %s
+            """
+            await cur.execute(sql, (key, last_image_id))
+            return (await cur.fetchone())["cnt"]
+
+    @classmethod
+    async def _get_page(cls, key: int, last_image_id: int, page_size: int) -> list[PiwigoImage]:
+        pcfg = ProgramConfig.get()
+        async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.pwgo_db_name) as (cur,_):
+            sql = """
+                SELECT i.id, i.file, i.path, i.width, i.height, i.rotation, i.md5sum, i.date_creation
+                FROM images i
+                JOIN image_category ic
+                ON ic.image_id = i.id
+                WHERE ic.category_id = %s AND i.id > %s
+                ORDER BY i.id
+                LIMIT %s
+            """
+            await cur.execute(sql, (key, last_image_id, page_size))
+            return [PiwigoImage(**row) for row in await cur.fetchall()]
+
+    @classmethod
+    async def _checkpoint(cls, key: int, last_image_id: int) -> None:
+        pcfg = ProgramConfig.get()
+        async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.msg_db_name) as (cur,conn):
+            sql = """
+                UPDATE autotag_backlog
+                SET last_image_id = %s
+                WHERE category_id = %s
+            """
+            await cur.execute(sql, (last_image_id, key))
+            await conn.commit()
+
+    @classmethod
+    async def _clear_checkpoint(cls, album_id: int) -> None:
+        pcfg = ProgramConfig.get()
+        async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.msg_db_name) as (cur,conn):
+            await cur.execute("DELETE FROM autotag_backlog WHERE category_id = %s", (album_id,))
+            await conn.commit()
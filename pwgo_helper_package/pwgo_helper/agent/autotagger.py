@@ -1,24 +1,30 @@
 """container module for AutoTagger class"""
 from __future__ import annotations
 
-import json, asyncio
+import json, asyncio, hashlib
+from time import monotonic
 from typing import List, Dict, Optional
 from contextlib import asynccontextmanager, AsyncExitStack
 
-from py_linq import Enumerable
 
 from . import strings
 from ..config import Configuration as ProgramConfig
 from .config import Configuration as AgentConfig
 from ..db_connection_pool import DbConnectionPool
-from .pwgo_image import PiwigoImage
+from .pwgo_image import PiwigoImage, ScaledImage
 from .rekognition import RekognitionClient
+from .burst_index import BurstIndex
+from .face_prefilter import FacePrefilter
 from . import utilities
 
 class AutoTagger():
     """Manages the autotagging process for a given PiwigoImage. Provides static methods that
     are involved with initializing/resyncing the autotagging functionality"""
     EXT_REFS_SEP = ":"
+    TEMP_EXT_ID_PREFIX = "autotag"
+    _last_deep_sync: Optional[float] = None
+    # external image ids of the temporary faces of matches in progress
+    _temp_external_ids: set[str] = set()
 
     @staticmethod
     def get_logger():
@@ -30,6 +36,7 @@ class AutoTagger():
         self.image: PiwigoImage = img
         self._rek_client = None
         self._exit_stack = stack
+        self._scaled_image_fut: Optional[asyncio.Future] = None
 
     @staticmethod
     @asynccontextmanager
@@ -64,19 +71,93 @@ class AutoTagger():
             self.logger.warning("image_id %s already exists in the processed auto-tag album. skipping autotagging."
                 , self.image.id)
             await self._move_image_to_processed(True)
+        else:
+            phash = None
+            source_id = None
+            if BurstIndex.is_enabled():
+                scaled_img = await self._get_scaled_image()
+                phash = BurstIndex.get_phash(scaled_img.pixels)
+                source_id = await BurstIndex.claim(self.image, phash)
+
+            tagged = False
+            try:
+                if source_id is None:
+                    tags = await self._get_rekognition_tags()
+                else:
+                    tags = await self._get_burst_tags(source_id)
+                for tag in tags:
+                    if not isinstance(tag, int):
+                        raise TypeError()
+                await asyncio.gather(self.add_tags(tags), self._move_image_to_processed())
+                tagged = True
+            finally:
+                if phash is not None:
+                    await BurstIndex.release(self.image, phash, tagged)
+
+    async def _get_rekognition_tags(self) -> set[int]:
+        """gets the tags for the faces and labels rekognition finds in the image"""
+        tag_coros = []
+        if AgentConfig.get().face_match_mode == "index" and not await self._has_processed_faces():
+            tag_coros.append(self._get_tags_for_indexed_faces())
         else:
             face_images = await self._get_face_image_files()
-            tag_coros = []
             for img, index in face_images:
                 tag_coros.append(self._get_tags_for_face_image(img, index))
 
-            tag_coros.append(self._get_label_tags())
-            results = await asyncio.gather(*tag_coros)
-            tags = set().union(*results)
-            for tag in tags:
-                if not isinstance(tag, int):
-                    raise TypeError()
-            await asyncio.gather(self.add_tags(tags), self._move_image_to_processed())
+        tag_coros.append(self._get_label_tags())
+        results = await asyncio.gather(*tag_coros)
+        return set().union(*results)
+
+    async def _get_burst_tags(self, source_id: int) -> set[int]:
+        """copies the detected faces and labels of the burst source image to the current
+        image and gets the tags they resolve to without calling rekognition"""
+        pcfg = ProgramConfig.get()
+        async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.rek_db_name) as (cur,conn):
+            if not pcfg.dry_run:
+                sql = """
+                    INSERT INTO processed_faces (piwigo_image_id, face_index, face_details, matched_to_face_id)
+                    SELECT %s, face_index, face_details, matched_to_face_id
+                    FROM processed_faces
+                    WHERE piwigo_image_id = %s
+                    ON DUPLICATE KEY UPDATE face_details = VALUES(face_details)
+                        , matched_to_face_id = VALUES(matched_to_face_id)
+                """
+                await cur.execute(sql, (self.image.id, source_id))
+                sql = """
+                    INSERT INTO image_labels (piwigo_image_id, label, confidence, parents)
+                    SELECT %s, label, confidence, parents
+                    FROM image_labels
+                    WHERE piwigo_image_id = %s
+                    ON DUPLICATE KEY UPDATE confidence = VALUES(confidence), parents = VALUES(parents)
+                """
+                await cur.execute(sql, (self.image.id, source_id))
+                await conn.commit()
+
+            sql = """
+                SELECT f.piwigo_category_id, f.piwigo_image_id
+                FROM processed_faces pf
+                JOIN indexed_faces f
+                ON f.face_id = pf.matched_to_face_id
+                WHERE pf.piwigo_image_id = %s
+            """
+            await cur.execute(sql, (source_id))
+            matched_faces = [
+                {"ExternalImageId": f"{row['piwigo_category_id']}{AutoTagger.EXT_REFS_SEP}{row['piwigo_image_id']}"}
+                for row in await cur.fetchall()
+            ]
+            sql = """
+                SELECT label
+                FROM image_labels
+                WHERE piwigo_image_id = %s AND confidence >= %s
+            """
+            await cur.execute(sql, (source_id, AgentConfig.get().min_tag_confidence))
+            labels = [row["label"] for row in await cur.fetchall()]
+
+        results = await asyncio.gather(
+            *[AutoTagger._get_tags_for_match(face) for face in matched_faces],
+            AutoTagger._get_tag_ids_for_labels(labels)
+        )
+        return set().union(*results)
 
     async def add_implicit_tags(self) -> None:
         """adds any tags that should be added based on implicit tag configuration."""
@@ -130,6 +211,53 @@ class AutoTagger():
 
                     await conn.commit()
 
+    async def _get_scaled_image(self) -> ScaledImage:
+        """decodes the image the first time it's needed. the result is shared by every
+        rekognition call and face crop made by this autotagger"""
+        if not self._scaled_image_fut:
+            loop = asyncio.get_running_loop()
+            self._scaled_image_fut = loop.run_in_executor(None, self.image.load_scaled)
+        return await self._scaled_image_fut
+
+    async def _get_content_hash(self) -> str:
+        """gets the hash rekognition responses are cached under. piwigo's md5sum of the
+        file is used when it's known, otherwise the md5 of the scaled image payload"""
+        if self.image.md5sum:
+            return self.image.md5sum
+        scaled_img = await self._get_scaled_image()
+        return hashlib.md5(scaled_img.payload).hexdigest()
+
+    async def _get_cached_response(self, operation: str) -> Optional[List[Dict]]:
+        """gets an earlier rekognition response for an image with the same content, which
+        may have been stored under a different piwigo image id"""
+        pcfg = ProgramConfig.get()
+        content_hash = await self._get_content_hash()
+        async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.rek_db_name) as (cur,_):
+            sql = f"""
+                SELECT response
+                FROM `{pcfg.rek_db_name}`.rekognition_responses
+                WHERE content_hash = %s AND operation = %s
+            """
+            await cur.execute(sql, (content_hash, operation))
+            result = await cur.fetchone()
+
+        if not result:
+            return None
+        self.logger.debug("reusing cached %s response for %s", operation, self.image.file)
+        return json.loads(result["response"])
+
+    async def _cache_response(self, operation: str, response: List[Dict]) -> None:
+        pcfg = ProgramConfig.get()
+        content_hash = await self._get_content_hash()
+        async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.rek_db_name) as (cur,conn):
+            sql = f"""
+                INSERT INTO `{pcfg.rek_db_name}`.rekognition_responses (content_hash, operation, response)
+                VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE response = VALUES(response)
+            """
+            await cur.execute(sql, (content_hash, operation, json.dumps(response)))
+            await conn.commit()
+
     async def _get_rek_client(self) -> RekognitionClient:
         if not self._rek_client:
             self._rek_client = await self._exit_stack.enter_async_context(RekognitionClient())
@@ -141,12 +269,12 @@ class AutoTagger():
         pcfg = ProgramConfig.get()
 
         if not pcfg.dry_run:
-            with self.image.open_file() as img_file:
-                client = await self._get_rek_client()
-                faces = await client.index_faces_from_image(
-                    img_file,
-                    external_image_id = f"{index_cat_id}{AutoTagger.EXT_REFS_SEP}{self.image.id}"
-                )
+            scaled_img = await self._get_scaled_image()
+            client = await self._get_rek_client()
+            faces = await client.index_faces_from_image(
+                scaled_img.open(),
+                external_image_id = f"{index_cat_id}{AutoTagger.EXT_REFS_SEP}{self.image.id}"
+            )
 
             sql = """
                 INSERT INTO indexed_faces ( face_id, image_id, piwigo_image_id, piwigo_category_id, face_confidence, face_details )
@@ -168,6 +296,14 @@ class AutoTagger():
                         ))
 
                     await conn.commit()
+            else:
+                # remembered so the face index sync doesn't keep sending the image to rekognition
+                async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.rek_db_name) as (cur,conn):
+                    await cur.execute("""
+                        INSERT IGNORE INTO no_face_images ( piwigo_image_id, piwigo_category_id )
+                        VALUES ( %s, %s )
+                    """, (self.image.id, index_cat_id))
+                    await conn.commit()
 
     async def _get_face_image_files(self):
         """gets the location of faces detected in the image from Rekognition
@@ -189,36 +325,123 @@ class AutoTagger():
                 existing = len(face_details) > 0
 
                 if not existing:
-                    with self.image.open_file() as img_file:
+                    face_details = await self._get_cached_response("detect_faces")
+                    if face_details is None and not await self._probably_has_faces():
+                        face_details = []
+                    if face_details is None:
+                        scaled_img = await self._get_scaled_image()
                         client = await self._get_rek_client()
-                        face_details = await client.detect_faces(img_file)
+                        face_details = await client.detect_faces(scaled_img.open())
+                        await self._cache_response("detect_faces", face_details)
 
                 if face_details:
-                    with self.image.open_file() as img_file:
-                        if not existing:
-                            for index, detail in enumerate(face_details):
-                                detail["index"] = index
+                    if not existing:
+                        for index, detail in enumerate(face_details):
+                            detail["index"] = index
 
-                                sql = """
-                                    INSERT INTO processed_faces ( piwigo_image_id, face_index, face_details )
-                                    VALUES ( %s, %s, '%s' )
-                                """
+                            sql = """
+                                INSERT INTO processed_faces ( piwigo_image_id, face_index, face_details )
+                                VALUES ( %s, %s, '%s' )
+                            """
 
-                                await cur.execute(sql % (
-                                    self.image.id,
-                                    detail["index"],
-                                    json.dumps(detail)
-                                ))
+                            await cur.execute(sql % (
+                                self.image.id,
+                                detail["index"],
+                                json.dumps(detail)
+                            ))
+
+                        await conn.commit()
+
+                    # crops are taken from the scaled pixels rather than decoding the file again
+                    scaled_img = await self._get_scaled_image()
+                    results = [(scaled_img.crop(f["BoundingBox"]), f["index"]) for f in face_details]
+
+        return results
+
+    async def _probably_has_faces(self) -> bool:
+        """runs the local face prefilter, if enabled, to decide whether rekognition
+        should be asked to find faces in the image"""
+        if not FacePrefilter.is_enabled():
+            return True
+
+        scaled_img = await self._get_scaled_image()
+        loop = asyncio.get_running_loop()
+        if await loop.run_in_executor(None, FacePrefilter.has_faces, scaled_img.pixels, self.image.rotation):
+            return True
+        self.logger.debug("no faces found in %s by the prefilter. skipping face detection.", self.image.file)
+        return False
+
+    async def _has_processed_faces(self) -> bool:
+        pcfg = ProgramConfig.get()
+        async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.rek_db_name) as (cur,_):
+            sql = "SELECT 1 FROM processed_faces WHERE piwigo_image_id = %s LIMIT 1"
+            await cur.execute(sql, (self.image.id))
+            return await cur.fetchone() is not None
+
+    async def _get_tags_for_indexed_faces(self) -> set[int]:
+        matched_faces = await self._match_faces_by_index()
+        results = await asyncio.gather(*[AutoTagger._get_tags_for_match(f) for f in matched_faces])
+        return set().union(*results)
+
+    async def _match_faces_by_index(self) -> List[Dict]:
+        """adds the faces in the image to the face index under a temporary external image id
+        and searches the index by the id of each of them. this uploads the image once however
+        many faces it has. the temporary faces are removed before returning and the faces are
+        recorded in processed_faces along with the face each was matched to"""
+        self.logger.debug(strings.LOG_DETECT_IMG_FACES(self.image.file))
+        pcfg = ProgramConfig.get()
+        if pcfg.dry_run:
+            return []
+
+        if not await self._probably_has_faces():
+            return []
+
+        client = await self._get_rek_client()
+        scaled_img = await self._get_scaled_image()
+        temp_id = f"{AutoTagger.TEMP_EXT_ID_PREFIX}{AutoTagger.EXT_REFS_SEP}{self.image.id}"
+        AutoTagger._temp_external_ids.add(temp_id)
+        try:
+            face_records = await client.index_faces_from_image(scaled_img.open(), external_image_id=temp_id)
+            try:
+                max_faces = AgentConfig.get().face_match_max_faces
+                searches = await asyncio.gather(*[client.search_faces(r["Face"]["FaceId"], max_faces)
+                    for r in face_records])
+            finally:
+                await client.remove_indexed_faces([r["Face"]["FaceId"] for r in face_records])
+        finally:
+            AutoTagger._temp_external_ids.discard(temp_id)
+
+        results = []
+        async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.rek_db_name) as (cur,conn):
+            for index, (frec, face_matches) in enumerate(zip(face_records, searches)):
+                # temporary faces of images being tagged at the same time aren't real matches
+                matched_face = next((m["Face"] for m in face_matches if not AutoTagger.is_temp_face(m["Face"])), None)
+                detail = frec["FaceDetail"]
+                detail["index"] = index
 
-                            await conn.commit()
+                sql = """
+                    INSERT INTO processed_faces ( piwigo_image_id, face_index, face_details, matched_to_face_id )
+                    VALUES ( %s, %s, %s, %s )
+                """
 
-                        img_file.seek(0)
-                        results = [
-                            (utilities.get_cropped_image(img_file, f["BoundingBox"]), f["index"]) for f in face_details
-                        ]
+                await cur.execute(sql, (
+                    self.image.id,
+                    index,
+                    json.dumps(detail),
+                    matched_face["FaceId"] if matched_face else None
+                ))
+                if matched_face:
+                    results.append(matched_face)
+
+            await conn.commit()
 
         return results
 
+    @staticmethod
+    def is_temp_face(face: Dict) -> bool:
+        """is the face one that was temporarily indexed to match the faces of an image"""
+        return face["ExternalImageId"].split(AutoTagger.EXT_REFS_SEP)[0] == AutoTagger.TEMP_EXT_ID_PREFIX
+
     async def _get_tags_for_face_image(self, img, index: int) -> List[int]:
         matched_face = await self._get_matched_face(img, index)
         tags = []
@@ -233,7 +456,9 @@ class AutoTagger():
         result = None
         if not pcfg.dry_run:
             client = await self._get_rek_client()
-            result = await client.match_face_from_image(img)
+            # temporary faces of images being tagged at the same time aren't real matches
+            result = await client.match_face_from_image(img, AgentConfig.get().face_match_max_faces
+                , exclude=AutoTagger.is_temp_face)
 
         if result and "Face" in result:
             async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.rek_db_name) as (cur,conn):
@@ -274,9 +499,12 @@ class AutoTagger():
                 existing = len(existing_labels) > 0
 
                 if not existing:
-                    with self.image.open_file() as img_file:
+                    labels = await self._get_cached_response("detect_labels")
+                    if labels is None:
+                        scaled_img = await self._get_scaled_image()
                         client = await self._get_rek_client()
-                        labels = await client.detect_labels(img_file)
+                        labels = await client.detect_labels(scaled_img.open())
+                        await self._cache_response("detect_labels", labels)
 
                     if labels:
                         sql = """
@@ -345,86 +573,203 @@ class AutoTagger():
         return faces
 
     @classmethod
-    async def sync_face_index(cls):
+    async def sync_face_index(cls, deep: Optional[bool] = None):
         """Adds and/or removes images from the Rekognition face index as neccessary to sync it
-        up with the Piwigo face index album"""
-        cls.get_logger().info("beginning face index sync")
-        cls.get_logger().debug("getting list of currently indexed images")
-        existing = {}
+        up with the Piwigo face index album. The faces recorded in the indexed_faces table are
+        compared with the face index albums in sql so a routine sync makes no rekognition calls.
+        Album images where no face was found are recorded in the no_face_images table and are
+        only sent again once they have left and rejoined the face index albums. A deep sync first
+        reconciles the indexed_faces table with the Rekognition collection. When deep isn't given
+        a deep sync is done if one is due"""
+        logger = cls.get_logger()
+        logger.info("beginning face index sync")
+        if deep is None:
+            deep = cls._is_deep_sync_due()
+        if deep:
+            await cls._reconcile_face_collection()
+            cls._last_deep_sync = monotonic()
+
         pcfg = ProgramConfig.get()
-        if not pcfg.dry_run:
-            async with RekognitionClient() as rek_client:
-                for face in await rek_client.get_indexed_faces():
-                    pwgo_image_id = face["ExternalImageId"].split(AutoTagger.EXT_REFS_SEP)[1]
-                    if pwgo_image_id in existing:
-                        existing[pwgo_image_id].append(face["FaceId"])
-                    else:
-                        existing[pwgo_image_id] = [face["FaceId"]]
-
-        cls.get_logger().info("pulling the expected face index collection from db")
-        async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.pwgo_db_name) as (cur,_):
-            sql = f"""
-                SELECT i.id image_id
-                    , c.id category_id
-                    , i.file
-                    , i.`path`
-                FROM `{pcfg.pwgo_db_name}`.images i
-                JOIN `{pcfg.pwgo_db_name}`.image_category ic
-                ON ic.image_id = i.id
-                JOIN `{pcfg.pwgo_db_name}`.categories c
-                ON c.id = ic.category_id
-                WHERE c.id IN (%s)
-            """
-            format_strings = ','.join(['%s'] * len(AgentConfig.get().face_idx_albs))
-
-            await cur.execute(sql % format_strings, tuple(AgentConfig.get().face_idx_albs))
-            wanted = []
-            for row in await cur.fetchall():
-                wanted.append({
-                    "img": PiwigoImage(id=row["image_id"],file=row["file"],path=row["path"]),
-                    "cat_id": row["category_id"]
-                })
-
-        remove_keys = Enumerable(existing.keys()) \
-                .except_(Enumerable(wanted).select(func=lambda i: str(i["img"].id))) \
-                .to_list()
-        # the irony of an impossible to comprehend list comprehension
-        # I apologize for potentially inflicting this on my future self, but it's a gd work of art
-        remove_face_ids = [id for sub in [v for k, v in existing.items() if k in remove_keys] for id in sub]
+        face_idx_albs = tuple(AgentConfig.get().face_idx_albs)
+        format_strings = ','.join(['%s'] * len(face_idx_albs)) or "NULL"
+        logger.debug("getting indexed faces that are no longer in a face index album")
+        sql = f"""
+            SELECT f.face_id
+            FROM `{pcfg.rek_db_name}`.indexed_faces f
+            WHERE NOT EXISTS (
+                SELECT 1
+                FROM `{pcfg.pwgo_db_name}`.image_category ic
+                WHERE ic.image_id = f.piwigo_image_id
+                    AND ic.category_id IN ({format_strings})
+            )
+        """
+        async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.rek_db_name) as (cur,_):
+            await cur.execute(sql, face_idx_albs)
+            remove_face_ids = [row["face_id"] for row in await cur.fetchall()]
 
         if remove_face_ids:
             await AutoTagger.remove_indexed_faces(remove_face_ids)
 
-        add = Enumerable(wanted) \
-            .where(lambda i: str(i["img"].id) not in existing) \
-            .to_list()
+        if not pcfg.dry_run:
+            logger.debug("forgetting images without faces that are no longer in a face index album")
+            async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.rek_db_name) as (cur,conn):
+                await cur.execute(f"""
+                    DELETE FROM `{pcfg.rek_db_name}`.no_face_images
+                    WHERE NOT EXISTS (
+                        SELECT 1
+                        FROM `{pcfg.pwgo_db_name}`.image_category ic
+                        WHERE ic.image_id = no_face_images.piwigo_image_id
+                            AND ic.category_id IN ({format_strings})
+                    )
+                """, face_idx_albs)
+                await conn.commit()
+
+        logger.debug("getting face index album images that aren't indexed")
+        sql = f"""
+            SELECT i.id image_id
+                , MIN(ic.category_id) category_id
+                , i.file
+                , i.`path`
+            FROM `{pcfg.pwgo_db_name}`.images i
+            JOIN `{pcfg.pwgo_db_name}`.image_category ic
+            ON ic.image_id = i.id
+            WHERE ic.category_id IN ({format_strings})
+                AND NOT EXISTS (
+                    SELECT 1
+                    FROM `{pcfg.rek_db_name}`.indexed_faces f
+                    WHERE f.piwigo_image_id = i.id
+                )
+                AND NOT EXISTS (
+                    SELECT 1
+                    FROM `{pcfg.rek_db_name}`.no_face_images nf
+                    WHERE nf.piwigo_image_id = i.id
+                )
+            GROUP BY i.id, i.file, i.`path`
+        """
+        rows = DbConnectionPool.get().stream_dict_rows(sql, face_idx_albs, db=pcfg.pwgo_db_name)
+        add = [{
+            "img": PiwigoImage(id=row["image_id"],file=row["file"],path=row["path"]),
+            "cat_id": row["category_id"]
+        } async for row in rows]
+
         for rec in add:
             async with AutoTagger.create(rec["img"]) as tagger:
                 await tagger.add_indexed_image(rec["cat_id"])
 
-        cls.get_logger().info("finished face index sync")
+        logger.info("finished face index sync")
+
+    @classmethod
+    def _is_deep_sync_due(cls) -> bool:
+        acfg = AgentConfig.get()
+        if cls._last_deep_sync is None:
+            # the interval starts with the first sync unless a deep sync at startup was asked for
+            cls._last_deep_sync = monotonic()
+            return acfg.face_index_deep_sync
+        return monotonic() - cls._last_deep_sync >= acfg.face_index_deep_sync_hours * 3600
+
+    @classmethod
+    async def _reconcile_face_collection(cls) -> None:
+        """removes faces from the Rekognition collection that aren't recorded in the indexed_faces
+        table and drops indexed_faces records whose face is no longer in the collection so the
+        image gets indexed again"""
+        pcfg = ProgramConfig.get()
+        if pcfg.dry_run:
+            return
+
+        cls.get_logger().info("reconciling indexed faces with the rekognition face collection")
+        async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.rek_db_name) as (cur,_):
+            await cur.execute("SELECT face_id FROM indexed_faces")
+            missing_face_ids = {row["face_id"] for row in await cur.fetchall()}
+
+        orphan_face_ids = []
+        async with RekognitionClient() as rek_client:
+            async for face in rek_client.get_indexed_faces():
+                if face["FaceId"] in missing_face_ids:
+                    missing_face_ids.discard(face["FaceId"])
+                elif face["ExternalImageId"] not in cls._temp_external_ids:
+                    # includes temporary faces left behind by an interrupted index mode match
+                    orphan_face_ids.append(face["FaceId"])
+
+        if missing_face_ids:
+            cls.get_logger().info("%s indexed faces are missing from the face collection", len(missing_face_ids))
+            async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.rek_db_name) as (cur,conn):
+                format_strings = ','.join(['%s'] * len(missing_face_ids))
+                await cur.execute(f"DELETE FROM indexed_faces WHERE face_id IN ({format_strings})"
+                    , tuple(missing_face_ids))
+                await conn.commit()
+
+        if orphan_face_ids:
+            await AutoTagger.remove_indexed_faces(orphan_face_ids)
 
     @classmethod
     async def process_new_tag(cls, tag_id: int) -> None:
         """Checks if the new tag associated with the given id should be added to any
         previously autotagged images"""
         cls.get_logger().debug("checking if new tag needs to be applied to any existing autotagged images")
+        await cls.apply_label_tags(tag_id)
+
+    @classmethod
+    async def apply_label_tags(cls, tag_id: Optional[int] = None) -> int:
+        """Applies tags to previously autotagged images that have a detected label matching the
+        tag name. This is done server side in chunks of image ids so that a tag that matches a
+        very common label doesn't require a lookup and insert per image. If no tag_id is given
+        all tags are considered. Returns the number of image tags that were added."""
+        logger = cls.get_logger()
         pcfg = ProgramConfig.get()
+        acfg = AgentConfig.get()
+        match_sql = f"""
+            FROM `{pcfg.rek_db_name}`.image_labels il
+            JOIN `{pcfg.pwgo_db_name}`.tags t
+            ON t.name = il.label
+            JOIN `{pcfg.pwgo_db_name}`.images i
+            ON i.id = il.piwigo_image_id
+            LEFT JOIN `{pcfg.pwgo_db_name}`.image_tag it
+            ON it.image_id = il.piwigo_image_id
+                AND it.tag_id = t.id
+            WHERE il.confidence >= %s
+                AND it.image_id IS NULL
+        """
+        match_params = (acfg.min_tag_confidence,)
+        if tag_id is not None:
+            match_sql += " AND t.id = %s"
+            match_params += (tag_id,)
+
+        async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.pwgo_db_name) as (cur,conn):
+            sql = f"""
+                SELECT MIN(il.piwigo_image_id) AS min_id
+                    , MAX(il.piwigo_image_id) AS max_id
+                    , COUNT(*) AS cnt
+                {match_sql}
+            """
+            await cur.execute(sql, match_params)
+            bounds = await cur.fetchone()
+            if not bounds or not bounds["cnt"]:
+                logger.debug("no label tags need to be applied to existing autotagged images")
+                return 0
+
+            logger.info(strings.LOG_APPLY_LABEL_TAGS(bounds["cnt"]))
+            if pcfg.dry_run:
+                return 0
 
-        async with AsyncExitStack() as stack:
-            db_cn_ctx = DbConnectionPool.get()
-            cur,_ = await stack.enter_async_context(db_cn_ctx.acquire_dict_cursor(db=pcfg.rek_db_name))
             sql = f"""
-                SELECT il.piwigo_image_id
-                FROM image_labels il
-                JOIN `{pcfg.pwgo_db_name}`.tags t
-                ON t.name = il.label
-                WHERE t.id = %s AND il.confidence >= %s
+                INSERT INTO `{pcfg.pwgo_db_name}`.image_tag (image_id, tag_id)
+                SELECT il.piwigo_image_id, t.id
+                {match_sql}
+                    AND il.piwigo_image_id BETWEEN %s AND %s
+                ON DUPLICATE KEY UPDATE tag_id = image_tag.tag_id
             """
-            await cur.execute(sql, (tag_id, AgentConfig.get().min_tag_confidence))
-            for img in await cur.fetchall():
-                tagger = await stack.enter_async_context(AutoTagger.create(img["piwigo_image_id"]))
-                await tagger.add_tags([tag_id])
+            added = 0
+            chunk_start = bounds["min_id"]
+            while chunk_start <= bounds["max_id"]:
+                chunk_end = chunk_start + acfg.label_tag_chunk_size - 1
+                await cur.execute(sql, match_params + (chunk_start, chunk_end))
+                await conn.commit()
+                added += cur.rowcount
+                logger.info("applied %s of %s label tags (through image id %s)"
+                    , added, bounds["cnt"], min(chunk_end, bounds["max_id"]))
+                chunk_start = chunk_end + 1
+
+        return added
 
     @classmethod
     async def _get_tags_for_match(cls, face: Dict) -> List[int]:
@@ -433,6 +778,9 @@ class AutoTagger():
         2) find json object(s) in description
         3) look for a "tags" array in json object
         """
+        if AutoTagger.is_temp_face(face):
+            # a temporary face has no album to take tags from
+            return []
         refs = face["ExternalImageId"].split(AutoTagger.EXT_REFS_SEP)
         tags = set()
 
@@ -0,0 +1,175 @@
+"""container module for BurstIndex"""
+from __future__ import annotations
+
+import asyncio
+from typing import Optional, Any
+
+try:
+    import imagehash
+except ImportError:
+    imagehash = None
+from PIL import Image
+
+from ..config import Configuration as ProgramConfig
+from .config import Configuration as AgentConfig
+from ..db_connection_pool import DbConnectionPool
+from .pwgo_image import PiwigoImage
+
+class BKTree():
+    """Burkhard-Keller tree of integer hashes keyed by hamming distance. Finds every
+    hash within a given distance of a query without comparing against all of them"""
+    def __init__(self):
+        self._root = None
+
+    @staticmethod
+    def distance(hash_a: int, hash_b: int) -> int:
+        """hamming distance between two hashes"""
+        return bin(hash_a ^ hash_b).count("1")
+
+    def add(self, hash_val: int, item: Any) -> None:
+        """adds an item under the given hash"""
+        if self._root is None:
+            self._root = (hash_val, [item], {})
+            return
+
+        node = self._root
+        while True:
+            dist = BKTree.distance(hash_val, node[0])
+            if dist == 0:
+                node[1].append(item)
+                return
+            if dist not in node[2]:
+                node[2][dist] = (hash_val, [item], {})
+                return
+            node = node[2][dist]
+
+    def remove(self, hash_val: int, item: Any) -> None:
+        """removes an item that was added under the given hash"""
+        node = self._root
+        while node:
+            dist = BKTree.distance(hash_val, node[0])
+            if dist == 0:
+                if item in node[1]:
+                    node[1].remove(item)
+                return
+            node = node[2].get(dist)
+
+    def search(self, hash_val: int, max_distance: int) -> list[tuple[int, Any]]:
+        """gets (distance, item) pairs for every item within max_distance of the hash"""
+        results = []
+        pending = [self._root] if self._root else []
+        while pending:
+            node = pending.pop()
+            dist = BKTree.distance(hash_val, node[0])
+            if dist <= max_distance:
+                # nodes are never unlinked, so a node may be left without items
+                results.extend((dist, item) for item in node[1])
+            # by the triangle inequality only these children can hold matches
+            pending.extend(child for child_dist, child in node[2].items()
+                if dist - max_distance <= child_dist <= dist + max_distance)
+        return results
+
+class BurstIndex():
+    """Perceptual hash index of autotagged images used to recognize bursts of nearly
+    identical shots. The hashes are stored in the image_phashes table and held in a
+    BKTree once loaded. An image matches an earlier one when their hashes are within
+    burst_max_distance of each other and they were taken within burst_max_secs"""
+    _tree: Optional[BKTree] = None
+    _load_lock: Optional[asyncio.Lock] = None
+    # images that are being tagged, resolved with whether the tagging succeeded
+    _pending: dict[int, asyncio.Future] = {}
+
+    @staticmethod
+    def get_logger():
+        """gets a logger..."""
+        return ProgramConfig.get().get_logger(__name__)
+
+    @staticmethod
+    def is_enabled() -> bool:
+        """is burst detection turned on and available"""
+        if not AgentConfig.get().burst_detection:
+            return False
+        if imagehash is None:
+            BurstIndex.get_logger().warning("burst detection requires the imagehash package. skipping.")
+            AgentConfig.get().burst_detection = False
+            return False
+        return True
+
+    @staticmethod
+    def get_phash(pixels: Image.Image) -> int:
+        """computes the 64 bit perceptual hash of an image"""
+        return int(str(imagehash.phash(pixels)), 16)
+
+    @classmethod
+    async def claim(cls, img: PiwigoImage, phash: int) -> Optional[int]:
+        """finds the already tagged image that the image is a burst shot of and returns its
+        id. if the match is still being tagged this waits for it to finish. when there's no
+        match the image is added to the index as in progress so later shots of the same
+        burst wait for it rather than going to rekognition as well"""
+        tree = await cls._get_tree()
+        source_id = cls._find_source(tree, img, phash)
+        if source_id is not None and source_id in cls._pending:
+            cls.get_logger().debug("waiting for burst source image %s to be tagged", source_id)
+            if not await asyncio.shield(cls._pending[source_id]):
+                source_id = None
+        if source_id is None:
+            cls._pending[img.id] = asyncio.get_running_loop().create_future()
+            tree.add(phash, (img.id, img.date_creation))
+        else:
+            cls.get_logger().info("%s is a burst shot of image %s", img.file, source_id)
+        return source_id
+
+    @classmethod
+    async def release(cls, img: PiwigoImage, phash: int, tagged: bool) -> None:
+        """records the outcome of tagging an image. tagged images are kept in the index
+        and the image_phashes table. an image that failed is taken back out"""
+        pcfg = ProgramConfig.get()
+        tree = await cls._get_tree()
+        pending = cls._pending.pop(img.id, None)
+        if pending:
+            pending.set_result(tagged)
+        if not tagged:
+            if pending:
+                tree.remove(phash, (img.id, img.date_creation))
+            return
+
+        if not pending:
+            tree.add(phash, (img.id, img.date_creation))
+        if not pcfg.dry_run:
+            async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.rek_db_name) as (cur,conn):
+                sql = """
+                    INSERT INTO image_phashes (piwigo_image_id, phash, date_creation)
+                    VALUES (%s, %s, %s)
+                    ON DUPLICATE KEY UPDATE phash = VALUES(phash), date_creation = VALUES(date_creation)
+                """
+                await cur.execute(sql, (img.id, f"{phash:016x}", img.date_creation))
+                await conn.commit()
+
+    @staticmethod
+    def _find_source(tree: BKTree, img: PiwigoImage, phash: int) -> Optional[int]:
+        if not img.date_creation:
+            return None
+
+        acfg = AgentConfig.get()
+        matches = [
+            (dist, abs((taken - img.date_creation).total_seconds()), image_id)
+            for dist, (image_id, taken) in tree.search(phash, acfg.burst_max_distance)
+            if image_id != img.id and taken
+                and abs((taken - img.date_creation).total_seconds()) <= acfg.burst_max_secs
+        ]
+        return min(matches)[2] if matches else None
+
+    @classmethod
+    async def _get_tree(cls) -> BKTree:
+        if cls._load_lock is None:
+            cls._load_lock = asyncio.Lock()
+        async with cls._load_lock:
+            if cls._tree is None:
+                pcfg = ProgramConfig.get()
+                tree = BKTree()
+                rows = DbConnectionPool.get().stream_dict_rows(
+                    "SELECT piwigo_image_id, phash, date_creation FROM image_phashes", None, db=pcfg.rek_db_name)
+                async for row in rows:
+                    tree.add(int(row["phash"], 16), (row["piwigo_image_id"], row["date_creation"]))
+                cls._tree = tree
+        return cls._tree
@@ -21,11 +21,38 @@ class Configuration():
         self.img_tag_wait_secs = 1
         self.stop_timeout = 10
         self.scaled_img_max_size = (1024,1024)
+        self.rek_max_pool_connections = 32
+        self.rek_list_faces_page_size = 1000
+        # temporary faces of images matched at the same time can outrank the real matches
+        self.face_match_max_faces = 10
+        self.face_index_deep_sync_hours = 24
+        self.label_tag_chunk_size = 5000
+        self.burst_max_distance = 8
+        self.burst_max_secs = 10
+        self.face_prefilter_min_size = 0.04
+        self.metadata_rewrite_workers = 4
+        self.metadata_rewrite_page_size = 200
+        self.autotag_backlog_workers = 4
+        self.autotag_backlog_page_size = 100
+        self.virtualfs_staging_prefix = ".pwgo-vfs-"
+        self.virtualfs_rebuild_workers = 16
+        self.virtualfs_link_chunk_size = 500
+        self.virtualfs_source_listing_min = 8
+        self.virtualfs_event_wait_secs = 1
+        self.virtualfs_event_batch_size = 5000
+        self.virtualfs_tags_dir = "tags"
+        self.virtualfs_dates_dir = "dates"
 
         # set by initialization
         self.piwigo_galleries_host_path = None
+        self.piwigo_data_host_path = None
         self.rek_cfg = None
         self.image_crop_save_path = None
+        self.burst_detection = False
+        self.face_match_mode = "crop"
+        self.face_index_deep_sync = False
+        self.face_prefilter = False
+        self.face_prefilter_min_neighbors = 3
         self.virtualfs_root = None
         self.virtualfs_allow_broken_links = True
         self.debug = False
@@ -34,6 +61,10 @@ class Configuration():
         self.virtualfs_remove_empty_dirs = True
         self.initialization_args = None
         self.virtualfs_category_id = 0
+        self.virtualfs_rebuild_mode = "reconcile"
+        self.virtualfs_staging_path = None
+        self.virtualfs_link_type = "symlink"
+        self.virtualfs_views = ()
 
     @staticmethod
     def get() -> Configuration:
@@ -66,6 +97,19 @@ class Configuration():
         Configuration.instance = cfg
         return cfg
 
+    @staticmethod
+    def initialize_virtualfs(**kwargs) -> Configuration:
+        """Initializes only the configuration values used to work with the virtualfs and image
+        files. Used by commands that manage the virtualfs or images without running the agent"""
+        cfg = Configuration()
+        cfg.initialization_args = kwargs
+        for key, val in kwargs.items():
+            if hasattr(cfg, key):
+                setattr(cfg, key, val)
+
+        Configuration.instance = cfg
+        return cfg
+
     async def _set_face_index_categories(self):
         pcfg = ProgramConfig.get()
         async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.pwgo_db_name) as (cur, _):
@@ -0,0 +1,176 @@
+"""container module for FacePrefilter"""
+from __future__ import annotations
+
+import asyncio, threading
+from time import perf_counter
+
+import click
+try:
+    import cv2
+    import numpy
+except ImportError:
+    cv2 = None
+from PIL import Image, ImageOps
+
+from ..config import Configuration as ProgramConfig
+from .config import Configuration as AgentConfig
+from ..db_connection_pool import DbConnectionPool as DbPool
+from .pwgo_image import PiwigoImage
+from ..asyncio import get_task
+
+# exif tag holding the orientation the camera was held in
+ORIENTATION_TAG = 0x0112
+
+class FacePrefilter():
+    """Local check for whether an image is likely to contain any faces. Uses the OpenCV
+    frontal and profile face haar cascades on the scaled image so images that clearly
+    don't have faces can skip the rekognition face calls. The cascades are tuned towards
+    finding every face at the cost of false positives since a missed face is a missed tag
+    while a false positive only costs the rekognition call that would have been made anyway"""
+    CASCADES = ["haarcascade_frontalface_default.xml", "haarcascade_profileface.xml"]
+    # cascade classifiers aren't safe to share between the executor threads
+    _local = threading.local()
+
+    @staticmethod
+    def get_logger():
+        """gets a logger..."""
+        return ProgramConfig.get().get_logger(__name__)
+
+    @staticmethod
+    def is_enabled() -> bool:
+        """is the face prefilter turned on and available"""
+        if not AgentConfig.get().face_prefilter:
+            return False
+        if cv2 is None:
+            FacePrefilter.get_logger().warning("the face prefilter requires the opencv package. skipping.")
+            AgentConfig.get().face_prefilter = False
+            return False
+        return True
+
+    @staticmethod
+    def upright(pixels: Image.Image, rotation: int=None) -> Image.Image:
+        """turns the pixels the right way up. the cascades only find upright faces and
+        portrait shots are usually stored sideways with an exif orientation. without an
+        exif orientation piwigo's rotation code (quarter turns counterclockwise) is used"""
+        orientation = pixels.getexif().get(ORIENTATION_TAG, 1)
+        if orientation != 1:
+            return ImageOps.exif_transpose(pixels)
+        if rotation:
+            return pixels.rotate(rotation * 90, expand=True)
+        return pixels
+
+    @classmethod
+    def has_faces(cls, pixels: Image.Image, rotation: int=None) -> bool:
+        """does the image probably contain at least one face"""
+        acfg = AgentConfig.get()
+        pixels = cls.upright(pixels, rotation)
+        gray = cv2.equalizeHist(numpy.asarray(pixels.convert("L")))
+        min_side = max(int(min(gray.shape) * acfg.face_prefilter_min_size), 20)
+        frontal, profile = cls._get_classifiers()
+        # the profile cascade only finds faces turned one way so it's run on the mirrored image too
+        for classifier, img in [(frontal, gray), (profile, gray), (profile, cv2.flip(gray, 1))]:
+            faces = classifier.detectMultiScale(img, scaleFactor=1.1
+                , minNeighbors=acfg.face_prefilter_min_neighbors, minSize=(min_side, min_side))
+            if len(faces):
+                return True
+        return False
+
+    @staticmethod
+    def score(results: list[tuple[bool, bool]]) -> dict[str, float]:
+        """summarizes (has faces, predicted has faces) pairs into the precision and recall of
+        the prefilter's face predictions and the share of images it would skip"""
+        tp = sum(1 for actual, predicted in results if actual and predicted)
+        fp = sum(1 for actual, predicted in results if not actual and predicted)
+        fn = sum(1 for actual, predicted in results if actual and not predicted)
+        return {
+            "images": len(results),
+            "precision": tp / (tp + fp) if tp + fp else 1.0,
+            "recall": tp / (tp + fn) if tp + fn else 1.0,
+            "skipped": sum(1 for _, predicted in results if not predicted) / len(results) if results else 0.0,
+            "missed": fn
+        }
+
+    @classmethod
+    async def benchmark(cls, limit: int=None, workers: int=4) -> dict[str, float]:
+        """runs the prefilter over the images already processed by the autotagger and scores
+        it against whether rekognition found faces in them"""
+        pcfg = ProgramConfig.get()
+        acfg = AgentConfig.get()
+        sql = f"""
+            SELECT i.id, i.file, i.path, i.width, i.height, i.rotation
+                , EXISTS (
+                    SELECT 1 FROM `{pcfg.rek_db_name}`.processed_faces pf WHERE pf.piwigo_image_id = i.id
+                ) AS has_faces
+            FROM `{pcfg.pwgo_db_name}`.images i
+            JOIN `{pcfg.pwgo_db_name}`.image_category ic
+            ON ic.image_id = i.id
+            WHERE ic.category_id = %s
+            ORDER BY i.id
+        """
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(workers)
+        def predict(img: PiwigoImage) -> bool:
+            return cls.has_faces(img.load_scaled().pixels, img.rotation)
+        async def run(row) -> tuple[bool, bool]:
+            has_faces = bool(row.pop("has_faces"))
+            async with semaphore:
+                return has_faces, await loop.run_in_executor(None, predict, PiwigoImage(**row))
+
+        beg = perf_counter()
+        rows = [row async for row in DbPool.get().stream_dict_rows(sql, (acfg.auto_tag_proc_alb), db=pcfg.pwgo_db_name)]
+        results = await asyncio.gather(*[run(row) for row in rows])
+        summary = cls.score(results)
+        summary["secs_per_image"] = (perf_counter() - beg) / len(results) if results else 0.0
+        return summary
+
+    @classmethod
+    def _get_classifiers(cls) -> list:
+        if not hasattr(cls._local, "classifiers"):
+            cls._local.classifiers = [cv2.CascadeClassifier(cv2.data.haarcascades + c) for c in cls.CASCADES]
+        return cls._local.classifiers
+
+@click.command("face-prefilter-benchmark")
+@click.option(
+    "--piwigo-galleries-host-path",
+    help="Host path of the piwigo galleries folder",
+    required=True, type=click.Path(exists=True,file_okay=False)
+)
+@click.option(
+    "--piwigo-data-host-path",
+    help="Host path of the piwigo _data folder. Derivatives are read in place of the originals when large enough",
+    type=click.Path(exists=True,file_okay=False)
+)
+@click.option(
+    "--face-prefilter-min-neighbors",
+    help="number of overlapping detections needed to count a face. lower values find more faces",
+    type=int, default=3
+)
+@click.option(
+    "--limit",
+    help="maximum number of processed images to check",
+    type=int
+)
+@click.option(
+    "--workers",
+    help="Number of images checked at once",
+    type=int, default=4
+)
+def face_prefilter_benchmark_entry(**kwargs):
+    """Scores the face prefilter against the images already processed by the autotagger"""
+    if cv2 is None:
+        raise click.ClickException("the face prefilter requires the opencv package")
+
+    async def exec_benchmark():
+        prg_cfg = ProgramConfig.get()
+        async with DbPool.initialize(**prg_cfg.db_config):
+            AgentConfig.initialize_virtualfs(**kwargs)
+            return await FacePrefilter.benchmark(kwargs["limit"], kwargs["workers"])
+
+    loop = asyncio.get_event_loop()
+    loop.set_task_factory(get_task)
+    summary = loop.run_until_complete(exec_benchmark())
+    for key, val in summary.items():
+        click.echo(f"{key}: {val:.3f}" if isinstance(val, float) else f"{key}: {val}")
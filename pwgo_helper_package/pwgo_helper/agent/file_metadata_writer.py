@@ -26,12 +26,23 @@ class FileMetadataWriter():
     def __exit__(self, exc_type, exc_value, exc_traceback):
         self._exit_stack.__exit__(exc_type, exc_value, exc_traceback)
 
-    def write(self) -> None:
-        """Writes image metadata from Piwigo database to file
+    def write(self, fields=None) -> None:
+        """Writes image metadata from Piwigo database to file. If a collection of metadata
+        field names is given, only those fields are written. The file is left untouched
+        if none of the values differ from what is already in the file.
         usage:
         with FileMetadataWriter(pwgo_img) as writer:
             writer.write()"""
+        iptc_dict = self.image.metadata.get_iptc_dict(fields)
+        current = self._img_data.read_iptc()
+        changes = { k: v for k, v in iptc_dict.items() if current.get(k) != v }
+        if not changes:
+            self._logger.debug("file metadata is already current. skipping write.")
+            return
+
         self._logger.debug("writing metadata to file")
-        self._img_data.modify_iptc(self.image.metadata.get_iptc_dict())
+        self._img_data.modify_iptc(changes)
         # pylint: disable=no-member
         self._img_file.write(self._img_data.get_bytes())
+        # removed fields can leave the file shorter than it was
+        self._img_file.truncate()
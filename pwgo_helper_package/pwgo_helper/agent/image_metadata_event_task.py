@@ -1,6 +1,7 @@
 """wrapper module for ImageTagEventTask"""
 from __future__ import annotations
 import asyncio
+from typing import Optional
 
 from py_linq import Enumerable
 
@@ -11,6 +12,7 @@ from .autotagger import AutoTagger
 from .pwgo_image import PiwigoImage
 from .file_metadata_writer import FileMetadataWriter
 from .database_event_row import ImageEventRow
+from .virtualfs_views import VirtualFsViews
 
 class ImageMetadataEventTask(EventTask):
     """Manages the handling of any routines that should run after an image
@@ -29,7 +31,11 @@ class ImageMetadataEventTask(EventTask):
             self._std_delay = AgentConfig.get().img_tag_wait_secs
         self._included_tags = {}
         self._included_cats = {}
-        self._write_metadata = False
+        self._metadata_fields = set()
+        # set when the image's dates view link needs to move. holds the dates it moves from
+        self._old_dates: Optional[list] = None
+        # set when the image may have moved in or out of the virtualfs root category
+        self._membership_changed = False
 
     @classmethod
     def get_pending_tasks(cls) -> list[ImageMetadataEventTask]:
@@ -95,6 +101,14 @@ class ImageMetadataEventTask(EventTask):
                 if not keep_task:
                     new_task.cancel()
 
+        if evt.table_name == "images" and evt.db_event_type == "DELETE":
+            # the image row is already gone so its view links are removed using the event values
+            deleted_fut = result_fut
+            async def remove_view_links():
+                await VirtualFsViews.remove_image_links(evt.image_id, evt.db_event_data.get("values", {}))
+                return await deleted_fut
+            result_fut = asyncio.ensure_future(remove_view_links())
+
         return result_fut
 
     def schedule_start(self) -> bool:
@@ -162,7 +176,7 @@ class ImageMetadataEventTask(EventTask):
         elif evt.table_name == "image_category":
             return self._add_category_event(evt.table_primary_key[1], evt.db_event_type)
         elif evt.table_name == "images":
-            return self._add_image_event()
+            return self._add_image_event(evt)
         else:
             raise RuntimeError(f"No event handler for table {evt.table_name}")
 
@@ -176,7 +190,6 @@ class ImageMetadataEventTask(EventTask):
         else:
             raise ValueError("unrecognized tag event operation")
 
-        self._write_metadata = True
         self._included_tags[tag_id] += increment
 
         return True
@@ -197,13 +210,39 @@ class ImageMetadataEventTask(EventTask):
 
             self._included_cats[category_id] += increment
 
+            return True
+        if VirtualFsViews.follows_membership():
+            # the view links follow the image in and out of the albums under the virtualfs root
+            self._membership_changed = True
             return True
         return False
 
-    def _add_image_event(self) -> bool:
-        self._write_metadata = True
+    def _add_image_event(self, evt: ImageEventRow) -> bool:
+        # date_creation is compared by the trigger but isn't written to the file
+        file_fields = ["name", "comment", "author"]
+        update_vals = evt.db_event_data.get("UPDATE")
+        if evt.db_event_type == "UPDATE" and update_vals:
+            before = update_vals.get("before", {})
+            after = update_vals.get("after", {})
+            changed = [f for f in file_fields if before.get(f) != after.get(f)]
+            if before.get("date_creation") != after.get("date_creation"):
+                self._old_dates = (self._old_dates or []) + [before.get("date_creation")]
+        else:
+            # without before/after values we can't tell what changed
+            changed = file_fields + ["tags"]
+            if evt.db_event_type == "INSERT":
+                self._old_dates = self._old_dates or []
+
+        self._metadata_fields.update(changed)
         return True
 
+    def _get_metadata_fields(self) -> set:
+        """gets the set of metadata fields that need to be written to the file"""
+        fields = set(self._metadata_fields)
+        if Enumerable(self._included_tags.values()).any(lambda x: x != 0):
+            fields.add("tags")
+        return fields
+
     def _schedule_action_task(self, _fut):
         self._action_task = asyncio.create_task(self._handle_events())
         self._action_task.set_name("exec_task")
@@ -220,10 +259,19 @@ class ImageMetadataEventTask(EventTask):
                     await tagger.add_implicit_tags()
                 if handle_cats:
                     await tagger.autotag_image()
-        if self._write_metadata:
+        if Enumerable(self._included_tags.values()).any(lambda x: x != 0):
+            await VirtualFsViews.apply_tag_changes(self.image_id, self._included_tags)
+        if self._old_dates is not None:
+            await VirtualFsViews.apply_date_change(self.image_id, self._old_dates)
+        if self._membership_changed:
+            await VirtualFsViews.apply_membership_change(self.image_id)
+        metadata_fields = self._get_metadata_fields()
+        if metadata_fields:
             pwgo_img = await PiwigoImage.create(self.image_id, load_metadata=True)
             if not ProgramConfig.get().dry_run:
                 with FileMetadataWriter(pwgo_img) as writer:
-                    await loop.run_in_executor(None,writer.write)
+                    await loop.run_in_executor(None,writer.write,metadata_fields)
+        else:
+            self._logger.debug("no file metadata changes for image %s", self.image_id)
         self.status = EventTaskStatus.DONE
         return True
@@ -1,6 +1,7 @@
 """wrapper module for ImageVirtualPathEventTask"""
 from __future__ import annotations
-import asyncio
+import asyncio, os, shutil, stat, tempfile, threading
+from typing import Optional
 
 from path import Path
 
@@ -8,19 +9,32 @@ from .database_event_row import ImageEventRow
 from .event_task import EventTask, EventTaskStatus
 from ..config import Configuration as ProgramConfig
 from .config import Configuration as AgentConfig
-from ..db_connection_pool import DbConnectionPool
+from .utilities import exchange_paths
+from .virtualfs_link_builder import VirtualFsLinkBuilder
+from .virtualfs_checker import VirtualFsChecker
+from .virtualfs_paths import VirtualFsPaths
+from .virtualfs_views import VirtualFsViews
 from . import strings
 
 class ImageVirtualPathEventTask(EventTask):
     """coordinates any tasks that should run when there is a new image virtual path
     in the piwigo database"""
     _pending_tasks: list[ImageVirtualPathEventTask] = []
+    # entry count of each virtualfs directory. seeded by the rebuild
+    _dir_counts: Optional[dict[str, int]] = None
+    _dir_counts_lock = threading.Lock()
 
-    def __init__(self, event):
+    def __init__(self, event=None, previous: ImageVirtualPathEventTask=None, **kwargs):
         super().__init__()
         self.logger = ImageVirtualPathEventTask.get_logger()
-        self.event = event
-        self._virt_path_task = None
+        self.events = [event] if event else []
+        self._previous = previous
+        self._sleep_futures = []
+        self._action_task = None
+        if "delay" in kwargs:
+            self._std_delay = kwargs["delay"]
+        else:
+            self._std_delay = AgentConfig.get().virtualfs_event_wait_secs
 
     @staticmethod
     def get_logger():
@@ -39,134 +53,327 @@ class ImageVirtualPathEventTask(EventTask):
 
     @classmethod
     def resolve_event_task(cls, evt: ImageEventRow) -> asyncio.Future:
-        """this class doesn't require any complex resolution logic so we
-        just create a new instance and set it as a result on a Future"""
+        """virtual path events that arrive close together are collected into a single
+        batch task so bulk album changes are applied to the filesystem in one pass"""
         uppercats_str = evt.db_event_data["values"]["category_uppercats"]
         uppercats = [int(c.strip()) for c in uppercats_str.split(",")]
         vfs_cat_id = AgentConfig.get().virtualfs_category_id
 
         result_fut = asyncio.Future()
-        if not vfs_cat_id or vfs_cat_id in uppercats:
-            result_fut.set_result(ImageVirtualPathEventTask(evt))
-        else:
+        if vfs_cat_id and vfs_cat_id not in uppercats:
             cls.get_logger().debug("%s is not a descendent of the virtualfs root category %s. skipping..."
                 , evt.db_event_data["values"]["virtual_path"], str(vfs_cat_id))
             result_fut.set_result(False)
+            return result_fut
 
+        result_fut.set_result(cls._get_batch(evt))
         return result_fut
 
-    def schedule_start(self):
-        """schedules execution of the image virtual path event handler on the event loop"""
+    @classmethod
+    async def queue_events(cls, events: list[ImageEventRow]) -> None:
+        """adds events that don't come from the image_virtual_paths table, like the tag and
+        date view links, to the waiting batches and waits until they have been applied so
+        they never touch the filesystem at the same time as another batch"""
+        batches = []
+        for evt in events:
+            batch = cls._get_batch(evt)
+            if batch not in batches:
+                batches.append(batch)
+        for batch in batches:
+            if batch.schedule_start():
+                await batch
+            else:
+                # the batch is awaited by whoever scheduled it so only wait for it to finish
+                # pylint: disable=protected-access
+                await batch._execute_task()
+
+    @classmethod
+    def _get_batch(cls, evt: ImageEventRow) -> ImageVirtualPathEventTask:
+        batch_size = AgentConfig.get().virtualfs_event_batch_size
+        waiting_task = next((t for t in cls._pending_tasks
+            if t.is_waiting() and len(t.events) < batch_size), None)
+        if waiting_task:
+            cls.get_logger().debug("adding virtual path event to existing batch")
+            waiting_task.add_event(evt)
+            return waiting_task
+
+        # a new batch must not touch the filesystem before an earlier batch finishes
+        previous = next((t for t in reversed(cls._pending_tasks) if not t.is_cancelled()), None)
+        return ImageVirtualPathEventTask(evt, previous)
+
+    def schedule_start(self) -> bool:
+        """schedules execution of the batch after a short delay to collect more events"""
         if not self.is_scheduled():
-            loop = asyncio.get_event_loop()
-            self._virt_path_task = loop.run_in_executor(None, self._handle_event)
-            self.status = EventTaskStatus.EXEC_QUEUED
+            sleep_fut = asyncio.ensure_future(asyncio.sleep(self._std_delay))
+            sleep_fut.add_done_callback(self._schedule_action_task)
+            self._sleep_futures.append(sleep_fut)
+            self.status = EventTaskStatus.WAITING
+            return True
 
-    def _handle_event(self):
-        self.status = EventTaskStatus.EXEC
+        return False
+
+    def add_event(self, evt: ImageEventRow) -> None:
+        """adds an event to the waiting batch and resets the delay"""
+        if not self.is_waiting():
+            raise RuntimeError(f"cannot add a new event to task in state {self.status}")
+
+        self.events.append(evt)
+        if self._sleep_futures:
+            self._sleep_futures[-1].remove_done_callback(self._schedule_action_task)
+            self._sleep_futures.append(asyncio.ensure_future(asyncio.sleep(self._std_delay)))
+            self._sleep_futures[-1].add_done_callback(self._schedule_action_task)
 
-        if self.event.db_event_type == "INSERT":
-            self.logger.info("handling image virtual path insert")
-            with Path(AgentConfig.get().piwigo_galleries_host_path):
-                src_path = Path(self.event.db_event_data["values"]["physical_path"]).abspath()
-                self.logger.debug("resolved source file to %s", src_path)
-                if not src_path.exists():
-                    broken_msg = "%s does not exist"
-                    if AgentConfig.get().virtualfs_allow_broken_links:
-                        self.logger.warning(broken_msg, src_path)
-                    else:
-                        raise FileNotFoundError(broken_msg % src_path)
-            with Path(AgentConfig.get().virtualfs_root):
-                virt_path = Path(self.event.db_event_data["values"]["virtual_path"]).abspath()
-                self.logger.debug("resolved virtual path to %s", virt_path)
-
-            if not ProgramConfig.get().dry_run and not virt_path.exists():
-                virt_path.dirname().makedirs_p()
-                src_path.symlink(virt_path)
-
-        elif self.event.db_event_type == "DELETE":
-            self.logger.info("handling image virtual path delete")
-            with Path(AgentConfig.get().virtualfs_root):
-                virt_path = Path(self.event.db_event_data["values"]["virtual_path"]).abspath()
-                self.logger.debug("resolved existing virtual path to %s", virt_path)
-            ImageVirtualPathEventTask._remove_path(virt_path)
+    def _schedule_action_task(self, _fut):
+        self._action_task = asyncio.create_task(self._handle_events())
+        self._action_task.set_name("exec_virt_path_batch")
+        self.status = EventTaskStatus.EXEC_QUEUED
 
+    async def _handle_events(self):
+        previous = self._previous
+        if previous:
+            # pylint: disable=protected-access
+            # a cancelled or finished batch may never get an action task to wait on
+            while not previous._action_task \
+                and previous.status not in [EventTaskStatus.CANCELLED, EventTaskStatus.DONE]:
+                await asyncio.sleep(0)
+            if previous._action_task:
+                await asyncio.wait([previous._action_task])
+            # don't keep the finished batches chained together in memory
+            self._previous = None
+        self.status = EventTaskStatus.EXEC
+        self.logger.info("handling batch of %s image virtual path events", len(self.events))
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.apply_events, self.events)
         self.status = EventTaskStatus.DONE
+        return True
 
     async def _execute_task(self):
-        res = await self._virt_path_task
-        return res
+        if self._sleep_futures:
+            await self._sleep_futures[-1]
+            # we may have appended a new sleep future...
+            if not self._sleep_futures[-1].done():
+                return await self._execute_task()
+
+        while not self._action_task:
+            await asyncio.sleep(0)
+        return await self._action_task
+
+    @classmethod
+    def apply_events(cls, events: list[ImageEventRow]) -> None:
+        """applies a batch of virtual path events to the virtualfs. only the last event
+        for each virtual path matters. the sources of new links are checked before the
+        filesystem is touched, removals are applied and then the links are created in one
+        pass grouped by their target directory. when broken links aren't allowed a link to
+        a missing source is logged and skipped without holding up the rest of the batch"""
+        logger = cls.get_logger()
+        final_events = {}
+        for evt in events:
+            virt_path = VirtualFsPaths.resolve_virtual_path(evt.db_event_data["values"]["virtual_path"])
+            final_events.pop(virt_path, None)
+            final_events[virt_path] = evt
+
+        links = sorted(
+            (p, VirtualFsPaths.resolve_source_path(e.db_event_data["values"]["physical_path"]))
+            for p, e in final_events.items()
+            if e.db_event_type == "INSERT" and not os.path.lexists(p)
+        )
+        link_builder = VirtualFsLinkBuilder()
+        if not AgentConfig.get().virtualfs_allow_broken_links:
+            missing = link_builder.find_missing_sources(src for _, src in links)
+            for virt_path, src_path in links:
+                if src_path in missing:
+                    logger.error(strings.LOG_VFS_MISSING_SOURCE(virt_path, src_path))
+            links = [(p, src) for p, src in links if src not in missing]
+
+        removals = sorted(p for p, e in final_events.items()
+            if e.db_event_type == "DELETE" and os.path.lexists(p))
+        for virt_path in removals:
+            logger.debug("removing virtual path %s", virt_path)
+            cls._remove_path(Path(virt_path))
+
+        logger.debug("creating %s virtual path links", len(links))
+        for virt_path in link_builder.build(links):
+            cls._record_dir_entry(virt_path)
 
     @classmethod
     def _remove_path(cls, target: Path):
         logger = cls.get_logger()
-        if not AgentConfig.get().virtualfs_remove_empty_dirs:
-            if not ProgramConfig.get().dry_run:
-                if not target.isdir():
-                    target.remove_p()
-                else:
-                    target.rmdir()
-        else:
-            parent_dir = target.parent
-            if not ProgramConfig.get().dry_run:
-                if not target.isdir():
-                    target.remove_p()
-                else:
-                    target.rmdir()
+        existed = os.path.lexists(target)
+        if not ProgramConfig.get().dry_run:
+            if not target.isdir():
+                target.remove_p()
+            else:
+                target.rmdir()
+        remaining = cls._release_dir_entry(target) if existed else None
 
+        if AgentConfig.get().virtualfs_remove_empty_dirs:
+            parent_dir = target.parent
             logger.debug("considering %s for removal...", parent_dir)
-            is_root_dir = parent_dir.samefile(AgentConfig.get().virtualfs_root)
+            is_root_dir = os.path.abspath(parent_dir) == os.path.abspath(AgentConfig.get().virtualfs_root)
             logger.debug("is path the root destination path? %s", is_root_dir)
-            is_empty = len(parent_dir.listdir()) == 0
+            if is_root_dir:
+                return
+            if remaining is None:
+                # the directory isn't tracked so fall back to listing it
+                is_empty = len(parent_dir.listdir()) == 0
+            else:
+                is_empty = remaining == 0
             logger.debug("is path empty? %s", is_empty)
-            remove_parent = not is_root_dir and is_empty
-            if remove_parent:
+            if is_empty:
                 logger.debug("removing %s", parent_dir)
-            if not ProgramConfig.get().dry_run and remove_parent:
+            if not ProgramConfig.get().dry_run and is_empty:
                 cls._remove_path(parent_dir)
 
+    @classmethod
+    def _seed_dir_counts(cls, vfs_root: str, link_paths) -> None:
+        """initializes the in-memory entry count of every virtualfs directory from the
+        full set of links so empty directories can be detected without listing them"""
+        counts = {}
+        for link_path in link_paths:
+            cls._add_dir_entry(counts, vfs_root, link_path)
+        with cls._dir_counts_lock:
+            cls._dir_counts = counts
+
+    @staticmethod
+    def _add_dir_entry(counts: dict[str, int], vfs_root: str, path: str) -> None:
+        """counts a new entry at path along with any directories that were created for it"""
+        directory = os.path.dirname(path)
+        while directory.startswith(vfs_root + os.sep):
+            if directory in counts:
+                counts[directory] += 1
+                return
+            counts[directory] = 1
+            directory = os.path.dirname(directory)
+
+    @classmethod
+    def _record_dir_entry(cls, path: str) -> None:
+        with cls._dir_counts_lock:
+            if cls._dir_counts is not None:
+                vfs_root = os.path.abspath(AgentConfig.get().virtualfs_root)
+                cls._add_dir_entry(cls._dir_counts, vfs_root, os.path.abspath(path))
+
+    @classmethod
+    def _release_dir_entry(cls, path: str) -> Optional[int]:
+        """uncounts a removed entry and returns the number of entries left in its
+        directory, or None if the directory isn't being tracked"""
+        with cls._dir_counts_lock:
+            if cls._dir_counts is None:
+                return None
+            return cls._remove_dir_entry(cls._dir_counts, os.path.abspath(path))
+
+    @staticmethod
+    def _remove_dir_entry(counts: dict[str, int], path: str) -> Optional[int]:
+        """uncounts the entry at path and returns the number of entries left in its directory"""
+        counts.pop(path, None)
+        parent = os.path.dirname(path)
+        if parent not in counts:
+            return None
+        counts[parent] = max(counts[parent] - 1, 0)
+        return counts[parent]
+
     @classmethod
     async def rebuild_virtualfs(cls):
-        """deletes everything in the virtualfs root directory and recreates
-        everything from the piwigo db"""
+        """reconciles the virtualfs root directory with the image virtual paths in the
+        piwigo db. only missing, stale or incorrect links are created or removed so the
+        tree stays usable by any clients browsing it while the rebuild runs"""
         # todo: rebuild the image_virtual_paths table--using existing script
         # can be referenced from program config db_scripts_path
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, VirtualFsLinkBuilder.detect_link_type)
+        vfs_root = os.path.abspath(AgentConfig.get().virtualfs_root)
+        expected = await VirtualFsPaths.get_expected_paths()
+
+        staging_parent = None
+        if AgentConfig.get().virtualfs_rebuild_mode == "staged":
+            staging_parent = cls._get_staging_parent(vfs_root)
+        if staging_parent:
+            old_tree = await loop.run_in_executor(None
+                , cls._staged_rebuild_virtualfs, vfs_root, expected, staging_parent)
+            if old_tree:
+                cls._remove_old_tree(old_tree)
+        else:
+            await loop.run_in_executor(None, cls._reconcile_virtualfs, vfs_root, expected)
+
+    @classmethod
+    def _remove_old_tree(cls, old_tree: str) -> asyncio.Future:
+        """removes a virtualfs tree that was swapped out by a staged rebuild without
+        holding up the agent startup"""
         logger = cls.get_logger()
-        async with DbConnectionPool.get().acquire_dict_cursor(db=ProgramConfig.get().pwgo_db_name) as (cur,_):
-            vfs_root = Path(AgentConfig.get().virtualfs_root)
-            logger.debug("retrieving all image virtual paths from db")
-            await cur.execute("SELECT * FROM image_virtual_paths")
-            v_path_rows = await cur.fetchall()
-
-            vfs_root_category_id = AgentConfig.get().virtualfs_category_id
-            def is_in_vfs(uppercats_str):
-                uppercats = [int(c.strip()) for c in uppercats_str.split(",")]
-                return vfs_root_category_id in uppercats
-
-            if vfs_root_category_id:
-                # if there's a root category set then filter the returned rows
-                v_path_rows = [p for p in v_path_rows if is_in_vfs(p["category_uppercats"])]
-
-            logger.debug(strings.LOG_VFS_REBUILD_REMOVE(vfs_root))
-            if not ProgramConfig.get().dry_run:
-                for file in vfs_root.files():
-                    file.remove()
-                for directory in vfs_root.dirs():
-                    directory.rmtree()
-
-            logger.debug(strings.LOG_VFS_REBUILD_CREATE(len(v_path_rows)))
-            for row in v_path_rows:
-                with Path(AgentConfig.get().piwigo_galleries_host_path):
-                    src_path = Path(row["physical_path"]).abspath()
-                    if not src_path.exists():
-                        broken_msg = "%s does not exist"
-                        if AgentConfig.get().virtualfs_allow_broken_links:
-                            logger.warning(broken_msg, src_path)
-                        else:
-                            raise FileNotFoundError(broken_msg % src_path)
-                with Path(AgentConfig.get().virtualfs_root):
-                    virt_path = Path(row["virtual_path"]).abspath()
-
-                if not ProgramConfig.get().dry_run and not virt_path.exists():
-                    virt_path.dirname().makedirs_p()
-                    src_path.symlink(virt_path)
+        def on_done(fut: asyncio.Future):
+            if fut.exception():
+                logger.error("unable to remove old virtualfs tree %s: %s", old_tree, fut.exception())
+            else:
+                logger.debug("removed old virtualfs tree %s", old_tree)
+
+        logger.debug("removing old virtualfs tree %s in the background", old_tree)
+        rm_fut = asyncio.get_running_loop().run_in_executor(None, shutil.rmtree, old_tree)
+        rm_fut.add_done_callback(on_done)
+        return rm_fut
+
+    @classmethod
+    def _get_staging_parent(cls, vfs_root: str) -> Optional[str]:
+        """gets the directory a staged tree is built in. the staged tree is swapped in with a
+        rename, so it has to be outside of the root, where clients browsing the virtualfs can't
+        see it, and on the same filesystem. returns None when the root can't be staged"""
+        staging_parent = os.path.abspath(AgentConfig.get().virtualfs_staging_path or os.path.dirname(vfs_root))
+        if os.path.ismount(vfs_root):
+            reason = "it is a mount point and can't be swapped"
+        elif staging_parent == vfs_root or staging_parent.startswith(vfs_root + os.sep):
+            reason = f"the staging path {staging_parent} is inside it"
+        elif os.stat(staging_parent).st_dev != os.stat(vfs_root).st_dev:
+            reason = f"the staging path {staging_parent} is on a different filesystem"
+        else:
+            return staging_parent
+
+        cls.get_logger().warning(strings.LOG_VFS_STAGING_FALLBACK(vfs_root, reason))
+        return None
+
+    @classmethod
+    def _staged_rebuild_virtualfs(cls, vfs_root: str, expected: dict[str, str], staging_parent: str) -> Optional[str]:
+        """builds a complete virtualfs tree in a staging directory under staging_parent and swaps
+        it with the live tree. returns the path holding the old tree, which the caller should remove"""
+        logger = cls.get_logger()
+        acfg = AgentConfig.get()
+        if ProgramConfig.get().dry_run:
+            logger.debug(strings.LOG_VFS_STAGED_BUILD(len(expected), "(dry run)"))
+            return None
+
+        staging = tempfile.mkdtemp(prefix=acfg.virtualfs_staging_prefix, dir=staging_parent)
+        root_stat = os.stat(vfs_root)
+        os.chmod(staging, stat.S_IMODE(root_stat.st_mode))
+        try:
+            os.chown(staging, root_stat.st_uid, root_stat.st_gid)
+        except PermissionError:
+            pass
+        logger.debug(strings.LOG_VFS_STAGED_BUILD(len(expected), staging))
+
+        def staged_path(virt_path: str) -> str:
+            return os.path.join(staging, os.path.relpath(virt_path, vfs_root))
+
+        try:
+            created = VirtualFsLinkBuilder().build((staged_path(p), src) for p, src in expected.items())
+        except Exception:
+            shutil.rmtree(staging)
+            raise
+
+        cls._seed_dir_counts(vfs_root, (os.path.join(vfs_root, os.path.relpath(p, staging)) for p in created))
+        atomic = exchange_paths(staging, vfs_root)
+        logger.info("swapped staged virtualfs into %s (atomic: %s)", vfs_root, atomic)
+        return staging
+
+    @classmethod
+    def _reconcile_virtualfs(cls, vfs_root: str, expected: dict[str, str]) -> None:
+        """scans the virtualfs tree and brings it in line with the expected mapping
+        of virtual paths to source paths"""
+        checker = VirtualFsChecker(vfs_root, expected)
+        report = checker.check()
+        created = checker.fix(report)
+        if not ProgramConfig.get().dry_run:
+            cls._seed_dir_counts(vfs_root, checker.current.union(created))
+
+        cls.get_logger().info("virtualfs reconciled: %s links created, %s entries removed, %s links unchanged"
+            , len(created), len(report["extra"]) + len(report["wrong_target"]) + len(report["extra_dirs"])
+            , len(checker.current))
+
+# the tag and date views queue their link changes with the virtual path batches
+VirtualFsViews.set_event_queue(ImageVirtualPathEventTask.queue_events)
@@ -8,14 +8,15 @@ from pwgo_helper.agent.image_virtual_path_event_task import ImageVirtualPathEven
 from asyncmy import connect
 from asyncmy.replication import BinLogStream
 from asyncmy.replication.row_events import WriteRowsEvent
-from py_linq import Enumerable
 
 from . import strings
 from .event_dispatcher import EventDispatcher
-from ..config import Configuration as ProgramConfiguration
+from ..config import Configuration as ProgramConfiguration, PiwigoScripts
 from .config import Configuration as AgentConfiguration
 from .autotagger import AutoTagger
-from .pwgo_image import PiwigoImage
+from .tag_metadata_rewriter import TagMetadataRewriter
+from .autotag_backlog import AutotagBacklog
+from .rekognition import RekognitionClient
 from ..db_connection_pool import DbConnectionPool as DbPool
 from .image_virtual_path_event_task import ImageVirtualPathEventTask
 from .utilities import parse_sql
@@ -30,6 +31,7 @@ class MetadataAgent():
         self._binlog_stream = None
         self._is_running = False
         self._stopping_task = None
+        self._background_tasks = []
 
     def __await__(self):
         if not self._is_running and not self._stopping_task:
@@ -70,6 +72,8 @@ class MetadataAgent():
         self._evt_monitor_task = await self._start_event_monitor()
         self._evt_monitor_task.set_name("event-monitor")
         self._is_running = True
+        # finish any tag keyword rewrites that were interrupted by a previous stop
+        self._start_background_task(TagMetadataRewriter.resume_pending(), "resume-tag-rewrites")
         await self.process_autotag_backlog()
 
     async def stop(self, force=False):
@@ -80,6 +84,8 @@ class MetadataAgent():
                 self._stopping_task.set_name(strings.AGNT_STOP_TASK_NM)
             if self._evt_monitor_task and not self._evt_monitor_task.done():
                 self._evt_monitor_task.cancel()
+            for bg_task in [t for t in self._background_tasks if not t.done()]:
+                bg_task.cancel()
             if self._evt_dispatcher and self._evt_dispatcher.state == "RUNNING":
                 stop_dispatch_task = asyncio.create_task(self._evt_dispatcher.stop(force=force))
                 stop_dispatch_task.set_name(strings.DSPCH_STOP_TASK_NM)
@@ -94,6 +100,19 @@ class MetadataAgent():
                 self._binlog_stream.close()
             self._is_running = False
 
+    def _start_background_task(self, coro, name) -> Task:
+        """runs a long running job alongside the event dispatcher. the task is cancelled
+        when the agent stops and any error it raises is logged rather than stopping the agent"""
+        def log_result(tsk: Task):
+            if not tsk.cancelled() and tsk.exception():
+                self._logger.error("background task %s failed", tsk.get_name(), exc_info=tsk.exception())
+
+        bg_task = asyncio.create_task(coro)
+        bg_task.set_name(name)
+        bg_task.add_done_callback(log_result)
+        self._background_tasks.append(bg_task)
+        return bg_task
+
     async def _start_event_monitor(self) -> Task:
         """Starts a BinLogStreamReader to monitor for mysql events
         that need to be handled"""
@@ -143,58 +162,11 @@ class MetadataAgent():
             else:
                 self._logger.debug("dispatcher is not running. ignoring event.")
 
-    async def process_autotag_backlog(self):
-        """process any existing images that are waiting in the auto tag album
-            and initialize the tags for any previously autotagged images"""
+    async def process_autotag_backlog(self) -> Task:
+        """starts working through any existing images that are waiting in the auto tag
+        album in the background so live events are handled while the backlog runs"""
         self._logger.debug("processing any autotag backlog photos")
-        pcfg = ProgramConfiguration.get()
-        async with DbPool.get().acquire_dict_cursor(db=pcfg.pwgo_db_name) as (cur, _):
-            sql = """
-                SELECT i.id, i.file, i.path
-                FROM images i
-                JOIN image_category ic
-                ON ic.image_id = i.id
-                WHERE ic.category_id = %s
-            """
-            await cur.execute(sql, (AgentConfiguration.get().auto_tag_alb))
-            tag_imgs = [PiwigoImage(**row) for row in await cur.fetchall()]
-
-        autotag_tasks = []
-        for img in tag_imgs:
-            async with AutoTagger.create(img) as tagger:
-                tsk = asyncio.create_task(tagger.autotag_image())
-                tsk.set_name(f"autotag-blog-{img.file}")
-                autotag_tasks.append(tsk)
-        await asyncio.gather(*autotag_tasks)
-
-        async def add_img_tags(img_id, tag_ids):
-            async with AutoTagger.create(img_id) as tagger:
-                await tagger.add_tags(tag_ids)
-
-        async with DbPool.get().acquire_dict_cursor(db=pcfg.pwgo_db_name) as (cur, _):
-            # initialize the tags for any previously autotagged images
-            # this is in case a new tag has been added to the piwigo table
-            # that matches one that was previously detected by rekognition
-            sql = f"""
-                SELECT il.piwigo_image_id, t.id tag_id
-                FROM `{pcfg.rek_db_name}`.image_labels il
-                JOIN tags t
-                ON t.name = il.label
-                LEFT JOIN image_tag it
-                ON it.image_id = il.piwigo_image_id
-                    AND it.tag_id = t.id
-                WHERE it.image_id IS NULL
-            """
-            await cur.execute(sql)
-            img_tags = [(r["piwigo_image_id"],r["tag_id"]) for r in await cur.fetchall()]
-
-        if img_tags:
-            imgs = Enumerable(img_tags).group_by(key_names=['img_id'], key=lambda x: x[0])
-            tag_coros = []
-            for img_grp in imgs:
-                tag_ids = [t[1] for t in img_grp]
-                tag_coros.append(add_img_tags(img_grp.key.img_id,tag_ids))
-            await asyncio.gather(*tag_coros)
+        return self._start_background_task(AutotagBacklog.process(), "autotag-backlog")
 
 @click.command("agent")
 @click.option(
@@ -203,6 +175,11 @@ class MetadataAgent():
     as a virtual filesystem by the fs package""",
     required=True,
 )
+@click.option(
+    "--piwigo-data-host-path",
+    help="""Host path of the piwigo _data folder. When set, existing piwigo derivatives that are at least
+    as large as the scaled image size are sent to rekognition in place of the original files""",
+)
 @click.option(
     "--rek-access-key",help="rekognition aws access key",type=str,required=True,hide_input=True
 )
@@ -223,6 +200,37 @@ class MetadataAgent():
     help="Indicates the directory to which to save crops of faces detected in images. Crops are not saved by default.",
     type=click.Path(exists=True,file_okay=False)
 )
+@click.option(
+    "--face-index-deep-sync",
+    help="""reconcile the recorded face index with the rekognition face collection at startup rather than
+    waiting for the first daily check. routine face index syncs only compare the recorded faces with the
+    face index albums""",
+    is_flag=True
+)
+@click.option(
+    "--face-match-mode",
+    help="""how detected faces are matched against the face index. crop uploads a crop of each face
+    to rekognition. index uploads the image once, adds its faces to the face index temporarily and
+    searches the index by face id""",
+    type=click.Choice(["crop", "index"]), default="crop"
+)
+@click.option(
+    "--face-prefilter",
+    help="""check images for faces locally before asking rekognition to find them. images where no face
+    is found skip the rekognition face calls. requires the opencv package""",
+    is_flag=True
+)
+@click.option(
+    "--face-prefilter-min-neighbors",
+    help="number of overlapping detections the face prefilter needs to count a face. lower values find more faces",
+    type=int, default=3
+)
+@click.option(
+    "--burst-detection",
+    help="""reuse the faces, labels and tags of an already tagged image for nearly identical shots taken
+    within seconds of it instead of sending them to rekognition. requires the imagehash package""",
+    is_flag=True
+)
 @click.option(
     "--virtualfs-root",
     help="path to the root of the album-based virtual filesystem",
@@ -243,6 +251,41 @@ class MetadataAgent():
     help="the root category for the virtual fs. subcategories of the specified category will be included",
     type=int, default=0
 )
+@click.option(
+    "--virtualfs-rebuild-mode",
+    help="""how the virtual fs is rebuilt at startup. reconcile updates the live tree in place.
+    staged builds a new tree in a staging directory and swaps it in atomically""",
+    type=click.Choice(["reconcile", "staged"]), default="reconcile"
+)
+@click.option(
+    "--virtualfs-staging-path",
+    help="""directory staged rebuilds are built in. it must be on the same filesystem as the virtual fs root
+    and outside of it. defaults to the parent directory of the root. when the root is a mount point or
+    can't be staged, the rebuild reconciles the live tree instead""",
+    type=click.Path(exists=True,file_okay=False)
+)
+@click.option(
+    "--virtualfs-link-type",
+    help="""how files are linked into the virtual fs. hardlink requires the virtual fs to be on the same
+    filesystem as the galleries and reflink requires a copy-on-write filesystem. a reflink is a separate
+    copy, so metadata written to an image afterwards doesn't show up in the virtual fs until it is
+    rebuilt. auto uses the first of hardlink and symlink that works, and only considers reflink in a
+    dry run""",
+    type=click.Choice(["symlink", "hardlink", "reflink", "auto"]), default="symlink"
+)
+@click.option(
+    "--virtualfs-fanout",
+    help="""splits the images of each album in the virtual fs into subdirectories, either by year and month
+    of the image date or by a two character hash of the image id. date subdirectories follow changes to the image date.
+    takes effect when the database is initialized with --initialize-db""",
+    type=click.Choice(["none", "date", "hash"]), default="none"
+)
+@click.option(
+    "--virtualfs-views",
+    help="""additional trees to maintain in the virtual fs. tags links each image under a directory per tag
+    and dates links each image under a year and month directory of its creation date""",
+    type=click.Choice(["tags", "dates"]), multiple=True
+)
 @click.option(
     "--workers",
     help="Number of workers to handle event queue",
@@ -285,6 +328,9 @@ def agent_entry(**kwargs):
             await AgentConfiguration.initialize(**kwargs)
             if kwargs["initialize_db"]:
                 logger.debug(strings.LOG_INITIALIZE_DB)
+                # the virtual path layout is baked into the piwigo scripts
+                prg_cfg.piwigo_db_scripts = PiwigoScripts(
+                    prg_cfg.pwgo_db_name, prg_cfg.msg_db_name, kwargs["virtualfs_fanout"])
                 exec_scripts = [
                     prg_cfg.piwigo_db_scripts.create_category_paths,
                     prg_cfg.piwigo_db_scripts.create_implicit_tags,
@@ -293,11 +339,17 @@ def agent_entry(**kwargs):
                     prg_cfg.piwigo_db_scripts.create_image_category_triggers,
                     prg_cfg.piwigo_db_scripts.create_tags_triggers,
                     prg_cfg.piwigo_db_scripts.create_image_tag_triggers,
+                    prg_cfg.piwigo_db_scripts.create_images_triggers,
                     prg_cfg.piwigo_db_scripts.create_pwgo_message,
+                    prg_cfg.piwigo_db_scripts.create_tag_keyword_rewrite,
+                    prg_cfg.piwigo_db_scripts.create_autotag_backlog,
                     prg_cfg.rekognition_db_scripts.create_rekognition_db,
                     prg_cfg.rekognition_db_scripts.create_image_labels,
                     prg_cfg.rekognition_db_scripts.create_index_faces,
-                    prg_cfg.rekognition_db_scripts.create_processed_faces
+                    prg_cfg.rekognition_db_scripts.create_no_face_images,
+                    prg_cfg.rekognition_db_scripts.create_processed_faces,
+                    prg_cfg.rekognition_db_scripts.create_rekognition_responses,
+                    prg_cfg.rekognition_db_scripts.create_image_phashes
                 ]
                 async with db_pool.acquire_connection() as conn:
                     async with conn.cursor() as cur:
@@ -308,8 +360,11 @@ def agent_entry(**kwargs):
                                 for stmt in stmts:
                                     await cur.execute(stmt)
                     await conn.commit()
+            elif ctx.get_parameter_source("virtualfs_fanout") != click.core.ParameterSource.DEFAULT:
+                logger.warning(strings.LOG_VFS_FANOUT_IGNORED)
             logger.debug("starting and awaiting metadata agent")
-            await MetadataAgent(logger)
+            async with RekognitionClient.initialize_shared():
+                await MetadataAgent(logger)
             logger.debug("metadata agent returned")
             logger.debug("releasing database connection pool resources...")
 
@@ -0,0 +1,100 @@
+"""container module for PagedImageJob"""
+from __future__ import annotations
+
+import asyncio
+from abc import ABC, abstractclassmethod
+from time import perf_counter
+
+from ..config import Configuration as ProgramConfig
+from .pwgo_image import PiwigoImage
+
+class PagedImageJob(ABC):
+    """Base class for jobs that work through a large set of images. Images are read in pages
+    ordered by id and handled with a bounded number of concurrent workers so the job doesn't
+    exhaust the db pool or memory. The last image id of each finished page is checkpointed so
+    an interrupted job continues where it stopped. A failed image is logged and skipped so it
+    can't hold up the rest of the job or every resume of it. Jobs are keyed so more than one
+    set of images, like the images of a tag, can be worked through by the same job type."""
+    # progress log message. formatted with the done, total and failed counts, the key and the eta
+    PROGRESS_MSG = "handled %s of %s images of %s, %s failed (eta %.0fs)"
+    # failure log message. formatted with the image file
+    FAILURE_MSG = "unable to handle image %s"
+
+    @classmethod
+    def get_logger(cls):
+        """gets a logger..."""
+        return ProgramConfig.get().get_logger(cls.__module__)
+
+    @abstractclassmethod
+    async def _count_remaining(cls, key: int, last_image_id: int) -> int:
+        """counts the images of the job after the given image id"""
+
+    @abstractclassmethod
+    async def _get_page(cls, key: int, last_image_id: int, page_size: int) -> list[PiwigoImage]:
+        """gets the next page of images of the job after the given image id"""
+
+    @abstractclassmethod
+    async def _checkpoint(cls, key: int, last_image_id: int) -> None:
+        """records the id of the last image handled"""
+
+    @abstractclassmethod
+    async def _handle_image(cls, img: PiwigoImage) -> None:
+        """does the work of the job for a single image"""
+
+    @classmethod
+    def _log_begin(cls, key: int, total: int, last_image_id: int) -> None:
+        cls.get_logger().info("handling %s images of %s after image %s", total, key, last_image_id)
+
+    @classmethod
+    def _take_restart(cls, key: int) -> bool:
+        """is the job to start over from the first image before its next page. a restart
+        request is consumed by this call"""
+        # pylint: disable=unused-argument
+        return False
+
+    @classmethod
+    async def _run_pages(cls, key: int, last_image_id: int, workers: int, page_size: int) -> tuple[int, int]:
+        """works through the images of the job page by page after the given image id.
+        returns the number of images handled and how many of them failed"""
+        logger = cls.get_logger()
+        total = await cls._count_remaining(key, last_image_id)
+        cls._log_begin(key, total, last_image_id)
+        semaphore = asyncio.Semaphore(workers)
+        done = 0
+        failed = 0
+        beg = perf_counter()
+        while True:
+            if cls._take_restart(key):
+                last_image_id = 0
+                done = 0
+                failed = 0
+                # a crash after the restart has to resume from the beginning as well
+                await cls._checkpoint(key, last_image_id)
+                total = await cls._count_remaining(key, last_image_id)
+                cls._log_begin(key, total, last_image_id)
+
+            page = await cls._get_page(key, last_image_id, page_size)
+            if not page:
+                break
+
+            results = await asyncio.gather(*[cls._handle_guarded(img, semaphore) for img in page])
+            failed += results.count(False)
+            last_image_id = page[-1].id
+            done += len(page)
+            await cls._checkpoint(key, last_image_id)
+            elapsed = perf_counter() - beg
+            remaining = max(total - done, 0)
+            logger.info(cls.PROGRESS_MSG, done, total, key, failed, elapsed / done * remaining)
+
+        return done, failed
+
+    @classmethod
+    async def _handle_guarded(cls, img: PiwigoImage, semaphore: asyncio.Semaphore) -> bool:
+        async with semaphore:
+            try:
+                await cls._handle_image(img)
+                return True
+            # pylint: disable=broad-except
+            except Exception:
+                cls.get_logger().exception(cls.FAILURE_MSG, img.file)
+                return False
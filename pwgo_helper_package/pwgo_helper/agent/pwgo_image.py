@@ -1,16 +1,21 @@
 """container module for PiwigoImage"""
 from __future__ import annotations
 
-import json, datetime
-from io import IOBase
+import json, datetime, os
+from io import IOBase, BytesIO
 from contextlib import contextmanager
 from typing import Dict
 
+from PIL import Image
+
 from . import utilities
 from ..config import Configuration as ProgramConfig
 from .config import Configuration as AgentConfig
 from ..db_connection_pool import DbConnectionPool
 
+# piwigo's standard derivative types that aren't cropped, smallest first
+DERIVATIVE_TYPES = ["me", "la", "xl", "xx"]
+
 class PiwigoImage:
     """Class which encapsulates the core attributes of an image in the Piwigo db."""
     @staticmethod
@@ -23,6 +28,11 @@ class PiwigoImage:
         self.id = int(kwargs["id"])
         self.file = kwargs["file"]
         self._path = kwargs["path"]
+        self.width = kwargs.get("width")
+        self.height = kwargs.get("height")
+        self.rotation = kwargs.get("rotation")
+        self.md5sum = kwargs.get("md5sum")
+        self.date_creation = kwargs.get("date_creation")
         if "metadata" in kwargs:
             self.metadata = kwargs["metadata"]
         else:
@@ -34,7 +44,7 @@ class PiwigoImage:
         cls.get_logger().debug("looking up image details from db")
         async with DbConnectionPool.get().acquire_dict_cursor(db=ProgramConfig.get().pwgo_db_name) as (cur,_):
             sql = """
-                SELECT file, path
+                SELECT file, path, width, height, rotation, md5sum, date_creation
                 FROM images
                 WHERE id = %s
             """
@@ -46,7 +56,12 @@ class PiwigoImage:
             return_args = {
                 "id": img_id,
                 "file": result["file"],
-                "path": result["path"]
+                "path": result["path"],
+                "width": result["width"],
+                "height": result["height"],
+                "rotation": result["rotation"],
+                "md5sum": result["md5sum"],
+                "date_creation": result["date_creation"]
             }
 
         if load_metadata:
@@ -82,8 +97,73 @@ class PiwigoImage:
             img_file.close()
             pgfs.close()
 
+    def load_scaled(self) -> ScaledImage:
+        """reads and decodes the PiwigoImage file once into a ScaledImage that can be
+        reused for every rekognition call made for the image. an existing piwigo
+        derivative is read instead of the original when one is large enough"""
+        pgfs = utilities.get_pwgo_fs()
+        try:
+            with pgfs.openbin(self.resolve_source_path(pgfs)) as img_file:
+                return ScaledImage(utilities.scale_image(img_file, AgentConfig.get().scaled_img_max_size))
+        finally:
+            pgfs.close()
+
+    def get_derivative_path(self, derivative_type: str) -> str:
+        """gets the piwigo relative path of one of the image's derivatives"""
+        root, ext = os.path.splitext(os.path.normpath(self._path))
+        return os.path.join("_data", "i", f"{root}-{derivative_type}{ext}")
+
+    def resolve_source_path(self, pgfs) -> str:
+        """gets the path of the smallest piwigo derivative that still covers the scaled
+        image size. falls back to the original if the derivatives aren't available"""
+        from_path = utilities.map_pwgo_path(self._path)
+        acfg = AgentConfig.get()
+        # rotated images have rotated derivatives, which would move any stored face boxes
+        if not acfg.piwigo_data_host_path or self.rotation:
+            return from_path
+
+        if self.width and self.height:
+            org_size = (self.width, self.height)
+        else:
+            with pgfs.openbin(from_path) as org_file, Image.open(org_file) as org_img:
+                org_size = org_img.size
+        target = sorted(utilities.fit_size(org_size, acfg.scaled_img_max_size))
+        for derivative_type in DERIVATIVE_TYPES:
+            deriv_path = utilities.map_pwgo_path(self.get_derivative_path(derivative_type))
+            if not pgfs.exists(deriv_path):
+                continue
+            with pgfs.openbin(deriv_path) as deriv_file, Image.open(deriv_file) as deriv_img:
+                # allow for piwigo rounding the derivative size differently
+                if all(d >= t - 1 for d, t in zip(sorted(deriv_img.size), target)):
+                    self.logger.debug("using %s derivative of %s", derivative_type, self.file)
+                    return deriv_path
+
+        return from_path
+
+class ScaledImage:
+    """Holds the scaled pixels of a decoded image along with their JPEG encoding so
+    the same image can be sent more than once and cropped without decoding it again"""
+    def __init__(self, pixels: Image.Image):
+        self.pixels = pixels
+        self.payload: bytes = utilities.encode_jpeg(pixels).getvalue()
+
+    def open(self) -> IOBase:
+        """gets a new file object for the encoded image"""
+        return BytesIO(self.payload)
+
+    def crop(self, box: utilities.Bounding) -> IOBase:
+        """crops the scaled pixels to the given rekognition bounding box"""
+        return utilities.crop_image(self.pixels, box)
+
 class PiwigoImageMetadata:
     """DTO to encapsulate the metadata fields that we're interested in"""
+    IPTC_KEYS = {
+        "name": "Iptc.Application2.ObjectName",
+        "comment": "Iptc.Application2.Caption",
+        "author": "Iptc.Application2.Byline",
+        "tags": "Iptc.Application2.Keywords"
+    }
+
     def __init__(self, raw: Dict):
         self._logger = ProgramConfig.get().get_logger(__name__)
         required_fields = ["name", "comment", "author", "date_creation", "tags"]
@@ -118,16 +198,22 @@ class PiwigoImageMetadata:
         """sets the tags list from the deduplictad value provided."""
         self._tags = list(dict.fromkeys(value))
 
-    def get_iptc_dict(self):
-        """returns the metadata as a dictonary with values mapped to iptc keys"""
+    def get_iptc_dict(self, fields=None):
+        """returns the metadata as a dictonary with values mapped to iptc keys. If a
+        collection of field names is given, only those fields are included and any
+        that are empty are mapped to None so that they are removed from the file."""
+        values = {
+            "name": self.name[ 0 : 64 ] if self.name else None,
+            "comment": self.comment[ 0 : 2000 ] if self.comment else None,
+            "author": self.author[ 0 : 32 ] if self.author else None,
+            "tags": list(self.tags) if self.tags else None
+        }
         iptc_dict = {}
-        if self.name:
-            iptc_dict["Iptc.Application2.ObjectName"] = self.name[ 0 : 64 ]
-        if self.comment:
-            iptc_dict["Iptc.Application2.Caption"] = self.comment[ 0 : 2000 ]
-        if self.author:
-            iptc_dict["Iptc.Application2.Byline"] = self.author[ 0 : 32 ]
-        if self.tags:
-            iptc_dict["Iptc.Application2.Keywords"] = list(self.tags)
+        for field, key in PiwigoImageMetadata.IPTC_KEYS.items():
+            if fields is None:
+                if values[field]:
+                    iptc_dict[key] = values[field]
+            elif field in fields:
+                iptc_dict[key] = values[field]
 
         return iptc_dict
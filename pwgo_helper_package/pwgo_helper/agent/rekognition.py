@@ -1,16 +1,22 @@
 """Container module for Rekognize class"""
 from __future__ import annotations
 
-from typing import Dict, List, IO
+from typing import Callable, Dict, List, IO, AsyncIterator, Optional
+from contextlib import asynccontextmanager
 
-from py_linq import Enumerable
 import aiobotocore
+from aiobotocore.config import AioConfig
 
 from ..config import Configuration as ProgramConfig
 from .config import Configuration as AgentConfig
 
 class RekognitionClient():
-    """A wrapper class with static methods for exposing the Rekognition client api"""
+    """A wrapper class with static methods for exposing the Rekognition client api. While
+    the shared client is initialized every instance uses it so its connection pool, credentials
+    and service model are set up once. Otherwise each instance creates and closes its own client"""
+    DELETE_FACES_MAX = 4096
+    _shared_client = None
+
     @staticmethod
     def get_logger():
         """gets a logger..."""
@@ -20,20 +26,43 @@ class RekognitionClient():
         self.logger = RekognitionClient.get_logger()
         self._config = AgentConfig.get().rek_cfg
         self._rek_client = None
+        self._owns_client = False
 
-    async def __aenter__(self):
+    @staticmethod
+    @asynccontextmanager
+    async def initialize_shared():
+        """creates the long lived client shared by all instances until the context exits"""
+        acfg = AgentConfig.get()
+        client_ctx = RekognitionClient._create_client(acfg.rek_cfg, acfg.rek_max_pool_connections)
+        async with client_ctx as client:
+            RekognitionClient._shared_client = client
+            try:
+                yield client
+            finally:
+                RekognitionClient._shared_client = None
+
+    @staticmethod
+    def _create_client(config: Dict, max_pool_connections: int = None):
         session = aiobotocore.session.AioSession()
-        client_ctx = session.create_client(
+        return session.create_client(
             'rekognition',
-            aws_access_key_id=self._config["aws_access_key_id"],
-            aws_secret_access_key=self._config["aws_secret_access_key"],
-            region_name=self._config["region_name"]
+            aws_access_key_id=config["aws_access_key_id"],
+            aws_secret_access_key=config["aws_secret_access_key"],
+            region_name=config["region_name"],
+            config=AioConfig(max_pool_connections=max_pool_connections) if max_pool_connections else None
         )
-        self._rek_client = await client_ctx.__aenter__()
+
+    async def __aenter__(self):
+        if RekognitionClient._shared_client:
+            self._rek_client = RekognitionClient._shared_client
+        else:
+            self._rek_client = await RekognitionClient._create_client(self._config).__aenter__()
+            self._owns_client = True
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self._rek_client.__aexit__(exc_type, exc_val, exc_tb)
+        if self._owns_client:
+            await self._rek_client.__aexit__(exc_type, exc_val, exc_tb)
 
     async def detect_labels(self, img_file: IO) -> List[Dict]:
         """Finds contextual labels in the image such as objects and setting"""
@@ -68,46 +97,48 @@ class RekognitionClient():
 
         return resp["FaceRecords"]
 
-    async def get_indexed_faces(self, **kwargs):
-        """Gets all the faces that are currently in the default face collection/index"""
-        request_args = { "CollectionId": self._config["collection_id"] }
-        if "next_token" in kwargs:
-            request_args["NextToken"] = kwargs["next_token"]
-
-        resp = await self._rek_client.list_faces(**request_args)
-        result = Enumerable(resp["Faces"])
-        if "NextToken" in resp:
-            result = result.union(Enumerable(await self._rek_client.get_indexed_faces(next_token=resp["NextToken"])))
-
-        return result.to_list()
-
-    async def remove_indexed_faces(self, face_ids):
+    async def get_indexed_faces(self, page_size: int = None) -> AsyncIterator[Dict]:
+        """Streams all the faces that are currently in the default face collection/index. The
+        faces are requested a page at a time so the collection is never held in memory"""
+        request_args = {
+            "CollectionId": self._config["collection_id"],
+            "MaxResults": page_size or AgentConfig.get().rek_list_faces_page_size
+        }
+        while True:
+            resp = await self._rek_client.list_faces(**request_args)
+            for face in resp["Faces"]:
+                yield face
+
+            if "NextToken" not in resp:
+                break
+            request_args["NextToken"] = resp["NextToken"]
+
+    async def remove_indexed_faces(self, face_ids) -> List[str]:
         """Removes the given face ids from the default face collection/index"""
         if not isinstance(face_ids, list):
             raise TypeError("face_ids must be a list")
 
-        if not face_ids:
-            return
-
-        resp = await self._rek_client.delete_faces(
-            CollectionId = self._config["collection_id"],
-            FaceIds = face_ids
-        )
+        deleted = []
+        # rekognition limits the number of faces deleted per call
+        for i in range(0, len(face_ids), RekognitionClient.DELETE_FACES_MAX):
+            resp = await self._rek_client.delete_faces(
+                CollectionId = self._config["collection_id"],
+                FaceIds = face_ids[i:i + RekognitionClient.DELETE_FACES_MAX]
+            )
+            deleted.extend(resp["DeletedFaces"])
 
-        return resp["DeletedFaces"]
+        return deleted
 
     async def remove_all_indexed_faces(self):
         """Removes all faces from the default face collection/index"""
-        idx_face_ids = Enumerable(await self._rek_client.get_indexed_faces()) \
-            .select(func=lambda f: f["FaceId"]) \
-            .to_list()
-        if idx_face_ids:
-            return self.remove_indexed_faces(idx_face_ids)
+        idx_face_ids = [f["FaceId"] async for f in self.get_indexed_faces()]
+        return await self.remove_indexed_faces(idx_face_ids)
 
-    async def match_face_from_image(self, img_file: IO) -> Dict:
+    async def match_face_from_image(self, img_file: IO, max_faces: int = 1
+        , exclude: Optional[Callable[[Dict], bool]] = None) -> Dict:
         """Attempt to match the provided image to the existing rekognition face index.
-        Returns the single highest ranked match or an empty face match list if the image
-        was not matched. There are cases when the detectfaces call returns a low quality
+        Returns the highest ranked of up to max_faces matches whose face isn't excluded, or None
+        if the image was not matched. There are cases when the detectfaces call returns a low quality
         face that is then not picked up by the search_faces_by_image call. In this case
         the latter responds with the InvalidParameterException--this is caught and "None"
         is returned"""
@@ -115,15 +146,26 @@ class RekognitionClient():
             resp = await self._rek_client.search_faces_by_image(
                 CollectionId = self._config["collection_id"],
                 Image = {"Bytes": img_file.read()},
-                MaxFaces = 1
+                MaxFaces = max_faces
             )
 
         except self._rek_client.exceptions.InvalidParameterException:
             self.logger.info("No faces detected")
             return None
 
-        if resp["FaceMatches"]:
-            return resp["FaceMatches"][0]
+        return next((m for m in resp["FaceMatches"] if not exclude or not exclude(m["Face"])), None)
+
+    async def search_faces(self, face_id: str, max_faces: int = 10) -> List[Dict]:
+        """Searches the default face collection/index for faces matching a face that is
+        already in it. Returns the face matches ranked by similarity, never including the
+        searched face itself"""
+        resp = await self._rek_client.search_faces(
+            CollectionId = self._config["collection_id"],
+            FaceId = face_id,
+            MaxFaces = max_faces
+        )
+
+        return resp["FaceMatches"]
 
     async def describe_collection(self):
         """Gets metadata for the default face collection/index"""
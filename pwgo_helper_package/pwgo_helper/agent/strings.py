@@ -2,12 +2,19 @@
 LOG_ADD_IMG_FACES = lambda fname: f"adding faces from {fname} to face index"
 LOG_DETECT_IMG_FACES = lambda fname: f"detecting faces in {fname}"
 LOG_MOVE_IMG = lambda fname: f"Moving {fname} from autotag to processed auto tag album"
+LOG_APPLY_LABEL_TAGS = lambda n: f"applying {n} label tags to previously autotagged images"
+LOG_TAG_REWRITE_BEGIN = lambda tag_id, n: f"rewriting keywords for {n} images tagged {tag_id}"
+LOG_AUTOTAG_BACKLOG_BEGIN = lambda n, last_id: f"processing {n} autotag backlog images after image {last_id}"
 LOG_QUEUE_EVT = "EventDispatcher: queuing event"
 LOG_HANDLE_SIG = lambda sig: f"MetadataAgent: handling signal {sig}"
 LOG_WORKER_ERRORS = lambda n: f"{n} workers encountered problems."
-LOG_VFS_REBUILD_REMOVE = lambda path: f"removing all filesystem objects from {path}"
-LOG_VFS_REBUILD_CREATE = lambda n: f"recreating virtualfs symlinks from {n} database rows"
+LOG_VFS_REBUILD_REMOVE = lambda path: f"removing stale filesystem objects from {path}"
+LOG_VFS_REBUILD_CREATE = lambda n: f"creating {n} missing virtualfs links"
+LOG_VFS_MISSING_SOURCE = lambda virt, src: f"{src} does not exist. skipping virtual path {virt}"
+LOG_VFS_STAGED_BUILD = lambda n, path: f"building {n} virtualfs symlinks in staging directory {path}"
+LOG_VFS_STAGING_FALLBACK = lambda root, reason: f"can't stage a rebuild of {root}, {reason}. reconciling it instead"
 LOG_INITIALIZE_DB = "Running database initialization"
+LOG_VFS_FANOUT_IGNORED = "--virtualfs-fanout only takes effect with --initialize-db. keeping the current layout"
 LOG_AGNT_OPT = lambda k,v: f"initializing agent config with {k}={v}"
 AGNT_STOP_TASK_NM = "agent-stopping-task"
 DSPCH_STOP_TASK_NM = "dispatcher-stopping-task"
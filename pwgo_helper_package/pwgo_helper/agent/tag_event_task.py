@@ -6,14 +6,18 @@ import asyncio
 from .autotagger import AutoTagger
 from .event_task import EventTask, EventTaskStatus
 from .database_event_row import TagEventRow
+from .tag_metadata_rewriter import TagMetadataRewriter
+from .virtualfs_views import VirtualFsViews
 
 class TagEventTask(EventTask):
-    """Manages the handling of new or deleted tags in the database"""
+    """Manages the handling of new, renamed, or deleted tags in the database"""
     _pending_tasks: list[EventTask] = []
 
-    def __init__(self, tag_id):
+    def __init__(self, tag_id, operation="INSERT", update_vals=None):
         super().__init__()
         self.tag_id = tag_id
+        self.operation = operation
+        self.update_vals = update_vals or {}
         self._tag_task = None
 
     @classmethod
@@ -31,7 +35,7 @@ class TagEventTask(EventTask):
         """this class doesn't require any complex resolution logic so we
         just create a new instance and set it as a result on a Future"""
         result_fut = asyncio.Future()
-        result_fut.set_result(TagEventTask(evt.tag_id))
+        result_fut.set_result(TagEventTask(evt.tag_id, evt.db_event_type, evt.db_event_data.get("UPDATE")))
         return result_fut
 
     def schedule_start(self):
@@ -43,12 +47,27 @@ class TagEventTask(EventTask):
     async def _handle_tag_event(self):
         self.status = EventTaskStatus.EXEC
         action = self._get_action()
-        await action[0](*action[1])
+        if action:
+            await action[0](*action[1])
         self.status = EventTaskStatus.DONE
 
     def _get_action(self):
+        if self.operation == "UPDATE":
+            return (self._handle_tag_rename, [])
+        if self.operation == "DELETE":
+            # piwigo removes the image_tag rows before deleting the tag, so the
+            # affected files are rewritten by the resulting image_tag events
+            self._logger.debug("tag %s deleted. no action required.", self.tag_id)
+            return None
         return (AutoTagger.process_new_tag, [self.tag_id])
 
+    async def _handle_tag_rename(self):
+        await TagMetadataRewriter.rewrite_tag_keywords(self.tag_id)
+        before = self.update_vals.get("before", {}).get("name")
+        after = self.update_vals.get("after", {}).get("name")
+        if before and after:
+            await VirtualFsViews.rename_tag(self.tag_id, before, after)
+
     async def _execute_task(self):
         res = await self._tag_task
         return res
@@ -0,0 +1,139 @@
+"""container module for TagMetadataRewriter"""
+from __future__ import annotations
+
+import asyncio, json
+
+from . import strings
+from ..config import Configuration as ProgramConfig
+from .config import Configuration as AgentConfig
+from ..db_connection_pool import DbConnectionPool
+from .pwgo_image import PiwigoImage, PiwigoImageMetadata
+from .file_metadata_writer import FileMetadataWriter
+from .paged_image_job import PagedImageJob
+
+class TagMetadataRewriter(PagedImageJob):
+    """Rewrites the keywords of every file tagged with a given tag. Used when a tag
+    is renamed so the new name makes it into the file metadata. Images are streamed
+    from image_tag in pages and written with a bounded number of concurrent writes.
+    Progress is checkpointed in the tag_keyword_rewrite table so an interrupted
+    rewrite can be resumed when the agent restarts."""
+    PROGRESS_MSG = "rewrote keywords for %s of %s images tagged %s, %s failed (eta %.0fs)"
+    FAILURE_MSG = "unable to rewrite keywords of image %s"
+    _active: set[int] = set()
+    _restart: set[int] = set()
+
+    @classmethod
+    async def rewrite_tag_keywords(cls, tag_id: int) -> None:
+        """rewrites the keywords of all images tagged with the given tag. If a rewrite
+        of the tag is already running it is restarted from the beginning instead."""
+        if tag_id in cls._active:
+            cls.get_logger().info("keyword rewrite for tag %s is already running. restarting it.", tag_id)
+            cls._restart.add(tag_id)
+            return
+
+        pcfg = ProgramConfig.get()
+        async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.msg_db_name) as (cur,conn):
+            sql = """
+                INSERT INTO tag_keyword_rewrite (tag_id, last_image_id)
+                VALUES (%s, 0)
+                ON DUPLICATE KEY UPDATE last_image_id = 0, started = CURRENT_TIMESTAMP()
+            """
+            await cur.execute(sql, (tag_id,))
+            await conn.commit()
+
+        await cls._rewrite(tag_id, 0)
+
+    @classmethod
+    async def resume_pending(cls) -> None:
+        """resumes any keyword rewrites that were interrupted before they completed"""
+        pcfg = ProgramConfig.get()
+        async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.msg_db_name) as (cur,_):
+            await cur.execute("SELECT tag_id, last_image_id FROM tag_keyword_rewrite")
+            pending = await cur.fetchall()
+
+        for row in pending:
+            cls.get_logger().info("resuming keyword rewrite for tag %s after image %s"
+                , row["tag_id"], row["last_image_id"])
+            await cls._rewrite(row["tag_id"], row["last_image_id"])
+
+    @classmethod
+    async def _rewrite(cls, tag_id: int, last_image_id: int) -> None:
+        pcfg = ProgramConfig.get()
+        acfg = AgentConfig.get()
+        cls._active.add(tag_id)
+        try:
+            done, failed = await cls._run_pages(tag_id, last_image_id
+                , acfg.metadata_rewrite_workers, acfg.metadata_rewrite_page_size)
+
+            async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.msg_db_name) as (cur,conn):
+                await cur.execute("DELETE FROM tag_keyword_rewrite WHERE tag_id = %s", (tag_id,))
+                await conn.commit()
+            cls.get_logger().info("finished keyword rewrite for tag %s: %s images, %s failed", tag_id, done, failed)
+
+        finally:
+            cls._active.discard(tag_id)
+
+    @classmethod
+    def _log_begin(cls, key: int, total: int, last_image_id: int) -> None:
+        cls.get_logger().info(strings.LOG_TAG_REWRITE_BEGIN(key, total))
+
+    @classmethod
+    def _take_restart(cls, key: int) -> bool:
+        if key in cls._restart:
+            cls._restart.discard(key)
+            return True
+        return False
+
+    @classmethod
+    async def _count_remaining(cls, key: int, last_image_id: int) -> int:
+        pcfg = ProgramConfig.get()
+        async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.pwgo_db_name) as (cur,_):
+            sql = """
+                SELECT COUNT(*) AS cnt
+                FROM image_tag
+                WHERE key = %s AND image_id > %s
+            """
+            await cur.execute(sql, (key, last_image_id))
+            return (await cur.fetchone())["cnt"]
+
+    @classmethod
+    async def _get_page(cls, key: int, last_image_id: int, page_size: int) -> list[PiwigoImage]:
+        pcfg = ProgramConfig.get()
+        async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.pwgo_db_name) as (cur,_):
+            sql = """
+                SELECT i.id, i.file, i.path, im.image_metadata
+                FROM image_tag it
+                JOIN images i
+                ON i.id = it.image_id
+                JOIN image_metadata im
+                ON im.id = it.image_id
+                WHERE it.key = %s AND it.image_id > %s
+                ORDER BY it.image_id
+                LIMIT %s
+            """
+            await cur.execute(sql, (key, last_image_id, page_size))
+            return [
+                PiwigoImage(id=row["id"], file=row["file"], path=row["path"],
+                    metadata=PiwigoImageMetadata(json.loads(row["image_metadata"])))
+                for row in await cur.fetchall()
+            ]
+
+    @classmethod
+    async def _checkpoint(cls, key: int, last_image_id: int) -> None:
+        pcfg = ProgramConfig.get()
+        async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.msg_db_name) as (cur,conn):
+            sql = """
+                UPDATE tag_keyword_rewrite
+                SET last_image_id = %s
+                WHERE key = %s
+            """
+            await cur.execute(sql, (last_image_id, key))
+            await conn.commit()
+
+    @classmethod
+    async def _handle_image(cls, img: PiwigoImage) -> None:
+        """rewrites the keywords of a single image"""
+        if not ProgramConfig.get().dry_run:
+            loop = asyncio.get_running_loop()
+            with FileMetadataWriter(img) as writer:
+                await loop.run_in_executor(None, writer.write, {"tags"})
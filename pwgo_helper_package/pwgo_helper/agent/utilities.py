@@ -1,5 +1,5 @@
 """Contains utility functions"""
-import uuid, asyncio, os
+import uuid, asyncio, os, ctypes, errno
 from io import BytesIO, FileIO
 from typing import Tuple, IO, Dict
 from json import JSONDecoder
@@ -19,6 +19,9 @@ def get_pwgo_fs(phys_fs=None):
     phys_fs = phys_fs or fs.open_fs(AgentConfig.get().piwigo_galleries_host_path)
     pgfs = MountFS()
     pgfs.mount(str(Path.joinpath(AgentConfig.get().pwgo_gallery_virt_path, "galleries")), phys_fs)
+    if AgentConfig.get().piwigo_data_host_path:
+        data_fs = fs.open_fs(AgentConfig.get().piwigo_data_host_path)
+        pgfs.mount(str(Path.joinpath(AgentConfig.get().pwgo_gallery_virt_path, "_data")), data_fs)
     return pgfs
 
 def map_pwgo_path(pwgo_rel_path):
@@ -41,21 +44,43 @@ def convert_pct_bounding_box(img_dimen: Dimension, bounding_box: Bounding) -> Bo
 
 def get_scaled_image(file: IO, max_size: tuple[int,int]) -> IO:
     """generate a scaled version of the given file"""
-    with Image.open(file) as org_img:
-        scaled_img = org_img.copy()
-        scaled_img.thumbnail(max_size, Image.ANTIALIAS)
-        scaled_img_bytes = BytesIO()
-        scaled_img.save(scaled_img_bytes, format="JPEG")
-        scaled_img_bytes.seek(0)
+    return encode_jpeg(scale_image(file, max_size))
 
-        return scaled_img_bytes
+def scale_image(file: IO, max_size: tuple[int,int]) -> Image.Image:
+    """decodes the given file into an image that fits within max_size. JPEGs are decoded
+    straight to a reduced DCT scale so the full resolution bitmap is never materialized"""
+    with Image.open(file) as org_img:
+        size = fit_size(org_img.size, max_size)
+        # only has an effect on JPEGs. the decoder picks the smallest 1/2, 1/4 or 1/8
+        # scale that is still at least the requested size
+        org_img.draft(None, size)
+        # reducing_gap shrinks by an integer factor with reduce() before the final resample
+        return org_img.resize(size, Image.LANCZOS, reducing_gap=3.0)
+
+def fit_size(size: Dimension, max_size: Dimension) -> Dimension:
+    """gets the largest size with the same aspect ratio that fits within max_size.
+    sizes that already fit are returned unchanged"""
+    ratio = min(max_size[0] / size[0], max_size[1] / size[1], 1)
+    return (max(round(size[0] * ratio), 1), max(round(size[1] * ratio), 1))
+
+def encode_jpeg(img: Image.Image) -> IO:
+    """encodes an image as an in memory JPEG file"""
+    img_bytes = BytesIO()
+    img.save(img_bytes, format="JPEG")
+    img_bytes.seek(0)
+    return img_bytes
 
 def get_cropped_image(file: IO, box: Bounding) -> IO:
     """generates a cropped image file from an exisiting image file using the specified
     bounding box--the bounding box is expected as a rekognition (left, top, width, height) box"""
     with Image.open(file) as img:
-        px_box = convert_pct_bounding_box(img.size, box)
-        cropped = img.crop(px_box)
+        return crop_image(img, box)
+
+def crop_image(img: Image.Image, box: Bounding) -> IO:
+    """generates a cropped image file from an already decoded image using the specified
+    rekognition bounding box"""
+    px_box = convert_pct_bounding_box(img.size, box)
+    cropped = img.crop(px_box)
 
     if AgentConfig.get().image_crop_save_path:
         f_path = os.path.join(AgentConfig.get().image_crop_save_path, f"{uuid.uuid4()}.JPEG")
@@ -68,6 +93,28 @@ def get_cropped_image(file: IO, box: Bounding) -> IO:
 
     return cropped_file
 
+_AT_FDCWD = -100
+_RENAME_EXCHANGE = 2
+
+def exchange_paths(path_a: str, path_b: str) -> bool:
+    """atomically swaps two paths using renameat2(RENAME_EXCHANGE). falls back to a sequence
+    of plain renames when the call isn't available. returns whether the swap was atomic"""
+    libc = ctypes.CDLL(None, use_errno=True)
+    renameat2 = getattr(libc, "renameat2", None)
+    if renameat2:
+        res = renameat2(_AT_FDCWD, os.fsencode(path_a), _AT_FDCWD, os.fsencode(path_b), _RENAME_EXCHANGE)
+        if res == 0:
+            return True
+        err = ctypes.get_errno()
+        if err not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+            raise OSError(err, os.strerror(err), path_a, None, path_b)
+
+    tmp_path = f"{path_b}.pwgo-swap-{uuid.uuid4().hex}"
+    os.rename(path_b, tmp_path)
+    os.rename(path_a, path_b)
+    os.rename(tmp_path, path_a)
+    return False
+
 def delayed_task_generator(coro, *args, delay=0, **kwargs):
     """generator function which accepts a coroutine and yields back a
     sleep task with given <delay>."""
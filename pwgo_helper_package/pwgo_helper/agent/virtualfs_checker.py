@@ -0,0 +1,197 @@
+"""container module for VirtualFsChecker"""
+from __future__ import annotations
+
+import os, asyncio
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import click
+
+from . import strings
+from ..config import Configuration as ProgramConfig
+from .config import Configuration as AgentConfig
+from ..db_connection_pool import DbConnectionPool as DbPool
+from .virtualfs_link_builder import VirtualFsLinkBuilder
+from .virtualfs_paths import VirtualFsPaths
+from ..asyncio import get_task
+
+class VirtualFsChecker():
+    """Compares the virtualfs tree on disk with the expected mapping of virtual paths to
+    source paths and optionally repairs the differences. Directories are scanned in
+    parallel and each entry is checked from the scanning thread."""
+    ISSUE_TYPES = ["missing", "extra", "wrong_target", "broken", "extra_dirs"]
+
+    def __init__(self, vfs_root: str, expected: dict[str, str], workers: int=None):
+        self.vfs_root = os.path.abspath(vfs_root)
+        self.expected = expected
+        self.workers = workers or AgentConfig.get().virtualfs_rebuild_workers
+        self.current: set[str] = set()
+        self._link_builder = VirtualFsLinkBuilder(workers=self.workers)
+
+    @staticmethod
+    def get_logger():
+        """gets a logger..."""
+        return ProgramConfig.get().get_logger(__name__)
+
+    @classmethod
+    def resolve_link_type(cls, vfs_root: str, expected: dict[str, str], wanted: str=None, fix: bool=False) -> str:
+        """works out the link type to check the virtualfs against. without a wanted type, or
+        with auto, the type the existing tree was built with is used. fixing a tree built with
+        a different type than the wanted one is refused since it would relink every entry.
+        link support is only probed when fixing so a report doesn't write to the virtualfs"""
+        acfg = AgentConfig.get()
+        tree_type = VirtualFsLinkBuilder.find_tree_link_type(vfs_root, expected)
+        if wanted in [None, "auto"]:
+            link_type = tree_type or wanted or "symlink"
+        else:
+            link_type = wanted
+            if tree_type and tree_type != wanted:
+                msg = f"the virtual fs is built with {tree_type} links but {wanted} links were requested"
+                if fix:
+                    raise click.ClickException(f"{msg}. refusing to fix.")
+                cls.get_logger().warning(msg)
+
+        acfg.virtualfs_link_type = link_type
+        if fix:
+            link_type = VirtualFsLinkBuilder.detect_link_type()
+        elif link_type == "auto":
+            # an empty tree has nothing to compare link types against
+            acfg.virtualfs_link_type = link_type = "symlink"
+        return link_type
+
+    def check(self) -> dict[str, list[str]]:
+        """scans the virtualfs and returns the paths of each kind of problem found"""
+        found, dirs = self._walk()
+        expected_dirs = set()
+        for virt_path in self.expected:
+            parent = os.path.dirname(virt_path)
+            while parent.startswith(self.vfs_root + os.sep) and parent not in expected_dirs:
+                expected_dirs.add(parent)
+                parent = os.path.dirname(parent)
+
+        self.current = {p for p, is_current in found.items() if is_current}
+        missing_sources = self._link_builder.find_missing_sources(self.expected.values())
+        return {
+            "missing": [p for p in self.expected if p not in found],
+            "extra": [p for p in found if p not in self.expected],
+            "wrong_target": [p for p, is_current in found.items() if p in self.expected and not is_current],
+            "broken": [p for p, src in self.expected.items() if src in missing_sources],
+            "extra_dirs": [d for d in dirs if d not in expected_dirs]
+        }
+
+    def fix(self, report: dict[str, list[str]]) -> list[str]:
+        """removes extra and incorrect entries and creates the missing links from a check
+        report. returns the paths of the links created"""
+        logger = self.get_logger()
+        dry_run = ProgramConfig.get().dry_run
+        logger.debug(strings.LOG_VFS_REBUILD_REMOVE(self.vfs_root))
+        for path in report["extra"] + report["wrong_target"]:
+            logger.debug("removing stale virtualfs entry %s", path)
+            if not dry_run:
+                os.unlink(path)
+        # deepest directories first so parents are empty by the time they're removed
+        for directory in sorted(report["extra_dirs"], key=len, reverse=True):
+            logger.debug("removing unexpected directory %s", directory)
+            if not dry_run:
+                os.rmdir(directory)
+
+        create = report["missing"] + report["wrong_target"]
+        logger.debug(strings.LOG_VFS_REBUILD_CREATE(len(create)))
+        return self._link_builder.build((p, self.expected[p]) for p in create)
+
+    def _walk(self) -> tuple[dict[str, bool], list[str]]:
+        """walks the virtualfs from a pool of threads, one directory per task. returns
+        whether each non directory entry is a current link and the list of directories"""
+        found = {}
+        dirs = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = {executor.submit(self._scan_dir, self.vfs_root)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    entries, subdirs = fut.result()
+                    found.update(entries)
+                    dirs.extend(subdirs)
+                    pending.update(executor.submit(self._scan_dir, d) for d in subdirs)
+
+        return found, dirs
+
+    def _scan_dir(self, directory: str) -> tuple[dict[str, bool], list[str]]:
+        entries = {}
+        subdirs = []
+        with os.scandir(directory) as dir_entries:
+            for entry in dir_entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                    continue
+                target = self.expected.get(entry.path)
+                entries[entry.path] = bool(target) and self._link_builder.is_current(entry, target)
+
+        return entries, subdirs
+
+@click.command("virtualfs-check")
+@click.option(
+    "--piwigo-galleries-host-path",
+    help="Host path of the piwigo galleries folder",
+    required=True, type=click.Path(exists=True,file_okay=False)
+)
+@click.option(
+    "--virtualfs-root",
+    help="path to the root of the album-based virtual filesystem",
+    required=True, type=click.Path(exists=True,file_okay=False)
+)
+@click.option(
+    "--virtualfs-category-id",
+    help="the root category for the virtual fs. subcategories of the specified category will be included",
+    type=int, default=0
+)
+@click.option(
+    "--virtualfs-link-type",
+    help="""the type of links used in the virtual fs. detected from the existing tree when not given.
+    fixing a tree that was built with a different type is refused""",
+    type=click.Choice(["symlink", "hardlink", "reflink", "auto"])
+)
+@click.option(
+    "--virtualfs-views",
+    help="the additional trees maintained in the virtual fs",
+    type=click.Choice(["tags", "dates"]), multiple=True
+)
+@click.option(
+    "--workers",
+    help="Number of threads used to scan the virtual fs",
+    type=int, default=16
+)
+@click.option(
+    "--fix",
+    help="repair the problems that are found",
+    is_flag=True
+)
+def virtualfs_check_entry(**kwargs):
+    """Checks the virtual fs against the image virtual paths in the piwigo database"""
+    logger = ProgramConfig.get().get_logger(__name__)
+
+    async def exec_check():
+        prg_cfg = ProgramConfig.get()
+        async with DbPool.initialize(**prg_cfg.db_config):
+            AgentConfig.initialize_virtualfs(**kwargs, virtualfs_rebuild_workers=kwargs["workers"])
+            loop = asyncio.get_running_loop()
+            expected = await VirtualFsPaths.get_expected_paths()
+            await loop.run_in_executor(None, VirtualFsChecker.resolve_link_type
+                , kwargs["virtualfs_root"], expected, kwargs["virtualfs_link_type"], kwargs["fix"])
+            checker = VirtualFsChecker(kwargs["virtualfs_root"], expected)
+            report = await loop.run_in_executor(None, checker.check)
+            for issue in VirtualFsChecker.ISSUE_TYPES:
+                for path in report[issue]:
+                    logger.debug("%s: %s", issue, path)
+                click.echo(f"{issue}: {len(report[issue])}")
+            if kwargs["fix"]:
+                created = await loop.run_in_executor(None, checker.fix, report)
+                click.echo(f"fixed: {len(created)} links created")
+            return report
+
+    loop = asyncio.get_event_loop()
+    loop.set_task_factory(get_task)
+    report = loop.run_until_complete(exec_check())
+    # broken links point at missing source files which can't be repaired here
+    fixable = [i for i in VirtualFsChecker.ISSUE_TYPES if i != "broken"]
+    if not kwargs["fix"] and any(report[i] for i in fixable):
+        click.get_current_context().exit(1)
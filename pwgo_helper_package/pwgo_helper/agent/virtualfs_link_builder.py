@@ -0,0 +1,232 @@
+"""container module for VirtualFsLinkBuilder"""
+from __future__ import annotations
+
+import os, uuid, fcntl
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
+
+from ..config import Configuration as ProgramConfig
+from .config import Configuration as AgentConfig
+
+# linux ioctl used to clone a file's extents on copy-on-write filesystems (btrfs, xfs...)
+FICLONE = 0x40049409
+
+def create_symlink(src_path: str, link_path: str) -> None:
+    """creates a symbolic link to the source file"""
+    os.symlink(src_path, link_path)
+
+def create_hardlink(src_path: str, link_path: str) -> None:
+    """creates a hard link to the source file. both paths must be on the same filesystem"""
+    os.link(src_path, link_path)
+
+def create_reflink(src_path: str, link_path: str) -> None:
+    """creates a copy-on-write clone of the source file. the clone gets the source's
+    timestamps so it can be recognized as current later on"""
+    try:
+        with open(src_path, "rb") as src_file, open(link_path, "xb") as link_file:
+            fcntl.ioctl(link_file.fileno(), FICLONE, src_file.fileno())
+    except OSError:
+        if os.path.lexists(link_path):
+            os.unlink(link_path)
+        raise
+
+    src_stat = os.stat(src_path)
+    os.utime(link_path, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+
+LINK_CREATORS = {
+    "symlink": create_symlink,
+    "hardlink": create_hardlink,
+    "reflink": create_reflink
+}
+
+class VirtualFsLinkBuilder():
+    """Creates virtualfs links in batches. Each distinct directory is created once, the
+    source files are checked with a single listing per source directory and the links
+    themselves are created from a thread pool. Links are created with the strategy
+    set by virtualfs_link_type."""
+    def __init__(self, workers: int=None, chunk_size: int=None, link_type: str=None):
+        acfg = AgentConfig.get()
+        self.workers = workers or acfg.virtualfs_rebuild_workers
+        self.chunk_size = chunk_size or acfg.virtualfs_link_chunk_size
+        self.link_type = link_type or acfg.virtualfs_link_type
+        if self.link_type not in LINK_CREATORS:
+            raise ValueError(f"unsupported virtualfs link type {self.link_type}")
+        self._known_dirs: set[str] = set()
+        self._dir_listings: dict[str, set[str]] = {}
+
+    @staticmethod
+    def get_logger():
+        """gets a logger..."""
+        return ProgramConfig.get().get_logger(__name__)
+
+    @classmethod
+    def detect_link_type(cls) -> str:
+        """works out which link type to use for the virtualfs. auto picks the first of
+        hardlink, reflink and symlink that works between the galleries and the virtualfs
+        root. reflinks are only picked in a dry run since a clone doesn't see the metadata
+        written to its source file afterwards. an explicitly requested type that doesn't
+        work falls back to symlink. the result is stored in virtualfs_link_type"""
+        logger = cls.get_logger()
+        acfg = AgentConfig.get()
+        wanted = acfg.virtualfs_link_type
+        candidates = [wanted]
+        if wanted == "auto":
+            candidates = ["hardlink", "reflink", "symlink"] if ProgramConfig.get().dry_run else ["hardlink", "symlink"]
+        probe_src = cls._find_probe_source(acfg.piwigo_galleries_host_path)
+        resolved = next((t for t in candidates
+            if t == "symlink" or cls._probe(t, probe_src, acfg.virtualfs_root)), "symlink")
+        if wanted not in ["auto", resolved]:
+            logger.warning("%s links are not supported for the virtualfs. falling back to %s links."
+                , wanted, resolved)
+        logger.info("using %s links for the virtualfs", resolved)
+        acfg.virtualfs_link_type = resolved
+        return resolved
+
+    @staticmethod
+    def _find_probe_source(galleries_path: str) -> Optional[str]:
+        if not galleries_path:
+            return None
+        for dir_path, _, files in os.walk(galleries_path):
+            if files:
+                return os.path.join(dir_path, files[0])
+        return None
+
+    @classmethod
+    def _probe(cls, link_type: str, src_path: Optional[str], vfs_root: str) -> bool:
+        if not src_path or not vfs_root:
+            return False
+        probe_path = os.path.join(vfs_root, f".pwgo-probe-{uuid.uuid4().hex}")
+        try:
+            LINK_CREATORS[link_type](src_path, probe_path)
+            return True
+        except OSError as err:
+            cls.get_logger().debug("%s links are unavailable: %s", link_type, err)
+            return False
+        finally:
+            if os.path.lexists(probe_path):
+                os.unlink(probe_path)
+
+    @staticmethod
+    def find_tree_link_type(vfs_root: str, expected: dict[str, str], sample_size: int=20) -> Optional[str]:
+        """works out the link type an existing virtualfs tree was built with from a sample
+        of its entries. returns None if the tree has no links to go by"""
+        counts = Counter()
+        pending = [os.path.abspath(vfs_root)]
+        while pending and sum(counts.values()) < sample_size:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif entry.is_symlink():
+                        counts["symlink"] += 1
+                    elif entry.path in expected and os.path.exists(expected[entry.path]):
+                        src_stat = os.stat(expected[entry.path])
+                        entry_stat = entry.stat(follow_symlinks=False)
+                        is_same_file = (entry_stat.st_dev, entry_stat.st_ino) == (src_stat.st_dev, src_stat.st_ino)
+                        counts["hardlink" if is_same_file else "reflink"] += 1
+
+        return counts.most_common(1)[0][0] if counts else None
+
+    def is_current(self, entry: os.DirEntry, src_path: str) -> bool:
+        """checks whether an existing virtualfs entry is a valid link to the source file
+        for the link type in use"""
+        if self.link_type == "symlink":
+            return entry.is_symlink() and os.readlink(entry.path) == src_path
+        if entry.is_symlink():
+            return False
+
+        try:
+            src_stat = os.stat(src_path)
+        except FileNotFoundError:
+            return False
+        entry_stat = entry.stat(follow_symlinks=False)
+        is_same_file = (entry_stat.st_dev, entry_stat.st_ino) == (src_stat.st_dev, src_stat.st_ino)
+        if self.link_type == "hardlink":
+            return is_same_file
+        # a reflink is its own file, so it's current if it still matches the source
+        return not is_same_file and entry_stat.st_size == src_stat.st_size \
+            and entry_stat.st_mtime_ns == src_stat.st_mtime_ns
+
+    def build(self, links: Iterable[tuple[str, str]]) -> list[str]:
+        """creates a link at each link path to its source path. links are given as
+        (link path, source path) pairs. returns the paths of the links created"""
+        links = list(links)
+        if not links:
+            return []
+
+        missing = self.check_sources(src_path for _, src_path in links)
+        if missing and self.link_type != "symlink":
+            # only symlinks can point at a file that isn't there
+            links = [(l, s) for l, s in links if s not in missing]
+        if ProgramConfig.get().dry_run:
+            return []
+
+        for link_path, _ in links:
+            self.ensure_dir(os.path.dirname(link_path))
+
+        chunks = [links[i:i + self.chunk_size] for i in range(0, len(links), self.chunk_size)]
+        if len(chunks) == 1:
+            # not worth starting threads for a small batch
+            self._create_links(chunks[0])
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(chunks))) as executor:
+                for _ in executor.map(self._create_links, chunks):
+                    pass
+
+        return [link_path for link_path, _ in links]
+
+    def ensure_dir(self, directory: str) -> None:
+        """creates the directory and any parents unless it's already known to exist"""
+        if directory in self._known_dirs:
+            return
+
+        os.makedirs(directory, exist_ok=True)
+        while directory not in self._known_dirs and directory != os.path.dirname(directory):
+            self._known_dirs.add(directory)
+            directory = os.path.dirname(directory)
+
+    def check_sources(self, src_paths: Iterable[str]) -> set[str]:
+        """verifies the source files exist. missing sources are logged or raised depending
+        on virtualfs_allow_broken_links. returns the missing source paths"""
+        broken_msg = "%s does not exist"
+        missing = self.find_missing_sources(src_paths)
+        if missing and not AgentConfig.get().virtualfs_allow_broken_links:
+            raise FileNotFoundError(broken_msg % next(iter(missing)))
+        for src_path in missing:
+            self.get_logger().warning(broken_msg, src_path)
+
+        return missing
+
+    def find_missing_sources(self, src_paths: Iterable[str]) -> set[str]:
+        """finds the source files that don't exist by listing each distinct source
+        directory once. the listings are read in parallel. sources from a directory with
+        only a few of them are checked individually so a handful of new images doesn't
+        list an entire large album"""
+        src_paths = list(src_paths)
+        dir_counts = Counter(os.path.dirname(p) for p in src_paths)
+        listing_min = AgentConfig.get().virtualfs_source_listing_min
+        new_dirs = [d for d, cnt in dir_counts.items() if cnt >= listing_min and d not in self._dir_listings]
+        if new_dirs:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(new_dirs))) as executor:
+                self._dir_listings.update(zip(new_dirs, executor.map(self._list_dir, new_dirs)))
+
+        return {p for p in src_paths if not self._source_exists(p)}
+
+    def _source_exists(self, src_path: str) -> bool:
+        listing = self._dir_listings.get(os.path.dirname(src_path))
+        if listing is None:
+            return os.path.exists(src_path)
+        return os.path.basename(src_path) in listing
+
+    @staticmethod
+    def _list_dir(directory: str) -> set[str]:
+        try:
+            return set(os.listdir(directory))
+        except (FileNotFoundError, NotADirectoryError):
+            return set()
+
+    def _create_links(self, chunk: list[tuple[str, str]]) -> None:
+        create_link = LINK_CREATORS[self.link_type]
+        for link_path, src_path in chunk:
+            create_link(src_path, link_path)
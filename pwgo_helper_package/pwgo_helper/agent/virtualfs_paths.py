@@ -0,0 +1,56 @@
+"""container module for VirtualFsPaths"""
+from __future__ import annotations
+
+import os
+
+from ..config import Configuration as ProgramConfig
+from .config import Configuration as AgentConfig
+from ..db_connection_pool import DbConnectionPool
+from .virtualfs_views import VirtualFsViews
+
+class VirtualFsPaths():
+    """Resolves the virtual and physical paths stored in the piwigo db to filesystem paths
+    and builds the expected contents of the virtualfs. Shared by the virtual path event
+    task and the virtualfs checker."""
+    @staticmethod
+    def get_logger():
+        """gets a logger..."""
+        return ProgramConfig.get().get_logger(__name__)
+
+    @staticmethod
+    def resolve_source_path(physical_path: str) -> str:
+        """resolves a physical path from the piwigo db against the galleries host path.
+        paths are joined as strings so no working directory change is needed"""
+        return os.path.normpath(os.path.join(
+            os.path.abspath(AgentConfig.get().piwigo_galleries_host_path), physical_path))
+
+    @staticmethod
+    def resolve_virtual_path(virtual_path: str) -> str:
+        """resolves a virtual path from the piwigo db against the virtualfs root"""
+        return os.path.normpath(os.path.join(
+            os.path.abspath(AgentConfig.get().virtualfs_root), virtual_path))
+
+    @classmethod
+    async def get_expected_paths(cls) -> dict[str, str]:
+        """streams the image virtual paths from the db and resolves them to a mapping
+        of virtualfs paths to source paths. links of any enabled tag or date views
+        are included"""
+        sql = """
+            SELECT virtual_path, physical_path
+            FROM image_virtual_paths
+        """
+        args = None
+        vfs_root_category_id = AgentConfig.get().virtualfs_category_id
+        if vfs_root_category_id:
+            # if there's a root category set then only stream its descendents
+            sql += " WHERE FIND_IN_SET(%s, category_uppercats)"
+            args = (vfs_root_category_id,)
+
+        cls.get_logger().debug("streaming image virtual paths from db")
+        expected = {}
+        rows = DbConnectionPool.get().stream_dict_rows(sql, args, db=ProgramConfig.get().pwgo_db_name)
+        async for row in rows:
+            expected[cls.resolve_virtual_path(row["virtual_path"])] = cls.resolve_source_path(row["physical_path"])
+        async for row in VirtualFsViews.stream_view_paths():
+            expected[cls.resolve_virtual_path(row["virtual_path"])] = cls.resolve_source_path(row["physical_path"])
+        return expected
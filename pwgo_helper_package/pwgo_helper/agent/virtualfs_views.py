@@ -0,0 +1,280 @@
+"""container module for VirtualFsViews"""
+from __future__ import annotations
+
+import os
+from datetime import datetime
+from typing import AsyncIterator, Awaitable, Callable, Optional, Union
+
+from ..config import Configuration as ProgramConfig
+from .config import Configuration as AgentConfig
+from ..db_connection_pool import DbConnectionPool
+from .database_event_row import ImageEventRow
+
+class VirtualFsViews():
+    """Maintains the optional tag and date trees of the virtualfs. The trees are built with
+    the rest of the virtualfs by the rebuild and afterwards are kept up to date from image
+    tag, image date and tag name changes. When the virtualfs is limited to a root category
+    an image's view links also follow it in and out of the albums under that category.
+    The changes are queued as virtual path events so they are batched with, and go through
+    the same filesystem handling as, album changes."""
+    _queue_events: Optional[Callable[[list[ImageEventRow]], Awaitable[None]]] = None
+
+    @staticmethod
+    def get_logger():
+        """gets a logger..."""
+        return ProgramConfig.get().get_logger(__name__)
+
+    @staticmethod
+    def is_enabled(view: str) -> bool:
+        """is the given view (tags or dates) enabled"""
+        return view in (AgentConfig.get().virtualfs_views or ())
+
+    @staticmethod
+    def tag_virtual_path(tag_name: str, image_id: int, file: str) -> str:
+        """gets the relative virtual path of an image in the tags view"""
+        acfg = AgentConfig.get()
+        return f"./{acfg.virtualfs_tags_dir}/{VirtualFsViews._safe_name(tag_name)}/{image_id}_{file}"
+
+    @staticmethod
+    def date_virtual_path(date_creation: Union[datetime, str, None], image_id: int, file: str) -> str:
+        """gets the relative virtual path of an image in the dates view"""
+        acfg = AgentConfig.get()
+        if not date_creation:
+            date_dir = "undated"
+        else:
+            if isinstance(date_creation, str):
+                date_creation = datetime.fromisoformat(date_creation)
+            date_dir = f"{date_creation.year:04d}/{date_creation.month:02d}"
+        return f"./{acfg.virtualfs_dates_dir}/{date_dir}/{image_id}_{file}"
+
+    @staticmethod
+    def _safe_name(name: str) -> str:
+        name = name.replace(os.sep, "_").strip()
+        return name if name not in ["", ".", ".."] else "_"
+
+    @classmethod
+    async def stream_view_paths(cls) -> AsyncIterator[dict]:
+        """streams the virtual and physical path of every link in the enabled views"""
+        pcfg = ProgramConfig.get()
+        condition, args = cls._get_category_condition()
+        where = cls._where([condition] if condition else [])
+        if cls.is_enabled("tags"):
+            sql = f"""
+                SELECT t.name, i.id, i.file, CONCAT(pcp.cpath, '/', i.file) AS physical_path
+                FROM image_tag it
+                JOIN tags t
+                ON t.id = it.tag_id
+                JOIN images i
+                ON i.id = it.image_id
+                JOIN category_paths pcp
+                ON pcp.cat_id = i.storage_category_id
+                {where}
+            """
+            async for row in DbConnectionPool.get().stream_dict_rows(sql, args, db=pcfg.pwgo_db_name):
+                yield {
+                    "virtual_path": cls.tag_virtual_path(row["name"], row["id"], row["file"]),
+                    "physical_path": row["physical_path"]
+                }
+
+        if cls.is_enabled("dates"):
+            sql = f"""
+                SELECT i.id, i.file, i.date_creation, CONCAT(pcp.cpath, '/', i.file) AS physical_path
+                FROM images i
+                JOIN category_paths pcp
+                ON pcp.cat_id = i.storage_category_id
+                {where}
+            """
+            async for row in DbConnectionPool.get().stream_dict_rows(sql, args, db=pcfg.pwgo_db_name):
+                yield {
+                    "virtual_path": cls.date_virtual_path(row["date_creation"], row["id"], row["file"]),
+                    "physical_path": row["physical_path"]
+                }
+
+    @classmethod
+    async def apply_tag_changes(cls, image_id: int, tag_deltas: dict[int, int]) -> None:
+        """adds or removes an image's links in the tags view. tag_deltas maps tag ids to
+        the net number of times the tag was added to the image"""
+        changed = {t: d for t, d in tag_deltas.items() if d}
+        if not cls.is_enabled("tags") or not changed:
+            return
+
+        img = await cls._get_image(image_id)
+        if not img:
+            return
+
+        pcfg = ProgramConfig.get()
+        async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.pwgo_db_name) as (cur,_):
+            placeholders = ",".join(["%s"] * len(changed))
+            await cur.execute(f"SELECT id, name FROM tags WHERE id IN ({placeholders})", tuple(changed))
+            tag_names = {row["id"]: row["name"] for row in await cur.fetchall()}
+
+        events = [
+            cls._view_event(image_id, "INSERT" if changed[tag_id] > 0 else "DELETE"
+                , cls.tag_virtual_path(name, image_id, img["file"]), img["physical_path"])
+            for tag_id, name in tag_names.items()
+        ]
+        await cls._apply(events)
+
+    @classmethod
+    async def apply_date_change(cls, image_id: int, old_dates: list) -> None:
+        """links an image into the dates view under its current creation date and removes
+        its links under any of the old dates. old_dates is empty for new images"""
+        if not cls.is_enabled("dates"):
+            return
+
+        img = await cls._get_image(image_id)
+        if not img:
+            return
+
+        events = [
+            cls._view_event(image_id, "DELETE"
+                , cls.date_virtual_path(old, image_id, img["file"]), img["physical_path"])
+            for old in old_dates
+        ]
+        events.append(cls._view_event(image_id, "INSERT"
+            , cls.date_virtual_path(img["date_creation"], image_id, img["file"]), img["physical_path"]))
+        await cls._apply(events)
+
+    @classmethod
+    async def rename_tag(cls, tag_id: int, before: str, after: str) -> None:
+        """moves the links of every image with the tag to the tag's new directory"""
+        if not cls.is_enabled("tags") or before == after:
+            return
+
+        pcfg = ProgramConfig.get()
+        condition, cat_args = cls._get_category_condition()
+        conditions, args = ["it.tag_id = %s"], [tag_id]
+        if condition:
+            conditions.append(condition)
+            args.extend(cat_args)
+        sql = f"""
+            SELECT i.id, i.file, CONCAT(pcp.cpath, '/', i.file) AS physical_path
+            FROM image_tag it
+            JOIN images i
+            ON i.id = it.image_id
+            JOIN category_paths pcp
+            ON pcp.cat_id = i.storage_category_id
+            {cls._where(conditions)}
+        """
+        events = []
+        rows = DbConnectionPool.get().stream_dict_rows(sql, tuple(args), db=pcfg.pwgo_db_name)
+        async for row in rows:
+            events.append(cls._view_event(row["id"], "DELETE"
+                , cls.tag_virtual_path(before, row["id"], row["file"]), row["physical_path"]))
+            events.append(cls._view_event(row["id"], "INSERT"
+                , cls.tag_virtual_path(after, row["id"], row["file"]), row["physical_path"]))
+        cls.get_logger().debug("moving %s tag view links from %s to %s", len(events) // 2, before, after)
+        await cls._apply(events)
+
+    @classmethod
+    async def remove_image_links(cls, image_id: int, values: dict) -> None:
+        """removes the view links of a deleted image. values holds the file and creation date
+        of the image since its row can't be read anymore. its tags may be gone already too
+        so every tag directory in the tags view is checked for a link"""
+        file = values.get("file")
+        if not file or not (cls.is_enabled("tags") or cls.is_enabled("dates")):
+            return
+
+        virtual_paths = []
+        if cls.is_enabled("tags"):
+            acfg = AgentConfig.get()
+            tags_dir = os.path.join(acfg.virtualfs_root, acfg.virtualfs_tags_dir)
+            tag_dirs = os.listdir(tags_dir) if os.path.isdir(tags_dir) else []
+            virtual_paths += [cls.tag_virtual_path(tag_dir, image_id, file) for tag_dir in tag_dirs]
+        if cls.is_enabled("dates"):
+            virtual_paths.append(cls.date_virtual_path(values.get("date_creation"), image_id, file))
+
+        await cls._apply([cls._view_event(image_id, "DELETE", p, None) for p in virtual_paths])
+
+    @staticmethod
+    def follows_membership() -> bool:
+        """do the views need to follow images in and out of the virtualfs root category"""
+        acfg = AgentConfig.get()
+        return bool(acfg.virtualfs_category_id and acfg.virtualfs_views)
+
+    @classmethod
+    async def apply_membership_change(cls, image_id: int) -> None:
+        """adds all of an image's view links when it is in an album under the virtualfs root
+        category and removes them when it isn't. existing links are left as they are"""
+        if not cls.follows_membership():
+            return
+
+        img = await cls._get_image(image_id, any_category=True)
+        if not img:
+            return
+        in_root = await cls._get_image(image_id) is not None
+
+        virtual_paths = []
+        if cls.is_enabled("tags"):
+            pcfg = ProgramConfig.get()
+            async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.pwgo_db_name) as (cur,_):
+                await cur.execute("""
+                    SELECT t.name
+                    FROM image_tag it
+                    JOIN tags t
+                    ON t.id = it.tag_id
+                    WHERE it.image_id = %s
+                """, (image_id,))
+                virtual_paths += [cls.tag_virtual_path(row["name"], image_id, img["file"])
+                    for row in await cur.fetchall()]
+        if cls.is_enabled("dates"):
+            virtual_paths.append(cls.date_virtual_path(img["date_creation"], image_id, img["file"]))
+
+        oper = "INSERT" if in_root else "DELETE"
+        await cls._apply([cls._view_event(image_id, oper, p, img["physical_path"]) for p in virtual_paths])
+
+    @staticmethod
+    def _get_category_condition() -> tuple[str, tuple]:
+        """limits the views to images in the virtualfs root category, if there is one"""
+        vfs_cat_id = AgentConfig.get().virtualfs_category_id
+        if not vfs_cat_id:
+            return "", ()
+        condition = """EXISTS (
+                SELECT 1
+                FROM image_virtual_paths ivp
+                WHERE ivp.image_id = i.id
+                    AND FIND_IN_SET(%s, ivp.category_uppercats)
+            )"""
+        return condition, (vfs_cat_id,)
+
+    @staticmethod
+    def _where(conditions: list[str]) -> str:
+        return f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    @classmethod
+    async def _get_image(cls, image_id: int, any_category: bool=False) -> Optional[dict]:
+        pcfg = ProgramConfig.get()
+        conditions, args = ["i.id = %s"], [image_id]
+        condition, cat_args = cls._get_category_condition()
+        if condition and not any_category:
+            conditions.append(condition)
+            args.extend(cat_args)
+        async with DbConnectionPool.get().acquire_dict_cursor(db=pcfg.pwgo_db_name) as (cur,_):
+            sql = f"""
+                SELECT i.file, i.date_creation, CONCAT(pcp.cpath, '/', i.file) AS physical_path
+                FROM images i
+                JOIN category_paths pcp
+                ON pcp.cat_id = i.storage_category_id
+                {cls._where(conditions)}
+            """
+            await cur.execute(sql, tuple(args))
+            return await cur.fetchone()
+
+    @staticmethod
+    def _view_event(image_id: int, operation: str, virtual_path: str, physical_path: Optional[str]) -> ImageEventRow:
+        evt = ImageEventRow(image_id=image_id, table_name="image_virtual_paths"
+            , table_primary_key=[image_id], operation=operation)
+        evt.db_event_data["values"] = {"virtual_path": virtual_path, "physical_path": physical_path}
+        return evt
+
+    @classmethod
+    def set_event_queue(cls, queue_events: Callable[[list[ImageEventRow]], Awaitable[None]]) -> None:
+        """sets the function the view link events are queued with. the virtual path event
+        task sets it so the views don't import it"""
+        cls._queue_events = queue_events
+
+    @classmethod
+    async def _apply(cls, events: list[ImageEventRow]) -> None:
+        if events:
+            # pylint: disable=not-callable
+            await cls._queue_events(events)
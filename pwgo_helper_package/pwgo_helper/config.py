@@ -75,7 +75,57 @@ class Configuration:
 
 class PiwigoScripts:
     """container class for piwigo db setup scripts"""
-    def __init__(self, pwgo_db_name="piwigo", msg_db_name="messaging"):
+    # sql expressions for the directories inserted between the category path and the
+    # file name of a virtual path. they keep very large albums from becoming flat directories
+    VIRTUALFS_FANOUTS = {
+        "none": "",
+        "date": "DATE_FORMAT(COALESCE(i.date_creation, i.date_available), '%Y/%m'), '/', ",
+        "hash": "SUBSTRING(MD5(i.id), 1, 2), '/', "
+    }
+
+    def __init__(self, pwgo_db_name="piwigo", msg_db_name="messaging", virtualfs_fanout="none"):
+        if virtualfs_fanout not in PiwigoScripts.VIRTUALFS_FANOUTS:
+            raise ValueError(f"unsupported virtualfs fanout {virtualfs_fanout}")
+        fanout = PiwigoScripts.VIRTUALFS_FANOUTS[virtualfs_fanout]
+        if virtualfs_fanout == "date":
+            # the date fanout has to follow the image when its dates are filled in or edited
+            fanout_trigger = f"""
+            CREATE OR REPLACE TRIGGER `{pwgo_db_name}`.tr_upd_aft_images_virt_paths
+            AFTER UPDATE ON `{pwgo_db_name}`.images
+            FOR EACH ROW
+            BEGIN
+                    IF NOT (DATE_FORMAT(COALESCE(new.date_creation, new.date_available), '%Y/%m')
+                            <=> DATE_FORMAT(COALESCE(old.date_creation, old.date_available), '%Y/%m')) THEN
+                            DELETE
+                            FROM `{pwgo_db_name}`.image_virtual_paths
+                            WHERE image_id = new.id;
+
+                            INSERT INTO `{pwgo_db_name}`.image_virtual_paths
+                            (image_id, category_id, category_uppercats, physical_path, virtual_path)
+                            SELECT ic.image_id
+                                    , ic.category_id
+                                    , c.uppercats
+                                    , CONCAT(pcp.cpath, '/', i.file)
+                                    , CONCAT(vcp.cpath, '/', {fanout}i.id, '_', i.file)
+                            FROM `{pwgo_db_name}`.image_category ic
+                            JOIN `{pwgo_db_name}`.images i
+                            ON i.id = ic.image_id
+                            JOIN `{pwgo_db_name}`.categories c
+                            ON c.id = ic.category_id
+                            JOIN `{pwgo_db_name}`.category_paths pcp
+                            ON pcp.cat_id = i.storage_category_id
+                            JOIN `{pwgo_db_name}`.category_paths vcp
+                            ON vcp.cat_id = ic.category_id
+                            WHERE c.dir IS NULL
+                                    AND ic.image_id = new.id;
+                    END IF;
+            END;
+            $$
+            """
+        else:
+            fanout_trigger = f"""
+            DROP TRIGGER IF EXISTS `{pwgo_db_name}`.tr_upd_aft_images_virt_paths$$
+            """
         self.create_category_paths = f"""
             CREATE OR REPLACE VIEW `{pwgo_db_name}`.category_paths
             AS
@@ -114,7 +164,7 @@ class PiwigoScripts:
                             , new.category_id
                             , c.uppercats
                             , CONCAT(pcp.cpath, '/', i.file)
-                            , CONCAT(vcp.cpath, '/', i.id, '_', i.file)
+                            , CONCAT(vcp.cpath, '/', {fanout}i.id, '_', i.file)
                     FROM `{pwgo_db_name}`.image_category ic
                     JOIN `{pwgo_db_name}`.images i
                     ON i.id = ic.image_id
@@ -158,7 +208,7 @@ class PiwigoScripts:
 
             END;
             $$
-
+            {fanout_trigger}
             DELIMITER ;
         """
 
@@ -236,7 +286,7 @@ class PiwigoScripts:
                     , ic.category_id
                     , c.uppercats
                     , CONCAT(pcp.cpath, '/', i.file)
-                    , CONCAT(vcp.cpath, '/', i.id, '_', i.file)
+                    , CONCAT(vcp.cpath, '/', {fanout}i.id, '_', i.file)
             FROM `{pwgo_db_name}`.image_category ic
             JOIN `{pwgo_db_name}`.images i
             ON i.id = ic.image_id
@@ -314,7 +364,8 @@ class PiwigoScripts:
             FOR EACH ROW
             BEGIN
                 
-                IF (new.name != old.name OR new.comment != old.comment OR new.author != old.author OR new.date_creation != old.date_creation) THEN
+                IF NOT (new.name <=> old.name AND new.comment <=> old.comment AND new.author <=> old.author
+                    AND new.date_creation <=> old.date_creation) THEN
                     INSERT INTO `{msg_db_name}`.pwgo_message (message_type, `message`)
                     VALUES ('IMG_METADATA' , JSON_OBJECT(
                             'image_id', new.id
@@ -349,6 +400,9 @@ class PiwigoScripts:
                         , 'table_name', 'images'
                         , 'table_primary_key', JSON_ARRAY(old.id)
                         , 'operation', 'DELETE'
+                        , 'values', JSON_OBJECT(
+                            'file', old.file, 'date_creation', old.date_creation
+                        )
                 ));
 
             END;$$
@@ -444,6 +498,26 @@ class PiwigoScripts:
             );
         """
 
+        self.create_tag_keyword_rewrite = f"""
+            CREATE TABLE IF NOT EXISTS `{msg_db_name}`.tag_keyword_rewrite
+            (
+                tag_id SMALLINT(5) UNSIGNED NOT NULL,
+                last_image_id MEDIUMINT(8) UNSIGNED NOT NULL DEFAULT 0,
+                started TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP(),
+                PRIMARY KEY (tag_id)
+            );
+        """
+
+        self.create_autotag_backlog = f"""
+            CREATE TABLE IF NOT EXISTS `{msg_db_name}`.autotag_backlog
+            (
+                category_id SMALLINT(5) UNSIGNED NOT NULL,
+                last_image_id MEDIUMINT(8) UNSIGNED NOT NULL DEFAULT 0,
+                started TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP(),
+                PRIMARY KEY (category_id)
+            );
+        """
+
         self.create_tags_triggers = f"""
             DELIMITER $$
             CREATE OR REPLACE TRIGGER `{pwgo_db_name}`.tr_ins_aft_tags
@@ -532,6 +606,15 @@ class RekognitionScripts:
             );
         """
 
+        self.create_no_face_images = f"""
+            CREATE TABLE IF NOT EXISTS `{rek_db_name}`.no_face_images
+            (
+                piwigo_image_id MEDIUMINT(8) UNSIGNED NOT NULL,
+                piwigo_category_id SMALLINT(5) UNSIGNED NOT NULL,
+                PRIMARY KEY (piwigo_image_id)
+            );
+        """
+
         self.create_processed_faces = f"""
             CREATE TABLE IF NOT EXISTS `{rek_db_name}`.processed_faces
             (
@@ -544,6 +627,27 @@ class RekognitionScripts:
             );
         """
 
+        self.create_image_phashes = f"""
+            CREATE TABLE IF NOT EXISTS `{rek_db_name}`.image_phashes
+            (
+                piwigo_image_id MEDIUMINT(8) NOT NULL,
+                phash CHAR(16) NOT NULL,
+                date_creation DATETIME NULL,
+                PRIMARY KEY (piwigo_image_id)
+            );
+        """
+
+        self.create_rekognition_responses = f"""
+            CREATE TABLE IF NOT EXISTS `{rek_db_name}`.rekognition_responses
+            (
+                content_hash CHAR(32) NOT NULL,
+                operation VARCHAR(25) NOT NULL,
+                response JSON NOT NULL,
+                created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP(),
+                PRIMARY KEY (content_hash, operation)
+            );
+        """
+
         self.create_rekognition_db = f"""
             CREATE DATABASE IF NOT EXISTS `{rek_db_name}`;
         """
@@ -1,10 +1,10 @@
 """container module for DbConnectionPool"""
 from __future__ import annotations
 from contextlib import asynccontextmanager
-from typing import Tuple
+from typing import Tuple, AsyncIterator
 
 from asyncmy import Connection,create_pool
-from asyncmy.cursors import DictCursor
+from asyncmy.cursors import DictCursor, SSDictCursor
 
 class DbConnectionPool():
     """Provides a context manager compatible connection to the given database"""
@@ -71,6 +71,31 @@ class DbConnectionPool():
             await conn.ensure_closed()
             self.__pool.release(conn)
 
+    @asynccontextmanager
+    async def acquire_ss_dict_cursor(self, **kwargs) -> Tuple[SSDictCursor,Connection]:
+        """Gets an unbuffered dictionary cursor and its connection. Rows are streamed from the
+        server as they are fetched instead of being read into memory up front. The connection
+        can't be used for other queries until the result is consumed. [async, contextmanager]"""
+        conn = await self.__pool.acquire()
+        if "db" in kwargs:
+            await conn.select_db(kwargs["db"])
+        try:
+            async with conn.cursor(cursor=SSDictCursor) as cur:
+                yield (cur,conn)
+
+        finally:
+            await conn.ensure_closed()
+            self.__pool.release(conn)
+
+    async def stream_dict_rows(self, sql: str, args=None, batch_size: int=1000, **kwargs) -> AsyncIterator[dict]:
+        """Executes a query with an unbuffered cursor and yields the rows one at a time, so
+        memory use doesn't grow with the size of the result. [async, generator]"""
+        async with self.acquire_ss_dict_cursor(**kwargs) as (cur,_):
+            await cur.execute(sql, args)
+            while rows := await cur.fetchmany(batch_size):
+                for row in rows:
+                    yield row
+
     async def clear(self):
         """Close all free connecctions in the pool."""
         await self.__pool.clear()
@@ -7,6 +7,8 @@ from pkg_resources import get_distribution
 
 from .config import Configuration
 from .agent.metadata_agent import agent_entry
+from .agent.virtualfs_checker import virtualfs_check_entry
+from .agent.face_prefilter import face_prefilter_benchmark_entry
 from .icloud_dl.base import main
 from .sync.main import sync_entry
 from .sync_vjs.main import sync_entry as sync_vjs_entry
@@ -36,7 +38,7 @@ def _load_environment(_ctx, _opt, val):
 @click.option(
     "--db-conn-json", help="json string representing the database server connection parameters",
     type=str, hide_input=True,
-    cls=required_for_commands(["agent", "icdownload", "sync"])
+    cls=required_for_commands(["agent", "icdownload", "sync", "virtualfs-check", "face-prefilter-benchmark"])
 )
 @click.option(
     "--pwgo-db-name",help="name of the piwigo database",type=str,required=False,default="piwigo"
@@ -94,3 +96,5 @@ pwgo_helper.add_command(agent_entry)
 pwgo_helper.add_command(main)
 pwgo_helper.add_command(sync_entry)
 pwgo_helper.add_command(sync_vjs_entry)
+pwgo_helper.add_command(virtualfs_check_entry)
+pwgo_helper.add_command(face_prefilter_benchmark_entry)
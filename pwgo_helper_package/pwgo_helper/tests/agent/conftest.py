@@ -65,11 +65,17 @@ async def test_db(request):
             pwgo_scripts.create_image_category_triggers,
             pwgo_scripts.create_tags_triggers,
             pwgo_scripts.create_image_tag_triggers,
+            pwgo_scripts.create_images_triggers,
             pwgo_scripts.create_pwgo_message,
+            pwgo_scripts.create_tag_keyword_rewrite,
+            pwgo_scripts.create_autotag_backlog,
             rek_scripts.create_rekognition_db,
             rek_scripts.create_image_labels,
             rek_scripts.create_index_faces,
-            rek_scripts.create_processed_faces
+            rek_scripts.create_no_face_images,
+            rek_scripts.create_processed_faces,
+            rek_scripts.create_rekognition_responses,
+            rek_scripts.create_image_phashes
         ]
     else:
         db_mod_scripts = []
@@ -0,0 +1,87 @@
+"""container module for TestAutotagBacklog"""
+import asyncio, json
+from unittest.mock import patch, AsyncMock
+
+import pytest
+
+from ...agent.config import Configuration as AgentConfig
+from ...config import Configuration as ProgramConfig
+from ...agent.autotag_backlog import AutotagBacklog
+from ...agent.pwgo_image import PiwigoImage
+from .conftest import TestDbResult
+
+class TestAutotagBacklog:
+    """Tests for the AutotagBacklog class"""
+    @pytest.mark.asyncio
+    @patch("pwgo_helper.agent.autotag_backlog.AutoTagger")
+    @patch.object(AutotagBacklog, "_clear_checkpoint")
+    @patch.object(AutotagBacklog, "_checkpoint")
+    @patch.object(AutotagBacklog, "_get_page")
+    @patch.object(AutotagBacklog, "_count_remaining")
+    @patch.object(AutotagBacklog, "_get_checkpoint")
+    @patch.object(AgentConfig, "get")
+    async def test_process_bounded(self, m_get_acfg, m_get_chk, m_count, m_get_page, m_chk, m_clear, m_at):
+        # pylint: disable=too-many-arguments
+        """tests that images are tagged with limited concurrency, that a failed image
+        doesn't stop the backlog and that progress is checkpointed per page"""
+        acfg = AgentConfig()
+        acfg.autotag_backlog_workers = 2
+        m_get_acfg.return_value = acfg
+        m_get_chk.return_value = 0
+        m_count.return_value = 5
+        pages = [[PiwigoImage(id=i, file=f"{i}.jpg", path=f"./{i}.jpg") for i in ids] for ids in [[1,2,3],[4,5]]]
+        m_get_page.side_effect = pages + [[]]
+        m_at.apply_label_tags = AsyncMock()
+        running = []
+        max_running = 0
+        async def autotag_image():
+            nonlocal max_running
+            running.append(1)
+            max_running = max(max_running, len(running))
+            await asyncio.sleep(0.01)
+            running.pop()
+            if m_at.create.call_count == 2:
+                raise RuntimeError("rekognition failure")
+        tagger = m_at.create.return_value.__aenter__.return_value
+        tagger.autotag_image.side_effect = autotag_image
+
+        await AutotagBacklog.process()
+
+        assert m_at.create.call_count == 5
+        assert max_running == 2
+        assert [c.args[1] for c in m_get_page.call_args_list] == [0, 3, 5]
+        assert [c.args[1] for c in m_chk.call_args_list] == [3, 5]
+        m_clear.assert_awaited_once()
+        m_at.apply_label_tags.assert_awaited_once()
+
+    @pytest.mark.asyncio
+    @patch("pwgo_helper.agent.autotag_backlog.AutoTagger")
+    async def test_resume_checkpoint(self, m_at, test_db: TestDbResult):
+        """tests that the backlog resumes after the checkpointed image and that the
+        checkpoint is cleared when the backlog completes"""
+        pcfg_params = {
+            "db_conn_json": json.dumps(test_db.db_host),
+            "pwgo_db_name": test_db.piwigo_db,
+            "msg_db_name": test_db.messaging_db,
+            "rek_db_name": test_db.rekognition_db,
+            "dry_run": False
+        }
+        pcfg = ProgramConfig.initialize(**pcfg_params)
+        m_at.apply_label_tags = AsyncMock()
+        album_id = AgentConfig.get().auto_tag_alb
+        async with test_db.db_connection_pool.acquire_dict_cursor(db=pcfg.pwgo_db_name) as (cur,_):
+            await cur.execute("SELECT MIN(image_id) AS id FROM image_category WHERE category_id = %s", (album_id,))
+            first_id = (await cur.fetchone())["id"]
+        async with test_db.db_connection_pool.acquire_dict_cursor(db=pcfg.msg_db_name) as (cur,conn):
+            await cur.execute("INSERT INTO autotag_backlog (category_id, last_image_id) VALUES (%s, %s)"
+                , (album_id, first_id))
+            await conn.commit()
+
+        await AutotagBacklog.process()
+
+        tagged_ids = [c.args[0].id for c in m_at.create.call_args_list]
+        assert first_id not in tagged_ids
+        assert tagged_ids == sorted(tagged_ids)
+        async with test_db.db_connection_pool.acquire_dict_cursor(db=pcfg.msg_db_name) as (cur,_):
+            await cur.execute("SELECT COUNT(*) AS cnt FROM autotag_backlog")
+            assert not (await cur.fetchone())["cnt"]
@@ -6,9 +6,8 @@ from unittest.mock import AsyncMock, MagicMock, patch
 import pytest
 from py_linq import Enumerable
 
-from ...agent import utilities
 from ...agent.autotagger import AutoTagger
-from ...agent.pwgo_image import PiwigoImage
+from ...agent.pwgo_image import PiwigoImage, ScaledImage
 from ...agent.config import Configuration as AgentConfig
 from ...config import Configuration as ProgramConfig
 from ...agent.rekognition import RekognitionClient
@@ -145,7 +144,7 @@ class TestAutotagger:
         m_rek.return_value = AsyncMock(spec=RekognitionClient)
         m_rek.return_value.index_faces_from_image.return_value = mck_idx_faces
         img = await PiwigoImage.create(img_id)
-        with patch.object(PiwigoImage, "open_file") as _:
+        with patch.object(PiwigoImage, "load_scaled") as _:
             async with AutoTagger.create(img) as tagger:
                 await tagger.add_indexed_image(img_cat_id)
 
@@ -166,9 +165,33 @@ class TestAutotagger:
             assert mck_idx_faces[0]["FaceDetail"] == detail
 
     @pytest.mark.asyncio
-    @patch.object(utilities, "get_cropped_image")
     @patch.object(AutoTagger, "_get_rek_client")
-    async def test_get_face_image_files(self, m_rek, m_crp_img, test_db: TestDbResult):
+    async def test_add_indexed_image_no_faces(self, m_rek, test_db: TestDbResult):
+        """tests that an image where rekognition finds no face is recorded so it
+        isn't sent again"""
+        pcfg_params = {
+            "db_conn_json": json.dumps(test_db.db_host),
+            "pwgo_db_name": test_db.piwigo_db,
+            "msg_db_name": test_db.messaging_db,
+            "rek_db_name": test_db.rekognition_db
+        }
+        pcfg = ProgramConfig.initialize(**pcfg_params)
+        m_rek.return_value = AsyncMock(spec=RekognitionClient)
+        m_rek.return_value.index_faces_from_image.return_value = []
+        img = await PiwigoImage.create(242)
+        with patch.object(PiwigoImage, "load_scaled") as _:
+            async with AutoTagger.create(img) as tagger:
+                await tagger.add_indexed_image(129)
+
+        async with test_db.db_connection_pool.acquire_dict_cursor(db=pcfg.rek_db_name) as (cur,_):
+            await cur.execute("SELECT piwigo_image_id, piwigo_category_id FROM no_face_images")
+            assert await cur.fetchall() == [{"piwigo_image_id": 242, "piwigo_category_id": 129}]
+            await cur.execute("SELECT 1 FROM indexed_faces")
+            assert not await cur.fetchall()
+
+    @pytest.mark.asyncio
+    @patch.object(AutoTagger, "_get_rek_client")
+    async def test_get_face_image_files(self, m_rek, test_db: TestDbResult):
         """test basic functioning of the _get_face_image_files method.
         mocks the rekognition client and checks that expected db entry
         is created"""
@@ -185,13 +208,14 @@ class TestAutotagger:
         m_rek.return_value = AsyncMock(spec=RekognitionClient)
         m_rek.return_value.detect_faces.return_value = mck_faces
         img = await PiwigoImage.create(img_id)
-        with patch.object(PiwigoImage, "open_file") as mck_open:
-            mck_open.return_value = MagicMock(spec=IOBase)
+        with patch.object(PiwigoImage, "load_scaled") as mck_load:
+            mck_load.return_value = MagicMock(spec=ScaledImage)
             async with AutoTagger.create(img) as tagger:
                 await tagger._get_face_image_files()
 
-        mck_open.call_count == 2
-        assert m_crp_img.call_count == 2
+        # the image is decoded once for detection and the crops
+        mck_load.assert_called_once()
+        assert mck_load.return_value.crop.call_count == 2
 
         async with test_db.db_connection_pool.acquire_dict_cursor(db=pcfg.rek_db_name) as (cur,_):
             sql = """
@@ -249,6 +273,7 @@ class TestAutotagger:
                     matched_face = await tagger._get_matched_face(img, img_face_idx)
 
             assert matched_face == mck_matched_face["Face"]
+            assert m_rek.return_value.match_face_from_image.call_args.kwargs["exclude"] == AutoTagger.is_temp_face
             sql = """
                 SELECT matched_to_face_id
                 FROM processed_faces
@@ -259,6 +284,61 @@ class TestAutotagger:
             assert len(result) == 1
             assert result[0]["matched_to_face_id"] == mck_matched_face["Face"]["FaceId"]
 
+    @pytest.mark.asyncio
+    @patch.object(PiwigoImage, "load_scaled")
+    @patch.object(AutoTagger, "_get_rek_client")
+    async def test_match_faces_by_index(self, m_rek, m_load, test_db: TestDbResult):
+        """tests that faces are matched by searching with the ids of the temporarily indexed
+        faces, that temporary faces are never used as matches and that they are removed"""
+        matched_face_id = "e2f5c37f-3ef5-4a06-bfe2-7251384f7873"
+        face_records = [
+            { "Face": { "FaceId": f"tmp-{i}" }, "FaceDetail": { "BoundingBox": {} } } for i in range(2)
+        ]
+        m_load.return_value = MagicMock(spec=ScaledImage)
+        m_rek.return_value = AsyncMock(spec=RekognitionClient)
+        m_rek.return_value.index_faces_from_image.return_value = face_records
+        m_rek.return_value.search_faces.side_effect = [
+            [
+                { "Face": { "FaceId": "tmp-other", "ExternalImageId": f"{AutoTagger.TEMP_EXT_ID_PREFIX}:1" } },
+                { "Face": { "FaceId": matched_face_id, "ExternalImageId": "129:582" } }
+            ],
+            []
+        ]
+        pcfg_params = {
+            "db_conn_json": json.dumps(test_db.db_host),
+            "pwgo_db_name": test_db.piwigo_db,
+            "msg_db_name": test_db.messaging_db,
+            "rek_db_name": test_db.rekognition_db,
+            "dry_run": False
+        }
+        pcfg = ProgramConfig.initialize(**pcfg_params)
+        img_id = 826
+        async with test_db.db_connection_pool.acquire_dict_cursor(db=pcfg.rek_db_name) as (cur,conn):
+            # insert indexed face to satisy fk in processed_faces
+            sql = """
+                INSERT INTO indexed_faces ( face_id, image_id, piwigo_image_id, piwigo_category_id, face_confidence, face_details)
+                VALUES ( %s, %s, %s, %s, %s, %s )
+            """
+            await cur.execute(sql, (matched_face_id, '30d1e2fe-bb3a-3fd8-abd5-a1917c706ae8', 582, 129, 99.99, '{}'))
+            await conn.commit()
+
+            async with AutoTagger.create(await PiwigoImage.create(img_id)) as tagger:
+                matched_faces = await tagger._match_faces_by_index()
+
+            assert [f["FaceId"] for f in matched_faces] == [matched_face_id]
+            assert m_rek.return_value.index_faces_from_image.call_args.kwargs["external_image_id"] \
+                == f"{AutoTagger.TEMP_EXT_ID_PREFIX}:{img_id}"
+            m_rek.return_value.remove_indexed_faces.assert_awaited_once_with(["tmp-0", "tmp-1"])
+            m_rek.return_value.match_face_from_image.assert_not_called()
+            sql = """
+                SELECT face_index, matched_to_face_id
+                FROM processed_faces
+                WHERE piwigo_image_id = %s
+                ORDER BY face_index
+            """
+            await cur.execute(sql, (img_id))
+            assert [r["matched_to_face_id"] for r in await cur.fetchall()] == [matched_face_id, None]
+
     @pytest.mark.asyncio
     @patch.object(AutoTagger, "_get_rek_client")
     async def test_fetch_image_labels(self, m_rek, test_db: TestDbResult):
@@ -281,8 +361,8 @@ class TestAutotagger:
         m_rek.return_value.detect_labels.return_value = mck_matched_labels
 
         img = await PiwigoImage.create(img_id)
-        with patch.object(PiwigoImage, "open_file") as mck_open:
-            mck_open.return_value = MagicMock(spec=IOBase)
+        with patch.object(PiwigoImage, "load_scaled") as mck_load:
+            mck_load.return_value = MagicMock(spec=ScaledImage)
             async with AutoTagger.create(img) as tagger:
                 labels = await tagger._fetch_image_labels()
 
@@ -300,6 +380,36 @@ class TestAutotagger:
         db_labels = [l["label"] for l in result]
         assert labels.sort() == db_labels.sort()
 
+    @pytest.mark.asyncio
+    @patch.object(AutoTagger, "_get_rek_client")
+    async def test_cached_response_reuse(self, m_rek, test_db: TestDbResult):
+        """tests that a rekognition response is reused for another image id with the
+        same content hash instead of calling rekognition again"""
+        pcfg_params = {
+            "db_conn_json": json.dumps(test_db.db_host),
+            "pwgo_db_name": test_db.piwigo_db,
+            "msg_db_name": test_db.messaging_db,
+            "rek_db_name": test_db.rekognition_db
+        }
+        pcfg = ProgramConfig.initialize(**pcfg_params)
+        mck_labels = [{ "Name": "Beverage", "Confidence": 99, "Parents": [] }]
+        m_rek.return_value = AsyncMock(spec=RekognitionClient)
+        m_rek.return_value.detect_labels.return_value = mck_labels
+
+        img = await PiwigoImage.create(543)
+        reimported = PiwigoImage(id=110, file=img.file, path=img._path, md5sum=img.md5sum)
+        with patch.object(PiwigoImage, "load_scaled") as mck_load:
+            mck_load.return_value = MagicMock(spec=ScaledImage)
+            for pwgo_img in [img, reimported]:
+                async with AutoTagger.create(pwgo_img) as tagger:
+                    labels = await tagger._fetch_image_labels()
+                    assert labels == ["Beverage"]
+
+        m_rek.return_value.detect_labels.assert_awaited_once()
+        async with test_db.db_connection_pool.acquire_dict_cursor(db=pcfg.rek_db_name) as (cur,_):
+            await cur.execute("SELECT label FROM image_labels WHERE piwigo_image_id = %s", (110))
+            assert [l["label"] for l in await cur.fetchall()] == ["Beverage"]
+
     @pytest.mark.asyncio
     async def test_move_image_to_processed(self, test_db: TestDbResult):
         """test the basic functioning of the _move_image_to_processed method"""
@@ -391,7 +501,8 @@ class TestAutotagger:
     @patch('pwgo_helper.agent.autotagger.RekognitionClient')
     @patch.object(AgentConfig, "get")
     async def test_sync_face_index(self, m_get_acfg, rek, at_create, at_rem_idx, _, test_db):
-        """tests the basic functioning of the sync_face_index static method."""
+        """tests the basic functioning of the sync_face_index static method. a routine
+        sync is worked out from the indexed_faces table without calling rekognition"""
         pcfg_params = {
             "db_conn_json": json.dumps(test_db.db_host),
             "pwgo_db_name": test_db.piwigo_db,
@@ -399,27 +510,114 @@ class TestAutotagger:
             "rek_db_name": test_db.rekognition_db,
             "dry_run": False
         }
-        ProgramConfig.initialize(**pcfg_params)
+        pcfg = ProgramConfig.initialize(**pcfg_params)
         acfg = AgentConfig()
         acfg.face_idx_albs = [129,130,131]
         m_get_acfg.return_value = acfg
-        mck_rek_client = MagicMock(spec=RekognitionClient)
         mck_curr_faces = [
             (129,584,'560a7c6b-4d29-40e1-b2cc-0224c0b25bf9'),
             (130,9688,'9d0fdcb4-4b9d-4138-b4d7-f6a124a6a385')
         ]
-        mck_rek_client.get_indexed_faces = AsyncMock(
-            return_value=[{"ExternalImageId": f"{f[0]}:{f[1]}", "FaceId": f[2]} for f in mck_curr_faces]
-        )
-        rek.return_value.__aenter__.return_value = mck_rek_client
+        await self._insert_indexed_faces(test_db, pcfg, mck_curr_faces)
         mck_tagger = AsyncMock(spec=AutoTagger)
         at_create.return_value.__aenter__.return_value = mck_tagger
 
-        await AutoTagger.sync_face_index()
+        await AutoTagger.sync_face_index(deep=False)
 
+        rek.assert_not_called()
         at_rem_idx.assert_called_once_with([mck_curr_faces[1][2]])
         assert mck_tagger.add_indexed_image.await_count == 9
 
+    @pytest.mark.asyncio
+    @patch.object(AutoTagger, "remove_indexed_faces")
+    @patch.object(AutoTagger, "create")
+    @patch.object(AgentConfig, "get")
+    async def test_sync_face_index_no_faces(self, m_get_acfg, at_create, _, test_db):
+        """tests that a routine sync skips album images recorded without faces and forgets
+        the record of an image that has left the face index albums"""
+        pcfg_params = {
+            "db_conn_json": json.dumps(test_db.db_host),
+            "pwgo_db_name": test_db.piwigo_db,
+            "msg_db_name": test_db.messaging_db,
+            "rek_db_name": test_db.rekognition_db,
+            "dry_run": False
+        }
+        pcfg = ProgramConfig.initialize(**pcfg_params)
+        acfg = AgentConfig()
+        acfg.face_idx_albs = [129,130,131]
+        m_get_acfg.return_value = acfg
+        await self._insert_indexed_faces(test_db, pcfg, [(129,584,'560a7c6b-4d29-40e1-b2cc-0224c0b25bf9')])
+        async with test_db.db_connection_pool.acquire_dict_cursor(db=pcfg.rek_db_name) as (cur,conn):
+            await cur.execute("INSERT INTO no_face_images (piwigo_image_id, piwigo_category_id) VALUES (22, 131), (9688, 130)")
+            await conn.commit()
+        mck_tagger = AsyncMock(spec=AutoTagger)
+        at_create.return_value.__aenter__.return_value = mck_tagger
+
+        await AutoTagger.sync_face_index(deep=False)
+
+        assert mck_tagger.add_indexed_image.await_count == 8
+        async with test_db.db_connection_pool.acquire_dict_cursor(db=pcfg.rek_db_name) as (cur,_):
+            await cur.execute("SELECT piwigo_image_id FROM no_face_images")
+            assert [r["piwigo_image_id"] for r in await cur.fetchall()] == [22]
+
+    @pytest.mark.asyncio
+    @patch.object(AutoTagger, "add_indexed_image")
+    @patch.object(AutoTagger, "remove_indexed_faces")
+    @patch.object(AutoTagger, "create")
+    @patch('pwgo_helper.agent.autotagger.RekognitionClient')
+    @patch.object(AgentConfig, "get")
+    async def test_sync_face_index_deep(self, m_get_acfg, rek, at_create, at_rem_idx, _, test_db):
+        """tests that a deep sync removes collection faces that aren't recorded, including
+        leftover temporary faces, and forgets recorded faces the collection has lost"""
+        pcfg_params = {
+            "db_conn_json": json.dumps(test_db.db_host),
+            "pwgo_db_name": test_db.piwigo_db,
+            "msg_db_name": test_db.messaging_db,
+            "rek_db_name": test_db.rekognition_db,
+            "dry_run": False
+        }
+        pcfg = ProgramConfig.initialize(**pcfg_params)
+        acfg = AgentConfig()
+        acfg.face_idx_albs = [129,130,131]
+        m_get_acfg.return_value = acfg
+        mck_curr_faces = [
+            (129,584,'560a7c6b-4d29-40e1-b2cc-0224c0b25bf9'),
+            (130,9688,'9d0fdcb4-4b9d-4138-b4d7-f6a124a6a385')
+        ]
+        await self._insert_indexed_faces(test_db, pcfg, mck_curr_faces)
+        mck_remote_faces = [
+            {"ExternalImageId": "129:584", "FaceId": mck_curr_faces[0][2]},
+            {"ExternalImageId": "131:22", "FaceId": "0b5b6a1e-3c57-4c4b-9d0e-8f4c3a9b8e01"},
+            {"ExternalImageId": f"{AutoTagger.TEMP_EXT_ID_PREFIX}:826", "FaceId": "5f0c2e1d-7a4b-4e8e-a0d1-2b9c6f3e4d02"}
+        ]
+        async def get_indexed_faces():
+            for face in mck_remote_faces:
+                yield face
+        mck_rek_client = MagicMock(spec=RekognitionClient)
+        mck_rek_client.get_indexed_faces = get_indexed_faces
+        rek.return_value.__aenter__.return_value = mck_rek_client
+        mck_tagger = AsyncMock(spec=AutoTagger)
+        at_create.return_value.__aenter__.return_value = mck_tagger
+
+        await AutoTagger.sync_face_index(deep=True)
+
+        at_rem_idx.assert_called_once_with([f["FaceId"] for f in mck_remote_faces[1:]])
+        async with test_db.db_connection_pool.acquire_dict_cursor(db=pcfg.rek_db_name) as (cur,_):
+            await cur.execute("SELECT face_id FROM indexed_faces")
+            assert [r["face_id"] for r in await cur.fetchall()] == [mck_curr_faces[0][2]]
+        assert mck_tagger.add_indexed_image.await_count == 9
+
+    @staticmethod
+    async def _insert_indexed_faces(test_db: TestDbResult, pcfg, faces):
+        async with test_db.db_connection_pool.acquire_dict_cursor(db=pcfg.rek_db_name) as (cur,conn):
+            sql = """
+                INSERT INTO indexed_faces ( face_id, image_id, piwigo_image_id, piwigo_category_id, face_confidence, face_details)
+                VALUES ( %s, %s, %s, %s, %s, %s )
+            """
+            for cat_id, img_id, face_id in faces:
+                await cur.execute(sql, (face_id, face_id, img_id, cat_id, 99.99, '{}'))
+            await conn.commit()
+
     @pytest.mark.asyncio
     async def test_process_new_tag(self, test_db: TestDbResult):
         """tests the basic functionality of the process_new_tag method"""
@@ -455,6 +653,50 @@ class TestAutotagger:
             await cur.execute(sql % (img_id, new_tag[0]))
             assert len(await cur.fetchall()) == 1
 
+    @pytest.mark.asyncio
+    @patch.object(AgentConfig, "get")
+    async def test_apply_label_tags_chunked(self, m_get_acfg, test_db: TestDbResult):
+        """tests that label tags are applied to all matching images when the
+        image id range spans multiple chunks"""
+        pcfg_params = {
+            "db_conn_json": json.dumps(test_db.db_host),
+            "pwgo_db_name": test_db.piwigo_db,
+            "msg_db_name": test_db.messaging_db,
+            "rek_db_name": test_db.rekognition_db
+        }
+        pcfg = ProgramConfig.initialize(**pcfg_params)
+        acfg = AgentConfig()
+        acfg.label_tag_chunk_size = 100
+        m_get_acfg.return_value = acfg
+        new_tag = (999,'test_auto_label')
+        img_ids = [22,110,367]
+        async with test_db.db_connection_pool.acquire_dict_cursor(db=pcfg.pwgo_db_name) as (cur,conn):
+            sql = f"""
+                INSERT INTO {pcfg.rek_db_name}.image_labels (piwigo_image_id,label,confidence,parents)
+                VALUES (%s,'%s',%s,'%s')
+            """
+            for img_id in img_ids:
+                await cur.execute(sql % (img_id,new_tag[1],99,'[]'))
+            # a low confidence label should not be applied
+            await cur.execute(sql % (543,new_tag[1],50,'[]'))
+            sql = f"""
+                INSERT INTO {pcfg.pwgo_db_name}.tags (id,name,url_name,lastmodified)
+                VALUES (%s,'%s','%s','%s')
+            """
+            await cur.execute(sql % (new_tag[0], new_tag[1], new_tag[1], '2020-01-01 00:00:00'))
+            await conn.commit()
+
+            added = await AutoTagger.apply_label_tags(new_tag[0])
+
+            sql = f"""
+                SELECT image_id
+                FROM {pcfg.pwgo_db_name}.image_tag
+                WHERE tag_id = %s
+            """
+            await cur.execute(sql % (new_tag[0]))
+            assert sorted([r["image_id"] for r in await cur.fetchall()]) == img_ids
+            assert added == len(img_ids)
+
     @pytest.mark.asyncio
     @patch.object(AutoTagger, "_move_image_to_processed")
     @patch.object(AutoTagger, "add_tags")
@@ -477,7 +719,7 @@ class TestAutotagger:
         ProgramConfig.initialize(**pcfg_params)
 
         img = await PiwigoImage.create(110)
-        with patch.object(PiwigoImage, "open_file") as _:
+        with patch.object(PiwigoImage, "load_scaled") as _:
             async with AutoTagger.create(img) as tagger:
                 await tagger.autotag_image()
 
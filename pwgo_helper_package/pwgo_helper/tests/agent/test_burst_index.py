@@ -0,0 +1,73 @@
+"""container module for TestBurstIndex"""
+import asyncio, os, random
+from datetime import datetime, timedelta
+from unittest.mock import patch, MagicMock
+
+import pytest
+from PIL import Image, ImageEnhance
+
+from ...agent.config import Configuration as AgentConfig
+from ...config import Configuration as ProgramConfig
+from ...agent.burst_index import BKTree, BurstIndex
+from ...agent.pwgo_image import PiwigoImage
+
+class TestBurstIndex:
+    """Tests for the BKTree and BurstIndex classes"""
+    def test_bk_tree_search(self):
+        """tests that the tree finds the same hashes as comparing against every hash"""
+        rnd = random.Random(7)
+        hashes = [rnd.getrandbits(64) for _ in range(300)]
+        hashes += [h ^ (1 << rnd.randrange(64)) for h in hashes[:50]]
+        tree = BKTree()
+        for i, hash_val in enumerate(hashes):
+            tree.add(hash_val, i)
+        tree.remove(hashes[0], 0)
+
+        for query in hashes[:20]:
+            expected = sorted((BKTree.distance(query, h), i) for i, h in enumerate(hashes)
+                if i and BKTree.distance(query, h) <= 4)
+            assert sorted(tree.search(query, 4)) == expected
+
+    def test_get_phash(self):
+        """tests that near identical shots hash close together and different ones don't"""
+        img_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "utilities", "test_image_handling")
+        with Image.open(os.path.join(img_dir, "test_image.JPG")) as org_img:
+            shot = org_img.convert("RGB")
+        with Image.open(os.path.join(img_dir, "test_image_crop.JPG")) as crop_img:
+            other = crop_img.convert("RGB")
+        # a slightly shifted and brighter frame of the same scene
+        next_shot = ImageEnhance.Brightness(shot.crop((4, 3, shot.size[0], shot.size[1]))).enhance(1.05)
+        max_distance = AgentConfig().burst_max_distance
+
+        assert BKTree.distance(BurstIndex.get_phash(shot), BurstIndex.get_phash(next_shot)) <= max_distance
+        assert BKTree.distance(BurstIndex.get_phash(shot), BurstIndex.get_phash(other)) > max_distance
+
+    @pytest.mark.asyncio
+    @patch.object(BurstIndex, "_pending", {})
+    @patch.object(BurstIndex, "_get_tree")
+    @patch.object(ProgramConfig, "get")
+    @patch.object(AgentConfig, "get")
+    async def test_claim_release(self, m_get_acfg, m_get_pcfg, m_get_tree):
+        """tests that a burst shot waits for its in progress source, that shots too far
+        apart in time aren't matched and that a failed image leaves the index"""
+        m_get_acfg.return_value = AgentConfig()
+        m_get_pcfg.return_value = MagicMock(dry_run=True)
+        tree = BKTree()
+        m_get_tree.return_value = tree
+        taken = datetime(2021, 6, 1, 12, 0, 0)
+        first = PiwigoImage(id=1, file="1.jpg", path="./1.jpg", date_creation=taken)
+        burst = PiwigoImage(id=2, file="2.jpg", path="./2.jpg", date_creation=taken + timedelta(seconds=2))
+        later = PiwigoImage(id=3, file="3.jpg", path="./3.jpg", date_creation=taken + timedelta(minutes=5))
+
+        assert await BurstIndex.claim(first, 0b1010) is None
+        burst_claim = asyncio.create_task(BurstIndex.claim(burst, 0b1011))
+        await asyncio.sleep(0)
+        assert not burst_claim.done()
+        assert await BurstIndex.claim(later, 0b1010) is None
+
+        await BurstIndex.release(first, 0b1010, True)
+        assert await burst_claim == 1
+        await BurstIndex.release(burst, 0b1011, True)
+        await BurstIndex.release(later, 0b1010, False)
+
+        assert sorted(item[0] for _, item in tree.search(0b1010, 1)) == [1, 2]
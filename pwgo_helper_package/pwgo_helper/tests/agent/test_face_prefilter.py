@@ -0,0 +1,64 @@
+"""container module for TestFacePrefilter"""
+import os
+from unittest.mock import patch
+
+import pytest
+from PIL import Image
+
+from ...agent.config import Configuration as AgentConfig
+from ...agent import face_prefilter
+from ...agent.face_prefilter import FacePrefilter
+
+class TestFacePrefilter:
+    """Tests for the FacePrefilter class"""
+    @patch.object(AgentConfig, "get")
+    def test_has_faces(self, m_get_acfg):
+        """tests that images without faces are filtered out"""
+        pytest.importorskip("cv2")
+        m_get_acfg.return_value = AgentConfig()
+        img_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "utilities", "test_image_handling")
+        with Image.open(os.path.join(img_dir, "test_image.JPG")) as test_card:
+            assert not FacePrefilter.has_faces(test_card)
+        assert not FacePrefilter.has_faces(Image.new("RGB", (1024, 768), (120, 160, 200)))
+
+    def test_upright(self):
+        """tests that sideways images are turned upright from their exif orientation or
+        else from the piwigo rotation, but never both"""
+        sideways = Image.new("RGB", (40, 30))
+        sideways.putpixel((0, 0), (255, 0, 0))
+        exif = sideways.getexif()
+        exif[face_prefilter.ORIENTATION_TAG] = 6
+        sideways.info["exif"] = exif.tobytes()
+
+        upright = FacePrefilter.upright(sideways, 3)
+        assert upright.size == (30, 40)
+        # orientation 6 is turned clockwise so the top left pixel ends up top right
+        assert upright.getpixel((29, 0)) == (255, 0, 0)
+
+        rotated = FacePrefilter.upright(Image.new("RGB", (40, 30)), 1)
+        assert rotated.size == (30, 40)
+        plain = Image.new("RGB", (40, 30))
+        assert FacePrefilter.upright(plain) is plain
+
+    @patch.object(face_prefilter, "cv2", None)
+    @patch.object(AgentConfig, "get")
+    def test_is_enabled(self, m_get_acfg):
+        """tests that the prefilter turns itself off when opencv isn't installed"""
+        m_get_acfg.return_value = AgentConfig()
+        assert not FacePrefilter.is_enabled()
+
+        m_get_acfg.return_value.face_prefilter = True
+        assert not FacePrefilter.is_enabled()
+        assert not m_get_acfg.return_value.face_prefilter
+
+    def test_score(self):
+        """tests the benchmark summary of the prefilter's predictions"""
+        results = [(True, True), (True, True), (True, False), (False, True), (False, False), (False, False)]
+        summary = FacePrefilter.score(results)
+
+        assert summary["images"] == 6
+        assert summary["precision"] == pytest.approx(2 / 3)
+        assert summary["recall"] == pytest.approx(2 / 3)
+        assert summary["skipped"] == pytest.approx(3 / 6)
+        assert summary["missed"] == 1
+        assert FacePrefilter.score([])["recall"] == 1.0
@@ -1,5 +1,5 @@
 """container module for TestFileMetadataWriter"""
-from io import BufferedIOBase
+from io import BufferedIOBase, BytesIO
 from unittest.mock import MagicMock, patch
 
 from fs.mountfs import MountFS
@@ -45,3 +45,23 @@ class TestFileMetadataWriter:
             "Iptc.Application2.Byline": img.metadata.author,
             "Iptc.Application2.Keywords": img.metadata.tags
         })
+
+    @patch("pwgo_helper.agent.file_metadata_writer.ImageData")
+    @patch.object(PiwigoImage, "open_file")
+    def test_shorter_file(self, mck_open, mck_img_data):
+        """tests that the old trailing bytes are cut off when the rewritten file is shorter"""
+        img_file = BytesIO(b"original image bytes")
+        img_file.close = MagicMock()
+        mck_open.return_value = img_file
+        mck_img_data_inst = MagicMock(spec=ImageData)
+        mck_img_data_inst.read_iptc.return_value = {"Iptc.Application2.Caption": "old comment"}
+        mck_img_data_inst.get_bytes.return_value = b"shorter"
+        mck_img_data.return_value.__enter__.return_value = mck_img_data_inst
+        img = PiwigoImage(id=1, file="test_file.JPG", path="/test_file.JPG", metadata=PiwigoImageMetadata({
+            "name": None, "comment": None, "author": None, "date_creation": None, "tags": []
+        }))
+
+        with FileMetadataWriter(img) as writer:
+            writer.write(["comment"])
+
+        assert img_file.getvalue() == b"shorter"
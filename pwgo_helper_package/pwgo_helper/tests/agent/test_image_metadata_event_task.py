@@ -1,6 +1,6 @@
 """container module for TestImageTagEventTask"""
 import asyncio
-from unittest.mock import patch,MagicMock
+from unittest.mock import patch,MagicMock,AsyncMock
 
 import pytest
 
@@ -10,6 +10,7 @@ from ...agent.image_metadata_event_task import ImageMetadataEventTask
 from ...agent.image_metadata_event_task import AutoTagger
 from ...agent.file_metadata_writer import FileMetadataWriter
 from ...agent.pwgo_image import PiwigoImage
+from ...agent.virtualfs_views import VirtualFsViews
 from ...agent.config import Configuration as AgentConfig
 
 class TestImageMetadataEventTask:
@@ -213,6 +214,37 @@ class TestImageMetadataEventTask:
             await mdata_event_handler
             mck_atag_create.return_value.__aenter__.return_value.autotag_image.assert_not_awaited()
 
+    @pytest.mark.asyncio
+    @patch.object(VirtualFsViews, "remove_image_links", new_callable=AsyncMock)
+    async def test_image_delete_view_links(self, mck_remove_links):
+        """tests that an image delete removes the image's view links using the event values"""
+        evt_row1 = ImageEventRow(image_id=1,
+            table_name="images",
+            table_primary_key=[1],
+            operation="DELETE")
+        evt_row1.db_event_data["values"] = {"file": "a.jpg", "date_creation": None}
+        handler = await EventTask.get_event_task(evt_row1)
+        assert not isinstance(handler, EventTask)
+        mck_remove_links.assert_awaited_once_with(1, {"file": "a.jpg", "date_creation": None})
+
+    @pytest.mark.asyncio
+    @patch.object(VirtualFsViews, "apply_membership_change", new_callable=AsyncMock)
+    @patch.object(VirtualFsViews, "follows_membership", return_value=True)
+    async def test_image_cat_view_membership(self, _, mck_apply_membership):
+        """tests that a non autotag category is handled when the virtualfs views
+        follow images in and out of the virtualfs root category"""
+        with patch.object(AutoTagger,"create") as mck_atag_create:
+            evt_row1 = ImageEventRow(image_id=1,
+                table_name="image_category",
+                table_primary_key=[1,1],
+                operation="INSERT")
+            mdata_event_handler = await EventTask.get_event_task(evt_row1)
+            assert mdata_event_handler.status == EventTaskStatus.INITIALIZED
+            mdata_event_handler.schedule_start()
+            await mdata_event_handler
+            mck_apply_membership.assert_awaited_once_with(1)
+            mck_atag_create.assert_not_called()
+
     @pytest.mark.asyncio
     @patch.object(FileMetadataWriter,"__exit__")
     @patch.object(PiwigoImage,"create")
@@ -271,3 +303,44 @@ class TestImageMetadataEventTask:
         res = await mdata_event_handler
         assert res
         mck_enter.return_value.write.assert_called_once()
+
+    @pytest.mark.asyncio
+    @patch.object(FileMetadataWriter,"__exit__")
+    @patch.object(PiwigoImage,"create")
+    @patch.object(AutoTagger,"create")
+    @patch.object(FileMetadataWriter,"__enter__")
+    async def test_img_mdata_diff(self, mck_enter, *_):
+        """tests that only changed metadata fields are written and that the write
+        is skipped when no field that is written to the file has changed"""
+        mck_enter.return_value = MagicMock(spec=FileMetadataWriter)
+        before = {
+            "name": "before_nm",
+            "comment": "comment",
+            "author": "author",
+            "date_creation": "2021-01-01 08:00:00"
+        }
+        evt_row1 = ImageEventRow(image_id=1,
+            table_name="images",
+            table_primary_key=[1],
+            operation="UPDATE")
+        evt_row1.db_event_data["UPDATE"] = {
+            "before": before,
+            "after": dict(before, date_creation="2021-01-02 08:00:00")
+        }
+        mdata_event_handler = await EventTask.get_event_task(evt_row1)
+        mdata_event_handler.schedule_start()
+        assert await mdata_event_handler
+        mck_enter.return_value.write.assert_not_called()
+
+        evt_row2 = ImageEventRow(image_id=1,
+            table_name="images",
+            table_primary_key=[1],
+            operation="UPDATE")
+        evt_row2.db_event_data["UPDATE"] = {
+            "before": before,
+            "after": dict(before, name="after_nm")
+        }
+        mdata_event_handler = await EventTask.get_event_task(evt_row2)
+        mdata_event_handler.schedule_start()
+        assert await mdata_event_handler
+        mck_enter.return_value.write.assert_called_once_with({"name"})
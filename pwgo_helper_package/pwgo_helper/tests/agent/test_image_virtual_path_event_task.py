@@ -1,13 +1,17 @@
 """container module for TestImageVirtualPathEventTask"""
-import tempfile, os.path, json
+import asyncio, tempfile, os.path, json, shutil
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 from unittest.mock import patch
 
 from path import Path
 import pytest
 
 from ...agent.config import Configuration as AgentConfig
-from ...config import Configuration as ProgramConfig
+from ...config import Configuration as ProgramConfig, PiwigoScripts
 from ...agent.image_virtual_path_event_task import ImageVirtualPathEventTask
+from ...agent.event_task import EventTaskStatus
+from ...agent.utilities import parse_sql
 from .conftest import TestDbResult
 
 class TestImageVirtualPathEventTask:
@@ -58,6 +62,243 @@ class TestImageVirtualPathEventTask:
             assert lvl1_path.exists()
             assert tmp_dir_path.exists()
 
+    @patch.object(ImageVirtualPathEventTask, "_dir_counts", None)
+    @patch.object(AgentConfig, "get")
+    def test_reconcile_virtualfs(self, mck_get_acfg):
+        """tests that reconciling the virtualfs leaves correct links untouched and only
+        creates or removes what differs from the expected paths"""
+        mck_get_acfg.return_value = AgentConfig()
+        mck_get_acfg.return_value.virtualfs_allow_broken_links = True
+        with tempfile.TemporaryDirectory() as src_dir, tempfile.TemporaryDirectory() as tmp_dir:
+            src_file1 = os.path.join(src_dir, "img1.jpg")
+            src_file2 = os.path.join(src_dir, "img2.jpg")
+            kept_link = os.path.join(tmp_dir, "a", "img1.jpg")
+            wrong_link = os.path.join(tmp_dir, "a", "img2.jpg")
+            new_link = os.path.join(tmp_dir, "b", "c", "img1.jpg")
+            stray_file = os.path.join(tmp_dir, "a", "stray.txt")
+            stray_dir = os.path.join(tmp_dir, "d", "e")
+            os.makedirs(os.path.dirname(kept_link))
+            os.makedirs(stray_dir)
+            os.symlink(src_file1, kept_link)
+            os.symlink(src_file1, wrong_link)
+            Path(stray_file).touch()
+            kept_ino = os.lstat(kept_link).st_ino
+
+            expected = {
+                kept_link: src_file1,
+                wrong_link: src_file2,
+                new_link: src_file1
+            }
+            ImageVirtualPathEventTask._reconcile_virtualfs(tmp_dir, expected)
+
+            assert os.lstat(kept_link).st_ino == kept_ino
+            assert os.readlink(wrong_link) == src_file2
+            assert os.readlink(new_link) == src_file1
+            assert not os.path.lexists(stray_file)
+            assert not os.path.lexists(os.path.join(tmp_dir, "d"))
+
+    @patch.object(ImageVirtualPathEventTask, "_dir_counts", None)
+    @patch.object(AgentConfig, "get")
+    def test_remove_path_counted(self, mck_get_acfg, mocker):
+        """tests that empty directories are detected from the seeded entry counts
+        without listing any directories"""
+        mck_get_acfg.return_value = AgentConfig()
+        mck_get_acfg.return_value.virtualfs_remove_empty_dirs = True
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            mck_get_acfg.return_value.virtualfs_root = tmp_dir
+            lvl2_path = os.path.join(tmp_dir, "lvl1", "lvl2")
+            other_path = os.path.join(tmp_dir, "lvl1", "other.jpg")
+            os.makedirs(lvl2_path)
+            link_paths = [os.path.join(lvl2_path, f"img{i}.jpg") for i in range(3)] + [other_path]
+            for link_path in link_paths:
+                os.symlink("/nonexistent", link_path)
+            ImageVirtualPathEventTask._seed_dir_counts(tmp_dir, link_paths)
+            spy_listdir = mocker.spy(os, "listdir")
+
+            for link_path in link_paths[:3]:
+                ImageVirtualPathEventTask._remove_path(Path(link_path))
+
+            assert not os.path.exists(lvl2_path)
+            assert os.path.lexists(other_path)
+            ImageVirtualPathEventTask._remove_path(Path(other_path))
+            assert not os.path.exists(os.path.join(tmp_dir, "lvl1"))
+            assert spy_listdir.call_count == 0
+            assert not ImageVirtualPathEventTask._dir_counts
+
+    @patch("os.chdir", side_effect=AssertionError("working directory must not change"))
+    @patch.object(AgentConfig, "get")
+    def test_handle_event_parallel(self, mck_get_acfg, _):
+        """tests that virtual path events resolve their paths without changing the working
+        directory and can be handled from several threads at once"""
+        mck_get_acfg.return_value = AgentConfig()
+        mck_get_acfg.return_value.virtualfs_allow_broken_links = True
+        with tempfile.TemporaryDirectory() as src_dir, tempfile.TemporaryDirectory() as tmp_dir:
+            mck_get_acfg.return_value.piwigo_galleries_host_path = src_dir
+            mck_get_acfg.return_value.virtualfs_root = tmp_dir
+            events = [SimpleNamespace(
+                db_event_type="INSERT",
+                db_event_data={"values": {
+                    "physical_path": f"./galleries/img{i}.jpg",
+                    "virtual_path": f"./album{i % 3}/img{i}.jpg"
+                }}) for i in range(30)]
+
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                list(executor.map(lambda e: ImageVirtualPathEventTask.apply_events([e]), events))
+
+            for i in range(30):
+                virt_path = os.path.join(tmp_dir, f"album{i % 3}", f"img{i}.jpg")
+                assert os.readlink(virt_path) == os.path.join(src_dir, "galleries", f"img{i}.jpg")
+
+    @pytest.mark.asyncio
+    @patch.object(ImageVirtualPathEventTask, "_dir_counts", None)
+    @patch.object(AgentConfig, "get")
+    async def test_batched_events(self, mck_get_acfg, mocker):
+        """tests that virtual path events arriving together are applied by a single batch
+        task and that only the last event for a path takes effect"""
+        mck_get_acfg.return_value = AgentConfig()
+        mck_get_acfg.return_value.virtualfs_allow_broken_links = True
+        mck_get_acfg.return_value.virtualfs_event_wait_secs = .1
+        spy_apply = mocker.spy(ImageVirtualPathEventTask, "apply_events")
+        def virt_path_evt(oper, idx):
+            return SimpleNamespace(db_event_type=oper, db_event_data={"values": {
+                "physical_path": f"./img{idx}.jpg",
+                "virtual_path": f"./album{idx % 2}/img{idx}.jpg",
+                "category_uppercats": "1,2"
+            }})
+
+        with tempfile.TemporaryDirectory() as src_dir, tempfile.TemporaryDirectory() as tmp_dir:
+            mck_get_acfg.return_value.piwigo_galleries_host_path = src_dir
+            mck_get_acfg.return_value.virtualfs_root = tmp_dir
+            events = [virt_path_evt("INSERT", i) for i in range(20)] + [virt_path_evt("DELETE", 0)]
+            tasks = [await ImageVirtualPathEventTask.resolve_event_task(e) for e in events]
+            assert all(t is tasks[0] for t in tasks)
+
+            tasks[0].schedule_start()
+            await tasks[0]
+
+            assert spy_apply.call_count == 1
+            assert not ImageVirtualPathEventTask.get_pending_tasks()
+            assert not os.path.lexists(os.path.join(tmp_dir, "album0", "img0.jpg"))
+            for i in range(1, 20):
+                virt_path = os.path.join(tmp_dir, f"album{i % 2}", f"img{i}.jpg")
+                assert os.readlink(virt_path) == os.path.join(src_dir, f"img{i}.jpg")
+
+    @patch.object(ImageVirtualPathEventTask, "_dir_counts", None)
+    @patch.object(AgentConfig, "get")
+    def test_apply_events_missing_source(self, mck_get_acfg, mocker):
+        """tests that a missing source only skips its own link when broken links aren't
+        allowed and that a small batch checks its sources without listing the album"""
+        mck_get_acfg.return_value = AgentConfig()
+        mck_get_acfg.return_value.virtualfs_allow_broken_links = False
+        spy_listdir = mocker.spy(os, "listdir")
+        def virt_path_evt(oper, name):
+            return SimpleNamespace(db_event_type=oper, db_event_data={"values": {
+                "physical_path": f"./{name}", "virtual_path": f"./album/{name}"
+            }})
+
+        with tempfile.TemporaryDirectory() as src_dir, tempfile.TemporaryDirectory() as tmp_dir:
+            mck_get_acfg.return_value.piwigo_galleries_host_path = src_dir
+            mck_get_acfg.return_value.virtualfs_root = tmp_dir
+            Path(os.path.join(src_dir, "new.jpg")).touch()
+            old_link = os.path.join(tmp_dir, "album", "old.jpg")
+            os.makedirs(os.path.dirname(old_link))
+            os.symlink(os.path.join(src_dir, "old.jpg"), old_link)
+            Path(os.path.join(tmp_dir, "album", "other.jpg")).touch()
+
+            ImageVirtualPathEventTask.apply_events([
+                virt_path_evt("DELETE", "old.jpg"),
+                virt_path_evt("INSERT", "missing.jpg"),
+                virt_path_evt("INSERT", "new.jpg")
+            ])
+
+            assert not os.path.lexists(old_link)
+            assert not os.path.lexists(os.path.join(tmp_dir, "album", "missing.jpg"))
+            assert os.readlink(os.path.join(tmp_dir, "album", "new.jpg")) == os.path.join(src_dir, "new.jpg")
+            assert not [c for c in spy_listdir.call_args_list if c.args and c.args[0] == src_dir]
+
+    @pytest.mark.asyncio
+    @patch.object(AgentConfig, "get")
+    async def test_batch_releases_previous(self, mck_get_acfg, mocker):
+        """tests that a batch waits for the batch before it, then lets go of it, and
+        doesn't wait on a previous batch that was cancelled before it started"""
+        mck_get_acfg.return_value = AgentConfig()
+        mocker.patch.object(ImageVirtualPathEventTask, "apply_events")
+        first = ImageVirtualPathEventTask(delay=0)
+        second = ImageVirtualPathEventTask(previous=first, delay=0)
+        first.schedule_start()
+        second.schedule_start()
+        await second
+        await first
+
+        assert first.status == EventTaskStatus.DONE
+        assert second._previous is None
+
+        cancelled = ImageVirtualPathEventTask(delay=0)
+        cancelled.status = EventTaskStatus.CANCELLED
+        third = ImageVirtualPathEventTask(previous=cancelled, delay=0)
+        third.schedule_start()
+        await asyncio.wait_for(third, 1)
+        assert third._previous is None
+        ImageVirtualPathEventTask.get_pending_tasks().remove(cancelled)
+
+    @pytest.mark.parametrize("use_staging_path", [False, True])
+    @patch.object(ImageVirtualPathEventTask, "_dir_counts", None)
+    @patch.object(AgentConfig, "get")
+    def test_staged_rebuild_virtualfs(self, mck_get_acfg, use_staging_path):
+        """tests that a staged rebuild swaps in a complete tree and hands back the old
+        tree for removal, both when staged next to the root and in a configured staging path"""
+        mck_get_acfg.return_value = AgentConfig()
+        mck_get_acfg.return_value.virtualfs_allow_broken_links = True
+        with tempfile.TemporaryDirectory() as src_dir, tempfile.TemporaryDirectory() as work_dir:
+            tmp_dir = os.path.join(work_dir, "vfs")
+            staging_path = os.path.join(work_dir, "staging")
+            os.makedirs(staging_path)
+            if use_staging_path:
+                mck_get_acfg.return_value.virtualfs_staging_path = staging_path
+            src_file = os.path.join(src_dir, "img1.jpg")
+            old_link = os.path.join(tmp_dir, "a", "img1.jpg")
+            old_file = os.path.join(tmp_dir, "stray.txt")
+            os.makedirs(os.path.dirname(old_link))
+            os.symlink(os.path.join(src_dir, "old.jpg"), old_link)
+            Path(old_file).touch()
+            expected = {
+                old_link: src_file,
+                os.path.join(tmp_dir, "b", "c", "img1.jpg"): src_file
+            }
+
+            staging_parent = ImageVirtualPathEventTask._get_staging_parent(tmp_dir)
+            assert staging_parent == (staging_path if use_staging_path else work_dir)
+            old_tree = ImageVirtualPathEventTask._staged_rebuild_virtualfs(tmp_dir, expected, staging_parent)
+
+            for virt_path, src_path in expected.items():
+                assert os.readlink(virt_path) == src_path
+            assert not os.path.lexists(old_file)
+            assert sorted(os.listdir(tmp_dir)) == ["a", "b"]
+            assert os.path.dirname(old_tree) == staging_parent
+            assert os.path.lexists(os.path.join(old_tree, "stray.txt"))
+
+    @patch.object(AgentConfig, "get")
+    def test_get_staging_parent_fallback(self, mck_get_acfg):
+        """tests that a root that can't be staged outside of itself on the same filesystem
+        isn't staged at all"""
+        mck_get_acfg.return_value = AgentConfig()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with patch("os.path.ismount", return_value=True):
+                assert ImageVirtualPathEventTask._get_staging_parent(tmp_dir) is None
+
+            mck_get_acfg.return_value.virtualfs_staging_path = os.path.join(tmp_dir, "staging")
+            os.makedirs(mck_get_acfg.return_value.virtualfs_staging_path)
+            assert ImageVirtualPathEventTask._get_staging_parent(tmp_dir) is None
+
+            mck_get_acfg.return_value.virtualfs_staging_path = None
+            real_stat = os.stat
+            def other_device(path, *args, **kwargs):
+                result = real_stat(path, *args, **kwargs)
+                return SimpleNamespace(st_dev=result.st_dev + 1) if path == tmp_dir else result
+            with patch("os.stat", side_effect=other_device):
+                assert ImageVirtualPathEventTask._get_staging_parent(tmp_dir) is None
+            assert ImageVirtualPathEventTask._get_staging_parent(tmp_dir) == os.path.dirname(tmp_dir)
+
     @pytest.mark.asyncio
     @patch.object(AgentConfig, "get")
     async def test_rebuild_fs(self, m_get_acfg, test_db: TestDbResult):
@@ -103,3 +344,62 @@ class TestImageVirtualPathEventTask:
                     for row in await cur.fetchall():
                         # need to use lexists so broken links are counted
                         assert os.path.lexists(row["virtual_path"])
+
+    @pytest.mark.asyncio
+    @patch.object(AgentConfig, "get")
+    async def test_rebuild_fs_category(self, m_get_acfg, test_db: TestDbResult):
+        """tests that a rebuild limited to a root category only creates links for
+        descendents of that category"""
+        m_get_acfg.return_value = AgentConfig()
+        m_get_acfg.return_value.virtualfs_allow_broken_links = True
+        m_get_acfg.return_value.piwigo_galleries_host_path = "/tmp"
+        m_get_acfg.return_value.virtualfs_category_id = 57
+        pcfg_params = {
+            "db_conn_json": json.dumps(test_db.db_host),
+            "pwgo_db_name": test_db.piwigo_db,
+            "msg_db_name": test_db.messaging_db,
+            "rek_db_name": test_db.rekognition_db,
+            "dry_run": False
+        }
+        pcfg = ProgramConfig.initialize(**pcfg_params)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            m_get_acfg.return_value.virtualfs_root = tmp_dir
+            await ImageVirtualPathEventTask.rebuild_virtualfs()
+
+            async with test_db.db_connection_pool.acquire_dict_cursor(db=pcfg.pwgo_db_name) as (cur,_):
+                await cur.execute("SELECT virtual_path, category_uppercats FROM image_virtual_paths")
+                rows = await cur.fetchall()
+
+            expected = {
+                os.path.normpath(os.path.join(tmp_dir, row["virtual_path"])) for row in rows
+                if 57 in [int(c) for c in row["category_uppercats"].split(",")]
+            }
+            created = {
+                os.path.join(dir_path, f) for dir_path, _, files in os.walk(tmp_dir) for f in files
+            }
+            assert expected
+            assert created == expected
+
+    @pytest.mark.parametrize("fanout,expected", [
+        ("none", "CONCAT(vcp.cpath, '/', i.id, '_', i.file)"),
+        ("date", "CONCAT(vcp.cpath, '/', DATE_FORMAT(COALESCE(i.date_creation, i.date_available), '%Y/%m'), '/', i.id, '_', i.file)"),
+        ("hash", "CONCAT(vcp.cpath, '/', SUBSTRING(MD5(i.id), 1, 2), '/', i.id, '_', i.file)")
+    ])
+    def test_virtual_path_fanout(self, fanout, expected):
+        """tests that the virtual path fanout is used both when the virtual paths table
+        is built and by the trigger that adds new virtual paths"""
+        scripts = PiwigoScripts(virtualfs_fanout=fanout)
+        assert expected in scripts.create_image_virtual_paths
+        assert expected in scripts.create_image_category_triggers
+        # only the date fanout has to move the virtual paths when an image's date changes
+        stmts = parse_sql(scripts.create_image_category_triggers)
+        date_trigger = [s for s in stmts if "tr_upd_aft_images_virt_paths" in s]
+        assert len(date_trigger) == 1
+        if fanout == "date":
+            assert date_trigger[0].startswith("CREATE OR REPLACE TRIGGER")
+            assert expected in date_trigger[0]
+        else:
+            assert date_trigger[0].startswith("DROP TRIGGER IF EXISTS")
+
+        with pytest.raises(ValueError):
+            PiwigoScripts(virtualfs_fanout="bogus")
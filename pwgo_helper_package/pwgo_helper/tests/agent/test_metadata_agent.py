@@ -554,6 +554,7 @@ class TestMetadataAgent:
             mck_handle_evts = mocker.spy(ImageMetadataEventTask, "_handle_events")
             mck_at = stack.enter_context(patch("pwgo_helper.agent.metadata_agent.AutoTagger"))
             mck_vfs_task = stack.enter_context(patch("pwgo_helper.agent.metadata_agent.ImageVirtualPathEventTask"))
+            mck_rewriter = stack.enter_context(patch("pwgo_helper.agent.metadata_agent.TagMetadataRewriter"))
             mck_pcfg_get = stack.enter_context(patch.object(ProgramConfig, "get"))
             mck_pcfg_get.return_value = ProgramConfig()
             mck_pcfg_get.return_value.log_level = "DEBUG"
@@ -568,6 +569,7 @@ class TestMetadataAgent:
             _ = stack.enter_context(patch.object(agent, "process_autotag_backlog"))
             mck_at.sync_face_index = AsyncMock()
             mck_vfs_task.rebuild_virtualfs = AsyncMock()
+            mck_rewriter.resume_pending = AsyncMock()
 
             await agent.start()
             while evts:
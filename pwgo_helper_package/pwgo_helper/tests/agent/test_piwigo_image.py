@@ -1,11 +1,13 @@
 """container module for TestPiwigoImageMetadata and TestPiwigoImage"""
 # pylint: disable=protected-access
-import datetime, json
+import datetime, json, os, tempfile
 from unittest.mock import AsyncMock, patch
 
 import pytest
+from PIL import Image
 
 from ...agent.pwgo_image import PiwigoImageMetadata,PiwigoImage
+from ...agent import utilities
 from ...agent.config import Configuration as AgentConfig
 from ...config import Configuration as ProgramConfig
 from .conftest import TestDbResult
@@ -57,6 +59,23 @@ class TestPiwigoImageMetadata:
         }
         pwgo_mdata = PiwigoImageMetadata(mdata)
 
+    def test_iptc_dict_fields(self):
+        """tests that requesting specific fields only returns those fields
+        and maps empty values to None"""
+        mdata = {
+            "name": "test_name",
+            "comment": None,
+            "author": "test_author",
+            "date_creation": "2021-01-01 08:00:00",
+            "tags": ["tag1","tag2"]
+        }
+        pwgo_mdata = PiwigoImageMetadata(mdata)
+        pwgo_iptc = pwgo_mdata.get_iptc_dict({"name","comment"})
+        assert pwgo_iptc == {
+            "Iptc.Application2.ObjectName": mdata["name"],
+            "Iptc.Application2.Caption": None
+        }
+
     def test_long_metadata_fields(self):
         """tests that metadata values that exceed iptc specs are properly truncated"""
         mdata = {
@@ -108,3 +127,29 @@ class TestPiwigoImage:
         assert pwgo_img.file == test_file["file"]
         assert pwgo_img._path == test_file["path"]
         assert pwgo_img.metadata
+
+    @patch.object(AgentConfig, "get")
+    def test_resolve_source_path(self, m_get_acfg):
+        """tests that the smallest derivative covering the scaled size is picked over the
+        original and that the original is used when no derivative is large enough"""
+        with tempfile.TemporaryDirectory() as galleries, tempfile.TemporaryDirectory() as data:
+            acfg = AgentConfig()
+            acfg.piwigo_galleries_host_path = galleries
+            acfg.piwigo_data_host_path = data
+            acfg.scaled_img_max_size = (1024,1024)
+            m_get_acfg.return_value = acfg
+            os.makedirs(os.path.join(galleries, "album"))
+            os.makedirs(os.path.join(data, "i", "galleries", "album"))
+            Image.new("RGB", (4000, 3000)).save(os.path.join(galleries, "album", "a.jpg"))
+            for deriv_type, size in [("me", (792, 594)), ("xl", (1224, 918)), ("xx", (1656, 1242))]:
+                Image.new("RGB", size).save(os.path.join(data, "i", "galleries", "album", f"a-{deriv_type}.jpg"))
+            img = PiwigoImage(id=1, file="a.jpg", path="./galleries/album/a.jpg")
+            pgfs = utilities.get_pwgo_fs()
+            try:
+                assert img.resolve_source_path(pgfs).endswith("_data/i/galleries/album/a-xl.jpg")
+                assert img.load_scaled().pixels.size == (1024, 768)
+                os.remove(os.path.join(data, "i", "galleries", "album", "a-xl.jpg"))
+                os.remove(os.path.join(data, "i", "galleries", "album", "a-xx.jpg"))
+                assert img.resolve_source_path(pgfs) == utilities.map_pwgo_path(img._path)
+            finally:
+                pgfs.close()
@@ -0,0 +1,118 @@
+"""container module for TestRekognitionClient"""
+from unittest.mock import patch, MagicMock, AsyncMock
+
+import pytest
+
+from ...agent.config import Configuration as AgentConfig
+from ...agent.rekognition import RekognitionClient
+
+class TestRekognitionClient:
+    """Tests for the RekognitionClient class"""
+    @staticmethod
+    def _get_config() -> AgentConfig:
+        acfg = AgentConfig()
+        acfg.rek_cfg = {
+            "aws_access_key_id": "key",
+            "aws_secret_access_key": "secret",
+            "region_name": "us-east-1",
+            "collection_id": "default"
+        }
+        return acfg
+
+    @pytest.mark.asyncio
+    @patch("aiobotocore.session.AioSession")
+    @patch.object(AgentConfig, "get")
+    async def test_shared_client(self, m_get_acfg, m_session):
+        """tests that instances reuse the shared client without closing it and that
+        the shared client is closed when its context exits"""
+        m_get_acfg.return_value = self._get_config()
+        client_ctx = m_session.return_value.create_client.return_value
+        client_ctx.__aenter__ = AsyncMock(return_value=MagicMock(__aexit__=AsyncMock()))
+        client_ctx.__aexit__ = AsyncMock(return_value=False)
+
+        async with RekognitionClient.initialize_shared() as shared:
+            for _ in range(3):
+                async with RekognitionClient() as rek_client:
+                    # pylint: disable=protected-access
+                    assert rek_client._rek_client is shared
+            client_ctx.__aexit__.assert_not_called()
+            shared.__aexit__.assert_not_called()
+
+        m_session.return_value.create_client.assert_called_once()
+        pool_cfg = m_session.return_value.create_client.call_args.kwargs["config"]
+        assert pool_cfg.max_pool_connections == AgentConfig().rek_max_pool_connections
+        client_ctx.__aexit__.assert_awaited_once()
+        assert RekognitionClient._shared_client is None
+
+    @pytest.mark.asyncio
+    @patch("aiobotocore.session.AioSession")
+    @patch.object(AgentConfig, "get")
+    async def test_own_client(self, m_get_acfg, m_session):
+        """tests that an instance creates and closes its own client without a shared client"""
+        m_get_acfg.return_value = self._get_config()
+        own_client = MagicMock(__aexit__=AsyncMock())
+        m_session.return_value.create_client.return_value.__aenter__ = AsyncMock(return_value=own_client)
+
+        async with RekognitionClient() as rek_client:
+            # pylint: disable=protected-access
+            assert rek_client._rek_client is own_client
+
+        own_client.__aexit__.assert_awaited_once()
+
+    @pytest.mark.asyncio
+    @patch.object(AgentConfig, "get")
+    async def test_get_indexed_faces(self, m_get_acfg):
+        """tests that the faces of every page are streamed in order"""
+        m_get_acfg.return_value = self._get_config()
+        pages = [
+            {"Faces": [{"FaceId": "a"}, {"FaceId": "b"}], "NextToken": "t1"},
+            {"Faces": [{"FaceId": "b"}], "NextToken": "t2"},
+            {"Faces": [{"FaceId": "c"}]}
+        ]
+        rek_client = RekognitionClient()
+        # pylint: disable=protected-access
+        rek_client._rek_client = MagicMock(list_faces=AsyncMock(side_effect=pages))
+
+        faces = [f["FaceId"] async for f in rek_client.get_indexed_faces(page_size=2)]
+
+        assert faces == ["a", "b", "b", "c"]
+        calls = rek_client._rek_client.list_faces.call_args_list
+        assert [c.kwargs.get("NextToken") for c in calls] == [None, "t1", "t2"]
+        assert all(c.kwargs["MaxResults"] == 2 for c in calls)
+
+    @pytest.mark.asyncio
+    @patch.object(AgentConfig, "get")
+    async def test_remove_indexed_faces(self, m_get_acfg):
+        """tests that large removals are split into calls rekognition accepts"""
+        m_get_acfg.return_value = self._get_config()
+        face_ids = [str(i) for i in range(RekognitionClient.DELETE_FACES_MAX + 10)]
+        rek_client = RekognitionClient()
+        # pylint: disable=protected-access
+        rek_client._rek_client = MagicMock(delete_faces=AsyncMock(
+            side_effect=lambda **kwargs: {"DeletedFaces": kwargs["FaceIds"]}))
+
+        assert await rek_client.remove_indexed_faces(face_ids) == face_ids
+        assert [len(c.kwargs["FaceIds"]) for c in rek_client._rek_client.delete_faces.call_args_list] \
+            == [RekognitionClient.DELETE_FACES_MAX, 10]
+        assert await rek_client.remove_indexed_faces([]) == []
+
+    @pytest.mark.asyncio
+    @patch.object(AgentConfig, "get")
+    async def test_match_face_from_image(self, m_get_acfg):
+        """tests that excluded faces are skipped over for the next best match"""
+        m_get_acfg.return_value = self._get_config()
+        matches = [{"Face": {"FaceId": "tmp", "ExternalImageId": "autotag:1"}}
+            , {"Face": {"FaceId": "a", "ExternalImageId": "129:2"}}]
+        rek_client = RekognitionClient()
+        # pylint: disable=protected-access
+        rek_client._rek_client = MagicMock(search_faces_by_image=AsyncMock(return_value={"FaceMatches": matches}))
+        img_file = MagicMock(read=MagicMock(return_value=b""))
+
+        match = await rek_client.match_face_from_image(img_file, 10
+            , exclude=lambda f: f["ExternalImageId"].startswith("autotag:"))
+
+        assert match is matches[1]
+        assert rek_client._rek_client.search_faces_by_image.call_args.kwargs["MaxFaces"] == 10
+        assert await rek_client.match_face_from_image(img_file) is matches[0]
+        rek_client._rek_client.search_faces_by_image.return_value = {"FaceMatches": matches[:1]}
+        assert await rek_client.match_face_from_image(img_file, exclude=lambda f: True) is None
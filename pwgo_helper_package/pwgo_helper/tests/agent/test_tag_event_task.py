@@ -7,6 +7,7 @@ import pytest
 from ...agent.database_event_row import TagEventRow
 from ...agent.event_task import EventTask, EventTaskStatus
 from ...agent.tag_event_task import TagEventTask
+from ...agent.tag_metadata_rewriter import TagMetadataRewriter
 
 class TestTagEventTask:
     """tests for the TagEventTask class"""
@@ -29,3 +30,16 @@ class TestTagEventTask:
             assert tag_event_handler.status == EventTaskStatus.EXEC
             await tag_event_handler
             assert tag_event_handler.status == EventTaskStatus.DONE
+
+    @pytest.mark.asyncio
+    async def test_tag_rename(self):
+        """tests that a renamed tag is handled by rewriting the keywords of tagged files"""
+        evt_row1 = TagEventRow(tag_id=1,
+            table_name="tags",
+            table_primary_key=[1],
+            operation="UPDATE")
+        tag_event_handler = await EventTask.get_event_task(evt_row1)
+        with patch.object(TagMetadataRewriter, "rewrite_tag_keywords") as mck_rewrite:
+            tag_event_handler.schedule_start()
+            await tag_event_handler
+            mck_rewrite.assert_awaited_once_with(1)
@@ -0,0 +1,88 @@
+"""container module for TestTagMetadataRewriter"""
+import json
+from unittest.mock import patch
+
+import pytest
+
+from ...agent.config import Configuration as AgentConfig
+from ...config import Configuration as ProgramConfig
+from ...agent.tag_metadata_rewriter import TagMetadataRewriter
+from .conftest import TestDbResult
+
+class TestTagMetadataRewriter:
+    """Tests for the TagMetadataRewriter class"""
+    @pytest.mark.asyncio
+    @patch("pwgo_helper.agent.tag_metadata_rewriter.FileMetadataWriter")
+    @patch.object(AgentConfig, "get")
+    async def test_rewrite_tag_keywords(self, m_get_acfg, m_writer, test_db: TestDbResult):
+        """tests that every image with the tag is rewritten across multiple pages
+        and that the progress checkpoint is cleared when the rewrite completes"""
+        pcfg_params = {
+            "db_conn_json": json.dumps(test_db.db_host),
+            "pwgo_db_name": test_db.piwigo_db,
+            "msg_db_name": test_db.messaging_db,
+            "rek_db_name": test_db.rekognition_db,
+            "dry_run": False
+        }
+        pcfg = ProgramConfig.initialize(**pcfg_params)
+        acfg = AgentConfig()
+        acfg.metadata_rewrite_page_size = 1
+        m_get_acfg.return_value = acfg
+        mck_writer = m_writer.return_value.__enter__.return_value
+
+        await TagMetadataRewriter.rewrite_tag_keywords(23)
+
+        assert mck_writer.write.call_count == 2
+        mck_writer.write.assert_called_with({"tags"})
+        written_ids = [c.args[0].id for c in m_writer.call_args_list]
+        assert written_ids == [414,415]
+        async with test_db.db_connection_pool.acquire_dict_cursor(db=pcfg.msg_db_name) as (cur,_):
+            await cur.execute("SELECT COUNT(*) AS cnt FROM tag_keyword_rewrite")
+            assert not (await cur.fetchone())["cnt"]
+
+    @pytest.mark.asyncio
+    @patch("pwgo_helper.agent.tag_metadata_rewriter.FileMetadataWriter")
+    async def test_resume_pending(self, m_writer, test_db: TestDbResult):
+        """tests that an interrupted rewrite resumes after the checkpointed image"""
+        pcfg_params = {
+            "db_conn_json": json.dumps(test_db.db_host),
+            "pwgo_db_name": test_db.piwigo_db,
+            "msg_db_name": test_db.messaging_db,
+            "rek_db_name": test_db.rekognition_db,
+            "dry_run": False
+        }
+        pcfg = ProgramConfig.initialize(**pcfg_params)
+        async with test_db.db_connection_pool.acquire_dict_cursor(db=pcfg.msg_db_name) as (cur,conn):
+            await cur.execute("INSERT INTO tag_keyword_rewrite (tag_id, last_image_id) VALUES (23, 414)")
+            await conn.commit()
+
+        await TagMetadataRewriter.resume_pending()
+
+        written_ids = [c.args[0].id for c in m_writer.call_args_list]
+        assert written_ids == [415]
+
+    @pytest.mark.asyncio
+    @patch("pwgo_helper.agent.tag_metadata_rewriter.FileMetadataWriter")
+    @patch.object(AgentConfig, "get")
+    async def test_rewrite_failed_image(self, m_get_acfg, m_writer, test_db: TestDbResult):
+        """tests that an image that can't be written is skipped without stopping the rewrite"""
+        pcfg_params = {
+            "db_conn_json": json.dumps(test_db.db_host),
+            "pwgo_db_name": test_db.piwigo_db,
+            "msg_db_name": test_db.messaging_db,
+            "rek_db_name": test_db.rekognition_db,
+            "dry_run": False
+        }
+        pcfg = ProgramConfig.initialize(**pcfg_params)
+        acfg = AgentConfig()
+        acfg.metadata_rewrite_page_size = 1
+        m_get_acfg.return_value = acfg
+        m_writer.return_value.__enter__.return_value.write.side_effect = [OSError("corrupt file"), None]
+
+        await TagMetadataRewriter.rewrite_tag_keywords(23)
+
+        written_ids = [c.args[0].id for c in m_writer.call_args_list]
+        assert written_ids == [414,415]
+        async with test_db.db_connection_pool.acquire_dict_cursor(db=pcfg.msg_db_name) as (cur,_):
+            await cur.execute("SELECT COUNT(*) AS cnt FROM tag_keyword_rewrite")
+            assert not (await cur.fetchone())["cnt"]
@@ -0,0 +1,84 @@
+"""container module for TestVirtualFsChecker"""
+import tempfile, os
+from unittest.mock import patch
+
+import click
+import pytest
+from path import Path
+
+from ...agent.config import Configuration as AgentConfig
+from ...agent.virtualfs_checker import VirtualFsChecker
+
+class TestVirtualFsChecker:
+    """Tests for the VirtualFsChecker class"""
+    @patch.object(AgentConfig, "get")
+    def test_check_and_fix(self, mck_get_acfg):
+        """tests that each kind of problem is reported and that fixing the report leaves a
+        tree with nothing left to report"""
+        mck_get_acfg.return_value = AgentConfig()
+        mck_get_acfg.return_value.virtualfs_allow_broken_links = True
+        with tempfile.TemporaryDirectory() as src_dir, tempfile.TemporaryDirectory() as tmp_dir:
+            src_paths = [os.path.join(src_dir, f"img{i}.jpg") for i in range(4)]
+            for src_path in src_paths[:3]:
+                Path(src_path).touch()
+            ok_link = os.path.join(tmp_dir, "a", "ok.jpg")
+            wrong_link = os.path.join(tmp_dir, "a", "wrong.jpg")
+            missing_link = os.path.join(tmp_dir, "b", "c", "missing.jpg")
+            broken_link = os.path.join(tmp_dir, "a", "broken.jpg")
+            extra_link = os.path.join(tmp_dir, "d", "e", "extra.jpg")
+            os.makedirs(os.path.dirname(ok_link))
+            os.makedirs(os.path.dirname(extra_link))
+            os.symlink(src_paths[0], ok_link)
+            os.symlink(src_paths[0], wrong_link)
+            os.symlink(src_paths[3], broken_link)
+            os.symlink(src_paths[0], extra_link)
+            expected = {
+                ok_link: src_paths[0],
+                wrong_link: src_paths[1],
+                missing_link: src_paths[2],
+                broken_link: src_paths[3]
+            }
+
+            checker = VirtualFsChecker(tmp_dir, expected, workers=4)
+            report = checker.check()
+
+            assert report["missing"] == [missing_link]
+            assert report["extra"] == [extra_link]
+            assert report["wrong_target"] == [wrong_link]
+            assert report["broken"] == [broken_link]
+            assert sorted(report["extra_dirs"]) == [os.path.join(tmp_dir, "d"), os.path.join(tmp_dir, "d", "e")]
+            assert checker.current == {ok_link, broken_link}
+
+            created = checker.fix(report)
+
+            assert sorted(created) == sorted([missing_link, wrong_link])
+            report = VirtualFsChecker(tmp_dir, expected).check()
+            assert report["broken"] == [broken_link]
+            assert not any(v for k, v in report.items() if k != "broken")
+
+    @patch.object(AgentConfig, "get")
+    def test_resolve_link_type(self, mck_get_acfg):
+        """tests that the link type is taken from the existing tree, that fixing a tree of
+        another type is refused and that a report doesn't probe the virtualfs"""
+        mck_get_acfg.return_value = AgentConfig()
+        with tempfile.TemporaryDirectory() as src_dir, tempfile.TemporaryDirectory() as tmp_dir:
+            mck_get_acfg.return_value.piwigo_galleries_host_path = src_dir
+            mck_get_acfg.return_value.virtualfs_root = tmp_dir
+            src_path = os.path.join(src_dir, "img1.jpg")
+            Path(src_path).touch()
+            link_path = os.path.join(tmp_dir, "a", "img1.jpg")
+            os.makedirs(os.path.dirname(link_path))
+            os.link(src_path, link_path)
+            expected = {link_path: src_path}
+
+            with patch("pwgo_helper.agent.virtualfs_link_builder.VirtualFsLinkBuilder._probe") as mck_probe:
+                assert VirtualFsChecker.resolve_link_type(tmp_dir, expected) == "hardlink"
+                assert VirtualFsChecker.resolve_link_type(tmp_dir, expected, "auto") == "hardlink"
+                assert VirtualFsChecker.resolve_link_type(tmp_dir, expected, "symlink") == "symlink"
+                mck_probe.assert_not_called()
+
+                with pytest.raises(click.ClickException):
+                    VirtualFsChecker.resolve_link_type(tmp_dir, expected, "symlink", fix=True)
+
+            assert VirtualFsChecker.resolve_link_type(tmp_dir, expected, fix=True) == "hardlink"
+            assert sorted(os.listdir(tmp_dir)) == ["a"]
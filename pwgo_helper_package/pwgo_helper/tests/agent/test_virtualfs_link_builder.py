@@ -0,0 +1,109 @@
+"""container module for TestVirtualFsLinkBuilder"""
+import tempfile, os
+from unittest.mock import patch, MagicMock
+
+from path import Path
+import pytest
+
+from ...agent.config import Configuration as AgentConfig
+from ...config import Configuration as ProgramConfig
+from ...agent.virtualfs_link_builder import VirtualFsLinkBuilder
+
+class TestVirtualFsLinkBuilder:
+    """Tests for the VirtualFsLinkBuilder class"""
+    @patch.object(AgentConfig, "get")
+    def test_build(self, mck_get_acfg, mocker):
+        """tests that links are created in parallel chunks and each directory is only created once"""
+        mck_get_acfg.return_value = AgentConfig()
+        mck_get_acfg.return_value.virtualfs_allow_broken_links = True
+        spy_makedirs = mocker.spy(os, "makedirs")
+        with tempfile.TemporaryDirectory() as src_dir, tempfile.TemporaryDirectory() as tmp_dir:
+            links = []
+            for i in range(50):
+                src_path = os.path.join(src_dir, f"img{i}.jpg")
+                Path(src_path).touch()
+                links.append((os.path.join(tmp_dir, f"album{i % 5}", "sub", f"img{i}.jpg"), src_path))
+
+            created = VirtualFsLinkBuilder(workers=4, chunk_size=7).build(links)
+
+            assert len(created) == 50
+            # makedirs recurses for missing parents so only count the leaf directory calls
+            leaf_calls = [c for c in spy_makedirs.call_args_list if c.args[0].endswith("sub")]
+            assert len(leaf_calls) == 5
+            for link_path, src_path in links:
+                assert os.readlink(link_path) == src_path
+
+    @patch.object(AgentConfig, "get")
+    def test_check_sources(self, mck_get_acfg, mocker):
+        """tests that source existence is checked with one listing per directory and that
+        missing sources raise when broken links aren't allowed"""
+        mck_get_acfg.return_value = AgentConfig()
+        mck_get_acfg.return_value.virtualfs_allow_broken_links = False
+        spy_listdir = mocker.spy(os, "listdir")
+        with tempfile.TemporaryDirectory() as src_dir:
+            src_paths = [os.path.join(src_dir, f"img{i}.jpg") for i in range(10)]
+            for src_path in src_paths:
+                Path(src_path).touch()
+
+            builder = VirtualFsLinkBuilder()
+            builder.check_sources(src_paths)
+            assert spy_listdir.call_count == 1
+
+            with pytest.raises(FileNotFoundError):
+                builder.check_sources([os.path.join(src_dir, "missing.jpg")])
+
+    @patch.object(AgentConfig, "get")
+    def test_build_hardlinks(self, mck_get_acfg):
+        """tests that hard links are recognized as current and that missing sources are
+        skipped since a hard link can't be broken"""
+        mck_get_acfg.return_value = AgentConfig()
+        mck_get_acfg.return_value.virtualfs_allow_broken_links = True
+        with tempfile.TemporaryDirectory() as src_dir, tempfile.TemporaryDirectory() as tmp_dir:
+            src_path = os.path.join(src_dir, "img1.jpg")
+            Path(src_path).touch()
+            link_path = os.path.join(tmp_dir, "album", "img1.jpg")
+            missing_link_path = os.path.join(tmp_dir, "album", "img2.jpg")
+            builder = VirtualFsLinkBuilder(link_type="hardlink")
+
+            created = builder.build([(link_path, src_path),
+                (missing_link_path, os.path.join(src_dir, "img2.jpg"))])
+
+            assert created == [link_path]
+            assert os.path.samefile(link_path, src_path)
+            assert not os.path.lexists(missing_link_path)
+            with os.scandir(os.path.dirname(link_path)) as entries:
+                entry = next(entries)
+                assert builder.is_current(entry, src_path)
+                assert not VirtualFsLinkBuilder(link_type="symlink").is_current(entry, src_path)
+
+    @pytest.mark.parametrize("wanted,supported,dry_run,expected", [
+        ("auto", ["hardlink", "reflink"], False, "hardlink"),
+        ("auto", ["reflink"], True, "reflink"),
+        ("auto", ["reflink"], False, "symlink"),
+        ("auto", [], False, "symlink"),
+        ("reflink", ["reflink"], False, "reflink"),
+        ("reflink", [], False, "symlink"),
+        ("symlink", ["hardlink"], False, "symlink")
+    ])
+    @patch.object(ProgramConfig, "get")
+    @patch.object(AgentConfig, "get")
+    def test_detect_link_type(self, mck_get_acfg, mck_get_pcfg, wanted, supported, dry_run, expected):
+        # pylint: disable=too-many-arguments
+        """tests the selection of the virtualfs link type from the supported types. reflinks
+        are only picked automatically when no metadata is written to the source files"""
+        mck_get_acfg.return_value = AgentConfig()
+        mck_get_pcfg.return_value = MagicMock(dry_run=dry_run)
+        mck_get_acfg.return_value.virtualfs_link_type = wanted
+        with patch.object(VirtualFsLinkBuilder, "_probe", side_effect=lambda t, *_: t in supported):
+            assert VirtualFsLinkBuilder.detect_link_type() == expected
+        assert mck_get_acfg.return_value.virtualfs_link_type == expected
+
+    @patch.object(AgentConfig, "get")
+    def test_probe(self, mck_get_acfg):
+        """tests that probing for hard link support leaves nothing behind"""
+        mck_get_acfg.return_value = AgentConfig()
+        with tempfile.TemporaryDirectory() as src_dir, tempfile.TemporaryDirectory() as tmp_dir:
+            Path(os.path.join(src_dir, "img1.jpg")).touch()
+            probe_src = VirtualFsLinkBuilder._find_probe_source(src_dir)
+            assert VirtualFsLinkBuilder._probe("hardlink", probe_src, tmp_dir)
+            assert not os.listdir(tmp_dir)
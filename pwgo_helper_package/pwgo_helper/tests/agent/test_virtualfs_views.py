@@ -0,0 +1,140 @@
+"""container module for TestVirtualFsViews"""
+import asyncio, tempfile, os
+from datetime import datetime
+from unittest.mock import patch
+
+import pytest
+from path import Path
+
+from ...agent.config import Configuration as AgentConfig
+from ...agent.virtualfs_views import VirtualFsViews
+from ...agent.image_virtual_path_event_task import ImageVirtualPathEventTask
+
+class TestVirtualFsViews:
+    """Tests for the VirtualFsViews class"""
+    @patch.object(AgentConfig, "get")
+    def test_view_paths(self, mck_get_acfg):
+        """tests the virtual paths generated for the tag and date views"""
+        mck_get_acfg.return_value = AgentConfig()
+
+        assert VirtualFsViews.tag_virtual_path("Beach/Sand", 3, "a.jpg") == "./tags/Beach_Sand/3_a.jpg"
+        assert VirtualFsViews.tag_virtual_path("..", 3, "a.jpg") == "./tags/_/3_a.jpg"
+        assert VirtualFsViews.date_virtual_path(datetime(2021, 2, 17, 22, 20), 3, "a.jpg") \
+            == "./dates/2021/02/3_a.jpg"
+        assert VirtualFsViews.date_virtual_path("2021-02-17 22:20:33", 3, "a.jpg") == "./dates/2021/02/3_a.jpg"
+        assert VirtualFsViews.date_virtual_path(None, 3, "a.jpg") == "./dates/undated/3_a.jpg"
+
+    @pytest.mark.asyncio
+    @patch.object(ImageVirtualPathEventTask, "_dir_counts", None)
+    @patch.object(VirtualFsViews, "_get_image")
+    @patch.object(AgentConfig, "get")
+    async def test_apply_date_change(self, mck_get_acfg, mck_get_image):
+        """tests that a date change moves the image's link and prunes the old directories"""
+        with tempfile.TemporaryDirectory() as src_dir, tempfile.TemporaryDirectory() as vfs_root:
+            mck_get_acfg.return_value = AgentConfig()
+            mck_get_acfg.return_value.virtualfs_views = ("dates",)
+            mck_get_acfg.return_value.virtualfs_root = vfs_root
+            mck_get_acfg.return_value.piwigo_galleries_host_path = src_dir
+            mck_get_acfg.return_value.virtualfs_event_wait_secs = 0
+            Path(os.path.join(src_dir, "a.jpg")).touch()
+            mck_get_image.return_value = {"file": "a.jpg", "physical_path": "./a.jpg", "date_creation": None}
+
+            await VirtualFsViews.apply_date_change(3, [])
+            old_link = os.path.join(vfs_root, "dates", "undated", "3_a.jpg")
+            assert os.path.islink(old_link)
+
+            mck_get_image.return_value["date_creation"] = datetime(2021, 2, 17)
+            await VirtualFsViews.apply_date_change(3, [None])
+            assert not os.path.lexists(os.path.dirname(old_link))
+            new_link = os.path.join(vfs_root, "dates", "2021", "02", "3_a.jpg")
+            assert os.readlink(new_link) == os.path.join(src_dir, "a.jpg")
+            assert not ImageVirtualPathEventTask.get_pending_tasks()
+
+    @pytest.mark.asyncio
+    @patch.object(ImageVirtualPathEventTask, "_dir_counts", None)
+    @patch.object(VirtualFsViews, "_get_image")
+    @patch.object(AgentConfig, "get")
+    async def test_view_changes_batched(self, mck_get_acfg, mck_get_image, mocker):
+        """tests that view changes of images handled at the same time are applied by
+        a single virtual path batch"""
+        mck_get_acfg.return_value = AgentConfig()
+        mck_get_acfg.return_value.virtualfs_views = ("dates",)
+        mck_get_acfg.return_value.virtualfs_allow_broken_links = True
+        mck_get_acfg.return_value.virtualfs_event_wait_secs = .1
+        spy_apply = mocker.spy(ImageVirtualPathEventTask, "apply_events")
+        mck_get_image.side_effect = lambda image_id: {
+            "file": f"{image_id}.jpg", "physical_path": f"./{image_id}.jpg", "date_creation": None
+        }
+        with tempfile.TemporaryDirectory() as src_dir, tempfile.TemporaryDirectory() as vfs_root:
+            mck_get_acfg.return_value.virtualfs_root = vfs_root
+            mck_get_acfg.return_value.piwigo_galleries_host_path = src_dir
+
+            await asyncio.gather(*[VirtualFsViews.apply_date_change(i, []) for i in range(5)])
+
+            assert spy_apply.call_count == 1
+            assert len(os.listdir(os.path.join(vfs_root, "dates", "undated"))) == 5
+            assert not ImageVirtualPathEventTask.get_pending_tasks()
+
+    @pytest.mark.asyncio
+    @patch.object(ImageVirtualPathEventTask, "_dir_counts", None)
+    @patch.object(VirtualFsViews, "_get_image")
+    @patch.object(AgentConfig, "get")
+    async def test_apply_membership_change(self, mck_get_acfg, mck_get_image):
+        """tests that an image's view links follow it in and out of the virtualfs root category"""
+        with tempfile.TemporaryDirectory() as src_dir, tempfile.TemporaryDirectory() as vfs_root:
+            mck_get_acfg.return_value = AgentConfig()
+            mck_get_acfg.return_value.virtualfs_views = ("dates",)
+            mck_get_acfg.return_value.virtualfs_root = vfs_root
+            mck_get_acfg.return_value.piwigo_galleries_host_path = src_dir
+            mck_get_acfg.return_value.virtualfs_event_wait_secs = 0
+            img = {"file": "a.jpg", "physical_path": "./a.jpg", "date_creation": datetime(2021, 2, 17)}
+            in_root = True
+            mck_get_image.side_effect = lambda image_id, any_category=False: img if in_root or any_category else None
+            link = os.path.join(vfs_root, "dates", "2021", "02", "3_a.jpg")
+
+            await VirtualFsViews.apply_membership_change(3)
+            assert not os.path.lexists(link)
+
+            mck_get_acfg.return_value.virtualfs_category_id = 1
+            await VirtualFsViews.apply_membership_change(3)
+            assert os.readlink(link) == os.path.join(src_dir, "a.jpg")
+
+            in_root = False
+            await VirtualFsViews.apply_membership_change(3)
+            assert not os.path.lexists(link)
+
+    @pytest.mark.asyncio
+    @patch.object(ImageVirtualPathEventTask, "_dir_counts", None)
+    @patch.object(AgentConfig, "get")
+    async def test_remove_image_links(self, mck_get_acfg):
+        """tests that a deleted image's links are removed from every view using the event values"""
+        with tempfile.TemporaryDirectory() as vfs_root:
+            mck_get_acfg.return_value = AgentConfig()
+            mck_get_acfg.return_value.virtualfs_views = ("tags", "dates")
+            mck_get_acfg.return_value.virtualfs_root = vfs_root
+            mck_get_acfg.return_value.virtualfs_event_wait_secs = 0
+            links = [os.path.join(vfs_root, *p) for p in [
+                ("tags", "Beach", "3_a.jpg"), ("tags", "Sand", "3_a.jpg"), ("dates", "2021", "02", "3_a.jpg")
+            ]]
+            other = os.path.join(vfs_root, "tags", "Beach", "4_b.jpg")
+            for link in links + [other]:
+                os.makedirs(os.path.dirname(link), exist_ok=True)
+                os.symlink("/nonexistent", link)
+
+            await VirtualFsViews.remove_image_links(3, {"file": "a.jpg", "date_creation": "2021-02-17 22:20:33"})
+
+            assert not any(os.path.lexists(link) for link in links)
+            assert os.path.lexists(other)
+            assert sorted(os.listdir(vfs_root)) == ["tags"]
+
+    @pytest.mark.asyncio
+    @patch.object(VirtualFsViews, "_get_image")
+    @patch.object(AgentConfig, "get")
+    async def test_disabled_views(self, mck_get_acfg, mck_get_image):
+        """tests that nothing is looked up when the views aren't enabled"""
+        mck_get_acfg.return_value = AgentConfig()
+
+        await VirtualFsViews.apply_tag_changes(3, {1: 1})
+        await VirtualFsViews.apply_date_change(3, [])
+
+        mck_get_image.assert_not_called()
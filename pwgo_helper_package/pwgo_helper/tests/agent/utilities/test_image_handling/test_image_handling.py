@@ -1,11 +1,14 @@
 """container for TestImageHandling"""
 import os
+from io import BytesIO
+from unittest.mock import patch
 
 import pytest
-from PIL import Image
+from PIL import Image, JpegImagePlugin
 import imagehash
 
 from .....agent import utilities
+from .....agent.pwgo_image import ScaledImage
 
 MODULE_PATH = os.path.dirname(os.path.abspath(__file__))
 
@@ -80,3 +83,44 @@ class TestImageHandling:
         with Image.open(test_scale_result) as scaled_test_img:
             assert scaled_test_img.size[0] and scaled_test_img.size[0] <= max_size[0]
             assert scaled_test_img.size[1] and scaled_test_img.size[1] <= max_size[1]
+
+    def test_scaled_image(self):
+        """tests that a ScaledImage encodes the scaled pixels and crops from them"""
+        max_size = (250,200)
+        crop_bounding = { "Left": 0.35, "Top": 0.25, "Width": 0.25, "Height": 0.45 }
+        with open(os.path.join(MODULE_PATH, "test_image.JPG"), mode='rb') as test_image:
+            scaled = ScaledImage(utilities.scale_image(test_image, max_size))
+
+        with Image.open(scaled.open()) as encoded_img, Image.open(scaled.open()) as encoded_again:
+            assert encoded_img.size == scaled.pixels.size == encoded_again.size
+            assert encoded_img.size[0] <= max_size[0] and encoded_img.size[1] <= max_size[1]
+
+        with Image.open(scaled.crop(crop_bounding)) as crop_img:
+            assert crop_img.size == (
+                round(scaled.pixels.size[0] * 0.6) - round(scaled.pixels.size[0] * 0.35),
+                round(scaled.pixels.size[1] * 0.7) - round(scaled.pixels.size[1] * 0.25))
+
+    def test_scale_image_draft(self):
+        """tests that a large JPEG is decoded at a reduced scale and resized to fit"""
+        org_bytes = BytesIO()
+        Image.new("RGB", (4000, 3000), (200, 30, 30)).save(org_bytes, format="JPEG")
+        org_bytes.seek(0)
+        drafted = []
+        org_draft = JpegImagePlugin.JpegImageFile.draft
+        def spy_draft(img, mode, size):
+            result = org_draft(img, mode, size)
+            drafted.append(img.size)
+            return result
+
+        with patch.object(JpegImagePlugin.JpegImageFile, "draft", autospec=True, side_effect=spy_draft):
+            scaled = utilities.scale_image(org_bytes, (1024, 1024))
+
+        assert drafted == [(2000, 1500)]
+        assert scaled.size == (1024, 768)
+        assert scaled.getpixel((512, 384))[0] > 150
+
+    def test_fit_size(self):
+        """tests the aspect preserving fit of fit_size"""
+        assert utilities.fit_size((4000, 3000), (1024, 1024)) == (1024, 768)
+        assert utilities.fit_size((3000, 4000), (1024, 1024)) == (768, 1024)
+        assert utilities.fit_size((800, 600), (1024, 1024)) == (800, 600)
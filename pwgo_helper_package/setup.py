@@ -31,12 +31,19 @@ setup_args = {
             "pytest-cov",
             "pytest-mock",
             "imagehash",
+            "opencv-python-headless<5",
             "pandas",
             "rope",
             "sphinx",
             "sphinx-click",
             "sphinx-markdown-builder",
             "myst-parser"
+        ],
+        "burst": [
+            "imagehash"
+        ],
+        "prefilter": [
+            "opencv-python-headless<5"
         ]
     },
     "entry_points": { "console_scripts": ["pwgo-helper = pwgo_helper.pwgo_helper:pwgo_helper"] }